@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite for the hogtie likelihood engines.
+
+Times BinaryStateModel, DiscreteMarkovModel, MatrixParser and
+SimulateNull over a grid of tree sizes, numbers of unique patterns,
+tree shapes and models. The screened_matrix_parser target fits 
+columns simulated with few changes with parsimony screening on, and
+also reports its speedup over fitting them unscreened. Each case runs in a fresh process so that its
+peak RSS is measured on its own. Results (wall time, peak RSS, and
+pattern likelihood evaluations per second) are written to JSON, and
+two result files can be compared to track regressions:
+
+    python benchmarks/run_benchmarks.py --grid quick -o new.json
+    python benchmarks/run_benchmarks.py --grid full -o new.json
+    python benchmarks/run_benchmarks.py --compare old.json new.json
+
+Pass --backend numpy or --backend numba to time one likelihood backend
+(cases are matched across files without it, so two backends can be
+compared like two commits).
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+TARGETS = (
+    "binary_state_model", "discrete_markov_model", "matrix_parser",
+    "screened_matrix_parser", "simulate_null",
+)
+SHAPES = ("baltree", "imbtree", "unittree")
+MODELS = ("ER", "ARD")
+
+GRIDS = {
+    "quick": {
+        "ntips": [10, 50],
+        "npatterns": [100, 1000],
+    },
+    "full": {
+        "ntips": [10, 100, 500, 2000],
+        "npatterns": [100, 10000, 1000000],
+    },
+}
+
+# targets that fit a single pattern are run once per tree
+SINGLE_PATTERN = ("binary_state_model",)
+
+# the screened_matrix_parser target simulates columns with about
+# SCREEN_CHANGES changes on average and screens at SCREEN_THRESHOLD
+SCREEN_CHANGES = 2.
+SCREEN_THRESHOLD = 3
+
+
+
+def make_tree(shape, ntips, seed):
+    """
+    Returns a toytree of the given shape and size with height 1.
+    """
+    import toytree
+    if shape == "baltree":
+        return toytree.rtree.baltree(ntips=ntips, treeheight=1.)
+    if shape == "imbtree":
+        return toytree.rtree.imbtree(ntips=ntips, treeheight=1.)
+    return toytree.rtree.unittree(ntips=ntips, treeheight=1., seed=seed)
+
+
+def make_patterns(ntips, npatterns, seed):
+    """
+    Returns up to npatterns unique random (npatterns, ntips) patterns.
+    """
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    npatterns = min(npatterns, 2 ** min(ntips, 62))
+    patterns = np.unique(rng.integers(0, 2, (npatterns, ntips), dtype=np.uint8), axis=0)
+    return patterns
+
+
+def simulate_patterns(tree, npatterns, seed):
+    """
+    Returns the unique patterns of npatterns columns simulated on the
+    tree at equal rates giving SCREEN_CHANGES changes on average, like
+    k-mer columns that mostly fit the tree.
+    """
+    import numpy as np
+    from hogtie.compiled_tree import compile_tree
+    from hogtie.forward import ForwardSimulator
+    ctree = compile_tree(tree)
+    rate = SCREEN_CHANGES / ctree.dists.sum()
+    sites = ForwardSimulator(ctree, rate, rate, seed=seed).simulate(npatterns)
+    return np.unique(sites, axis=0)
+
+
+def count_evaluations():
+    """
+    Turns on hogtie profiling so that the pattern likelihoods computed
+    by every engine are counted (the 'pruned_patterns' counter), and
+    returns the profiler holding the counts.
+    """
+    from hogtie.profiling import PROFILER, enable_profiling
+    PROFILER.reset()
+    enable_profiling()
+    return PROFILER
+
+
+def run_case(case):
+    """
+    Runs one benchmark case and returns its result dict. Called in a
+    fresh process.
+    """
+    import numpy as np
+    import pandas as pd
+    from loguru import logger
+    logger.remove()
+
+    tree = make_tree(case["shape"], case["ntips"], case["seed"])
+    if case["target"] == "screened_matrix_parser":
+        patterns = simulate_patterns(tree, case["npatterns"], case["seed"])
+    else:
+        patterns = make_patterns(case["ntips"], case["npatterns"], case["seed"])
+    profiler = count_evaluations()
+    result = dict(case, nunique=int(patterns.shape[0]))
+
+    start = time.perf_counter()
+    if case["target"] == "binary_state_model":
+        from hogtie import BinaryStateModel
+        model = BinaryStateModel(tree, patterns[0], case["model"])
+        model.optimize()
+
+    elif case["target"] == "discrete_markov_model":
+        from hogtie.discrete_markov_model import DiscreteMarkovModel
+        data = pd.DataFrame(patterns, columns=tree.get_tip_labels())
+        model = DiscreteMarkovModel(tree, data, case["model"], backend=case["backend"])
+        model.optimize()
+
+    elif case["target"] == "matrix_parser":
+        from hogtie import MatrixParser
+        matrix = pd.DataFrame(patterns.T, index=tree.get_tip_labels())
+        parser = MatrixParser(tree=tree, matrix=matrix, model=case["model"], backend=case["backend"])
+        parser.matrix_likelihoods()
+
+    elif case["target"] == "screened_matrix_parser":
+        from hogtie import MatrixParser
+        matrix = pd.DataFrame(patterns.T, index=tree.get_tip_labels())
+        parser = MatrixParser(
+            tree=tree, matrix=matrix, model=case["model"],
+            screen=SCREEN_THRESHOLD, backend=case["backend"])
+        parser.matrix_likelihoods()
+
+    elif case["target"] == "simulate_null":
+        from hogtie.simulate import SimulateNull
+        matrix = pd.DataFrame(patterns.T, index=tree.get_tip_labels())
+        mode = "exact" if case["ntips"] <= 20 else "bootstrap"
+        null = SimulateNull(tree=tree, matrix=matrix, model=case["model"], mode=mode, seed=case["seed"])
+        null.null()
+        result["mode"] = mode
+
+    wall = time.perf_counter() - start
+    result["wall"] = wall
+    evaluations = profiler.counters["pruned_patterns"]
+    result["evaluations"] = evaluations
+    result["evals_per_sec"] = evaluations / wall if wall else float("nan")
+
+    # the unscreened fit of the same columns, for the screening speedup
+    if case["target"] == "screened_matrix_parser":
+        from hogtie.profiling import enable_profiling
+        enable_profiling(False)
+        result["screened"] = profiler.counters["screened_patterns"]
+        unscreened = MatrixParser(tree=tree, matrix=matrix, model=case["model"], backend=case["backend"])
+        start = time.perf_counter()
+        unscreened.matrix_likelihoods()
+        result["unscreened_wall"] = time.perf_counter() - start
+        result["speedup"] = result["unscreened_wall"] / wall
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    scale = 1 / 1024 ** 2 if sys.platform == "darwin" else 1 / 1024
+    result["peak_rss_mb"] = maxrss * scale
+    result["status"] = "ok"
+    return result
+
+
+def make_cases(targets, shapes, models, ntips, npatterns, seed, backend="auto"):
+    """
+    Returns the list of benchmark cases in the grid.
+    """
+    cases = []
+    for target, shape, model, tips in itertools.product(targets, shapes, models, ntips):
+        for npat in ([1] if target in SINGLE_PATTERN else npatterns):
+            cases.append({
+                "target": target, "shape": shape, "model": model,
+                "ntips": tips, "npatterns": npat, "seed": seed,
+                "backend": backend,
+            })
+    return cases
+
+
+def run_cases(cases, timeout=None):
+    """
+    Runs each case in its own process and returns the results. Cases
+    that fail are recorded with their error.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for case in cases:
+        label = "{target} {shape} {model} ntips={ntips} npatterns={npatterns}".format(**case)
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            try:
+                result = pool.submit(run_case, case).result(timeout=timeout)
+            except Exception as err:
+                result = dict(case, status=f"error: {type(err).__name__}: {err}")
+        results.append(result)
+        if result["status"] == "ok":
+            speedup = f" {result['speedup']:>6.1f}x unscreened" if "speedup" in result else ""
+            print(f"{label:<70} {result['wall']:>9.3f}s {result['peak_rss_mb']:>8.1f}MB "
+                  f"{result['evals_per_sec']:>12.0f} evals/s{speedup}", flush=True)
+        else:
+            print(f"{label:<70} {result['status']}", flush=True)
+    return results
+
+
+def environment():
+    """
+    Returns versions and machine info stored with the results.
+    """
+    import numpy as np
+    import hogtie
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    return {
+        "hogtie": hogtie.__version__,
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": numba_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def case_key(result):
+    "Identifies a case across result files"
+    return tuple(result[i] for i in ("target", "shape", "model", "ntips", "npatterns"))
+
+
+def compare(old_path, new_path):
+    """
+    Prints the ratio of new to old wall time and peak RSS of the cases
+    in both result files.
+    """
+    with open(old_path) as infile:
+        old = {case_key(i): i for i in json.load(infile)["results"] if i["status"] == "ok"}
+    with open(new_path) as infile:
+        new = {case_key(i): i for i in json.load(infile)["results"] if i["status"] == "ok"}
+    print(f"{'case':<70} {'time':>8} {'rss':>8}")
+    for key in sorted(set(old) & set(new), key=str):
+        label = "{} {} {} ntips={} npatterns={}".format(*key)
+        time_ratio = new[key]["wall"] / old[key]["wall"]
+        rss_ratio = new[key]["peak_rss_mb"] / old[key]["peak_rss_mb"]
+        flag = "  <-- slower" if time_ratio > 1.2 else ""
+        print(f"{label:<70} {time_ratio:>7.2f}x {rss_ratio:>7.2f}x{flag}")
+
+
+def parse_command_line():
+    """
+    Parses the benchmark CLI inputs
+    """
+    parser = argparse.ArgumentParser('hogtie benchmarks')
+    parser.add_argument('--grid', choices=sorted(GRIDS), default='quick',
+        help='Preset of tip and pattern counts (default=quick)')
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=list(TARGETS))
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=list(SHAPES))
+    parser.add_argument('--models', nargs='+', choices=MODELS, default=list(MODELS))
+    parser.add_argument('--ntips', nargs='+', type=int, help='Overrides the tip counts of the grid')
+    parser.add_argument('--npatterns', nargs='+', type=int, help='Overrides the pattern counts of the grid')
+    parser.add_argument('--seed', type=int, default=123)
+    parser.add_argument('--backend', choices=('auto', 'numpy', 'numba'), default='auto',
+        help='Likelihood backend of DiscreteMarkovModel and MatrixParser (default=auto)')
+    parser.add_argument('--timeout', type=float, default=None, help='Seconds before a case is abandoned')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='JSON file to write')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='Compare two result files instead of running benchmarks')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the benchmark grid and writes the results to JSON.
+    """
+    args = parse_command_line()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    grid = GRIDS[args.grid]
+    cases = make_cases(
+        args.targets, args.shapes, args.models,
+        args.ntips or grid["ntips"], args.npatterns or grid["npatterns"], args.seed,
+        args.backend,
+    )
+    results = run_cases(cases, args.timeout)
+    with open(args.output, "w") as out:
+        json.dump({"environment": environment(), "results": results}, out, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
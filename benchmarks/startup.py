@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Startup time benchmark for hogtie.
+
+Cluster array jobs that each score a small shard run the hogtie CLI
+thousands of times, so the fixed cost of starting python and importing
+hogtie matters as much as the likelihood engine. Each command is run
+in a fresh interpreter several times and the median wall time is
+compared to its target. The heavy optional stacks (scipy, plotting,
+coalescent simulation) must not be imported by the CLI at all.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --repeats 20 -o startup.json
+
+Exits with status 1 if a target is missed or a heavy module is loaded.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# (name, python code run in a fresh interpreter, target median seconds)
+COMMANDS = [
+    ("python", "pass", None),
+    ("import hogtie", "import hogtie", 0.25),
+    ("import cli", "import hogtie.__main__", 0.6),
+    ("cli --help", (
+        "import sys; sys.argv = ['hogtie', '--help']\n"
+        "from hogtie.__main__ import main\n"
+        "try:\n    main()\nexcept SystemExit:\n    pass"
+    ), 0.6),
+]
+
+# modules that scoring a matrix from the CLI must not import
+HEAVY = ("scipy", "toyplot", "ipcoal", "IPython", "numba")
+
+REPORT_LOADED = (
+    "import sys, json\n"
+    "import hogtie.__main__\n"
+    "print(json.dumps(sorted(m for m in {} if m in sys.modules)))"
+).format(HEAVY)
+
+
+def run(code):
+    """
+    Returns the wall time in seconds of running code in a fresh
+    interpreter.
+    """
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", code], check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def heavy_modules():
+    """
+    Returns the heavy modules that are loaded by importing the CLI.
+    """
+    out = subprocess.run(
+        [sys.executable, "-c", REPORT_LOADED],
+        check=True, capture_output=True, text=True,
+    )
+    return json.loads(out.stdout)
+
+
+def parse_command_line():
+    """
+    Parses the startup benchmark CLI inputs
+    """
+    parser = argparse.ArgumentParser('hogtie startup benchmark')
+    parser.add_argument('--repeats', type=int, default=10,
+        help='Number of fresh interpreters per command (default=10)')
+    parser.add_argument('-o', '--output', default=None, help='JSON file to write')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Times each command, prints the medians against their targets and
+    exits with status 1 if any target is missed.
+    """
+    args = parse_command_line()
+    # run from the repo root so that the working tree is imported
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    results = []
+    failed = False
+    for name, code, target in COMMANDS:
+        run(code)  # warm the filesystem and bytecode caches
+        times = [run(code) for _ in range(args.repeats)]
+        median = statistics.median(times)
+        ok = target is None or median <= target
+        failed |= not ok
+        results.append({"command": name, "median": median, "min": min(times), "target": target, "ok": ok})
+        target_str = f"{target:.2f}s" if target is not None else "-"
+        print(f"{name:<16} {median:>7.3f}s  (target {target_str}){'' if ok else '  <-- over target'}")
+
+    loaded = heavy_modules()
+    failed |= bool(loaded)
+    print(f"heavy modules loaded by the CLI: {', '.join(loaded) or 'none'}")
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump({"python": sys.version, "results": results, "heavy_modules": loaded}, out, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
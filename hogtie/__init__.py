@@ -5,11 +5,32 @@ Binary state character phylogenetic likelihood calculations
 """
 
 
+import importlib
 from hogtie.utils import set_loglevel
-from hogtie.binary_state_model import BinaryStateModel
-from hogtie.matrixlike import MatrixParser
-from hogtie.simulate import SimulateNull
 
 __version__ = "0.0.5"
 
+# public classes are imported from their modules on first access (PEP 562),
+# so that `import hogtie` and the CLI do not load scipy, the simulation
+# stack (ipcoal) or plotting libraries until they are actually used.
+_LAZY = {
+    "BinaryStateModel": "hogtie.binary_state_model",
+    "MatrixParser": "hogtie.matrixlike",
+    "SimulateNull": "hogtie.simulate",
+}
+
+__all__ = ["set_loglevel", *_LAZY]
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        value = getattr(importlib.import_module(_LAZY[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module 'hogtie' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
 #set_loglevel("INFO")
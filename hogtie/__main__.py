@@ -7,8 +7,11 @@ Command line interface for hogtie
 import argparse
 import sys
 import os
-import pandas as pd
-from hogtie import BinaryStateModel, MatrixParser
+from hogtie.matrixlike import MatrixParser
+from hogtie.binary_matrix import convert_matrix, is_binary_matrix
+from hogtie.compiled_tree import compile_tree
+from hogtie.profiling import enable_profiling, log_profile, stage
+from hogtie.utils import set_loglevel
 
 
 
@@ -22,14 +25,20 @@ def parse_command_line():
     parser.add_argument('-d', '--data',
         nargs='?',
         type=argparse.FileType('r'),
-        help='Input is binary character trait data in a csv file',
+        help='Input is binary character trait data in a csv file or a bit-packed matrix (.hbm) from hogtie convert',
         default=sys.stdin
         )
 
     parser.add_argument('-t', '--tree',
         nargs='?',
-        type=argparse.FileType('r'),
-        help='tree in newick format with edge lengths and support values'
+        type=str,
+        help='tree in newick format with edge lengths and support values, or a compiled tree (.npz) written with --save-tree'
+        )
+
+    parser.add_argument('--save-tree',
+        nargs='?',
+        type=str,
+        help='Write the compiled tree to this .npz file so later runs can skip parsing newick'
         )
 
     parser.add_argument('-m', '--model',
@@ -44,33 +53,142 @@ def parse_command_line():
         help='Prior probability that the root state is 1 (default=0.5). Flat, uniform prior is assumed.'
         )
 
+    parser.add_argument('--threads',
+        type=int,
+        default=1,
+        help='Number of processes used to fit unique patterns (default=1)'
+        )
+
+    parser.add_argument('--chunksize',
+        type=int,
+        default=None,
+        help='Stream the matrix in blocks of this many columns instead of loading it into memory'
+        )
+
+    parser.add_argument('--cache',
+        type=str,
+        default=None,
+        help='Path to a persistent likelihood cache (SQLite) reused across runs on the same tree, model and prior'
+        )
+
+    parser.add_argument('--screen',
+        type=int,
+        default=None,
+        help='Only fit columns with a Fitch parsimony score above this number of changes; the rest are scored without a search at fixed rates set by their parsimony score'
+        )
+
+    parser.add_argument('--table',
+        type=str,
+        default=None,
+        help='Path to a table of the fits of every possible pattern (trees up to ~20 tips); built there if it does not exist'
+        )
+
+    parser.add_argument('--backend',
+        choices=('auto', 'numpy', 'numba'),
+        default='auto',
+        help='Likelihood backend; numba compiles the pruning passes and is used by auto when installed (default=auto)'
+        )
+
+    parser.add_argument('--profile',
+        nargs='?',
+        type=str,
+        const=sys.stderr,
+        default=None,
+        help='Log stage timings and hot-path counters as JSON to stderr, or to this file if a path is given'
+        )
+
     args = parser.parse_args()
     return args
 
+def parse_convert_command_line(argv):
+    """
+    Parses the args of the `hogtie convert` subcommand
+    """
+
+    parser = argparse.ArgumentParser('hogtie convert',
+        description='Convert a csv or vcf matrix to the bit-packed hogtie matrix format (.hbm)'
+        )
+
+    parser.add_argument('input',
+        type=str,
+        help='csv matrix with tips as rows, or vcf (.vcf or .vcf.gz) with samples as tips'
+        )
+
+    parser.add_argument('output',
+        type=str,
+        help='Path of the bit-packed matrix file to write (e.g., matrix.hbm)'
+        )
+
+    parser.add_argument('--chunksize',
+        type=int,
+        default=100000,
+        help='Number of columns converted at a time (default=100000)'
+        )
+
+    return parser.parse_args(argv)
+
+def convert(argv):
+    """
+    Runs the `hogtie convert` subcommand
+    """
+    args = parse_convert_command_line(argv)
+    print(f'Converting {args.input}...')
+    ncolumns = convert_matrix(args.input, args.output, args.chunksize)
+    print(f'Wrote {ncolumns} columns to {args.output}.')
+
 def main():
     """
     Runs Pagel on parsed args
     """
+    if sys.argv[1:2] == ['convert']:
+        convert(sys.argv[2:])
+        return
+
     args = parse_command_line()
+    if args.profile is not None:
+        enable_profiling()
+        set_loglevel("INFO", profile=args.profile)
    
     print('Reading in data and tree...')
     #mydata = args.matrix.read()
-    mytree = args.tree.read()
+    with stage("read_tree"):
+        mytree = compile_tree(args.tree)
+        if args.save_tree:
+            mytree.save(args.save_tree)
    
-    print('Calculating likelihoods...')
-    liketree = MatrixParser(tree=mytree, matrix=args.data, model=args.model)
-    liketree.matrix_likelihoods()
-
-
     HOGTIEDIR = os.path.dirname(os.getcwd())
     path = f"{HOGTIEDIR}/hogtie_output"
     os.makedirs(path, exist_ok=True)
 
-    result = open(f"{HOGTIEDIR}/hogtie_output/result.csv", "w")
+    # streamed and bit-packed matrices are read from the file path, not the open handle
+    matrix = args.data
+    if args.chunksize or is_binary_matrix(args.data.name):
+        args.data.close()
+        matrix = args.data.name
 
-    liketree.likelihoods.to_csv(result)
+    print('Calculating likelihoods...')
+    if args.chunksize:
+        liketree = MatrixParser(tree=mytree, matrix=matrix, model=args.model,
+            workers=args.threads, chunksize=args.chunksize, cache=args.cache,
+            screen=args.screen, table=args.table, backend=args.backend)
+        liketree.stream_likelihoods(f"{HOGTIEDIR}/hogtie_output/result.csv")
+    else:
+        liketree = MatrixParser(tree=mytree, matrix=matrix, model=args.model,
+            workers=args.threads, cache=args.cache, screen=args.screen,
+            table=args.table, backend=args.backend)
+        liketree.matrix_likelihoods()
+        with stage("write_output"):
+            with open(f"{HOGTIEDIR}/hogtie_output/result.csv", "w") as result:
+                liketree.likelihoods.to_csv(result)
+
+    if liketree.cache is not None:
+        stats = liketree.cache.stats()
+        print(f"Likelihood cache: {stats['hits']} hits, {stats['misses']} misses.")
+        liketree.cache.close()
 
     print(f'Wrote log-likelihoods to {HOGTIEDIR}/hogtie_output/result.csv.')
+    if args.profile is not None:
+        log_profile()
 
 if __name__ == "__main__":
     HOGTIEDIR1 = os.path.dirname(os.getcwd())
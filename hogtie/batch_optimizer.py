@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+
+"""
+Fits the binary Markov model separately to every pattern in a matrix
+at once. Each optimizer iteration runs a single vectorized pruning pass
+over all patterns that have not yet converged, instead of running one
+scipy.optimize.minimize loop per pattern.
+"""
+
+import numpy as np
+from loguru import logger
+from hogtie.profiling import count
+from hogtie.jit import resolve_backend
+from hogtie.likelihood import LikelihoodEngine
+from hogtie.transition import transition_matrices, transition_derivatives
+
+
+# fraction of the bracket at which golden section search probes
+GOLDEN = (3. - np.sqrt(5.)) / 2.
+
+# quasi-Newton settings: largest step in log units and number of step
+# halvings in the line search.
+MAXSTEP = 5.
+MAXHALVINGS = 30
+
+# default (min, max) values of the rate parameters
+BOUNDS = (1e-12, 50.)
+
+
+def boundary_optimum(patterns, model, prior, bounds):
+    """
+    Returns a mask of the patterns whose maximum likelihood rates are
+    known in closed form, and their alpha and beta (nan elsewhere, and
+    beta is nan under ER). These are constant (all 0 or all 1) patterns,
+    which are fit best when no change is needed:
+
+    ER: the rate is at its lower bound, provided the prior probability
+    of the observed state at the root is >= 0.5. Otherwise fast rates
+    toward the stationary distribution can fit better, and the pattern
+    is fit numerically.
+
+    ARD: the rate away from the observed state is at its lower bound
+    and the rate toward it at its upper bound. The optimum sits at a
+    corner of the bounds, so these rates and the score (close to 0)
+    reflect the bounds rather than the data. The same holds in the 
+    limit for singleton patterns (one tip differs), whose ARD optimum
+    is a ridge of ever larger rates with a stationary frequency of 
+    1/ntips. No bounded closed form exists for them and they are fit
+    numerically, as are singletons under ER, which are already a one
+    dimensional search.
+    """
+    patterns = np.asarray(patterns)
+    nones = patterns.sum(axis=1)
+    zeros = nones == 0
+    ones = nones == patterns.shape[1]
+    lower, upper = bounds
+    alpha = np.full(patterns.shape[0], np.nan)
+    beta = np.full(patterns.shape[0], np.nan)
+    if model == 'ER':
+        if prior <= 0.5:
+            alpha[zeros] = lower
+        if prior >= 0.5:
+            alpha[ones] = lower
+    else:
+        alpha[zeros], beta[zeros] = lower, upper
+        alpha[ones], beta[ones] = upper, lower
+    return ~np.isnan(alpha), alpha, beta
+
+
+class BatchOptimizer:
+    """
+    Maximum likelihood estimates of alpha (ER) or alpha and beta (ARD)
+    for each tip pattern independently. Under ER alpha is searched on a
+    log scale with a vectorized grid scan refined by golden section
+    search. Under ARD the ER estimate is used as a starting point for
+    vectorized projected quasi-Newton (BFGS) steps on the log rates.
+    Patterns drop out of the active set as soon as they converge.
+    Constant patterns with a closed-form optimum at the bounds (see
+    boundary_optimum()) are not searched.
+
+    Parameters
+    ----------
+    ctree: CompiledTree
+        compiled species tree.
+    patterns: ndarray
+        integer binary data of shape (npatterns, ntips) with tips in
+        node idx order.
+    model: str
+        Either equal rates ('ER') or all rates different ('ARD').
+    prior: float
+        Prior probability that the root state is 1 (default=0.5).
+    bounds: tuple
+        (min, max) values of the rate parameters.
+    xtol: float
+        Width of the log-scale bracket at which a line search stops.
+    ftol: float
+        Relative improvement in -loglik below which an ARD fit is
+        considered converged.
+    gtol: float
+        Projected gradient size below which an ARD fit is considered
+        converged.
+    maxiter: int
+        Maximum number of quasi-Newton iterations under ARD.
+    ngrid: int
+        Number of points of the initial grid scan over each parameter 
+        used to locate the best of several local optima.
+    chunksize: int
+        Number of patterns fit together, which bounds the memory used
+        by the (nnodes, 2, 2, chunksize) transition matrix array.
+    backend: str
+        Backend of the likelihood engine, 'numpy', 'numba' or 'auto'
+        (see hogtie.jit).
+    """
+    def __init__(
+        self,
+        ctree,
+        patterns,
+        model,
+        prior=0.5,
+        bounds=BOUNDS,
+        xtol=1e-5,
+        ftol=1e-9,
+        gtol=1e-6,
+        maxiter=200,
+        ngrid=48,
+        chunksize=10000,
+        backend="numpy",
+        ):
+
+        if model not in ('ER', 'ARD'):
+            raise Exception("model must be specified as either 'ER' or 'ARD'")
+
+        self.ctree = ctree
+        self.patterns = np.asarray(patterns)
+        self.model = model
+        self.prior = prior
+        self.bounds = np.log(bounds)
+        self.xtol = xtol
+        self.ftol = ftol
+        self.gtol = gtol
+        self.maxiter = maxiter
+        self.ngrid = ngrid
+        self.chunksize = chunksize
+        self.backend = resolve_backend(backend)
+
+
+    def fit(self):
+        """
+        Returns a dict of arrays with the fitted 'alpha', 'beta' (nan
+        under ER), 'negLogLik' and 'convergence' of every pattern.
+        """
+        npatterns = self.patterns.shape[0]
+        results = {
+            "alpha": np.empty(npatterns),
+            "beta": np.empty(npatterns),
+            "negLogLik": np.empty(npatterns),
+            "convergence": np.empty(npatterns, dtype=bool),
+        }
+
+        # constant patterns are scored once at their boundary optimum
+        closed, alpha, beta = boundary_optimum(
+            self.patterns, self.model, self.prior, np.exp(self.bounds))
+        if closed.any():
+            count("boundary_fits", int(closed.sum()))
+            engine = LikelihoodEngine(self.ctree, self.patterns[closed], self.backend)
+            pmats = transition_matrices(
+                alpha[closed], np.where(np.isnan(beta), alpha, beta)[closed], self.ctree.dists)
+            results["alpha"][closed] = alpha[closed]
+            results["beta"][closed] = beta[closed]
+            results["negLogLik"][closed] = -engine.log_likelihoods(pmats, self.prior)
+            results["convergence"][closed] = True
+
+        rest = np.flatnonzero(~closed)
+        for start in range(0, rest.size, self.chunksize):
+            idxs = rest[start:start + self.chunksize]
+            chunk = self.fit_chunk(self.patterns[idxs])
+            for key, values in chunk.items():
+                results[key][idxs] = values
+            logger.debug(f"fit patterns {start}-{start + idxs.size} of {rest.size}")
+        return results
+
+
+    def fit_chunk(self, patterns):
+        """
+        Fits every pattern in a (npatterns, ntips) array together.
+        """
+        engine = LikelihoodEngine(self.ctree, patterns, self.backend)
+        npatterns = patterns.shape[0]
+        count("patterns_fit", npatterns)
+        alpha = np.full(npatterns, 1 / self.ctree.height)
+        beta = alpha.copy()
+        converged = np.ones(npatterns, dtype=bool)
+        lower, upper = np.exp(self.bounds)
+
+        # the ER grid scan and golden section search, which is the fit
+        # under ER and the first starting point under ARD
+        idxs = np.arange(npatterns)
+        def evaluate(sub, logx):
+            rate = np.exp(logx)
+            return self.negloglik(engine, patterns, idxs[sub], rate, rate)
+        logx, fun = self.grid_search(
+            evaluate,
+            np.full(npatterns, self.bounds[0]),
+            np.full(npatterns, self.bounds[1]),
+        )
+
+        if self.model == 'ER':
+            alpha[:] = np.exp(logx)
+
+        # ARD is refined by projected quasi-Newton steps on (log alpha,
+        # log beta) from two starts, the ER estimate and the default 
+        # values, keeping the better fit of each pattern.
+        else:
+            owner = np.concatenate([idxs, idxs])
+            starts = np.repeat(np.concatenate([logx, np.log(alpha)])[:, None], 2, axis=1)
+            def evaluate_ard(sub, logx):
+                rates = np.exp(logx)
+                return self.negloglik(engine, patterns, owner[sub], rates[:, 0], rates[:, 1])
+            def gradient_ard(sub, logx):
+                rates = np.exp(logx)
+                return self.negloglik_gradient(engine, patterns, owner[sub], rates[:, 0], rates[:, 1])
+            fun = np.concatenate([fun, evaluate_ard(idxs + npatterns, starts[npatterns:])])
+            logx, fun, converged = self.quasi_newton(evaluate_ard, gradient_ard, starts, fun)
+            best = np.where(fun[:npatterns] <= fun[npatterns:], idxs, npatterns + idxs)
+            alpha, beta = np.exp(logx[best]).T
+            fun = fun[best]
+            converged = converged[best]
+
+        return {
+            "alpha": alpha,
+            "beta": beta if self.model == 'ARD' else np.full(npatterns, np.nan),
+            "negLogLik": fun,
+            "convergence": converged,
+        }
+
+
+    def negloglik(self, engine, patterns, idxs, alpha, beta):
+        """
+        Returns -loglik of the patterns at idxs given one (alpha, beta)
+        pair per pattern.
+        """
+        engine.set_patterns(patterns[idxs])
+        pmats = transition_matrices(alpha, beta, self.ctree.dists)
+        return -engine.log_likelihoods(pmats, self.prior)
+
+
+    def negloglik_gradient(self, engine, patterns, idxs, alpha, beta):
+        """
+        Returns the exact gradient of -loglik of the patterns at idxs
+        with respect to (log alpha, log beta), shape (len(idxs), 2).
+        """
+        engine.set_patterns(patterns[idxs])
+        pmats = transition_matrices(alpha, beta, self.ctree.dists)
+        dpmats = transition_derivatives(alpha, beta, self.ctree.dists)
+        _, grads = engine.log_likelihoods_and_gradients(pmats, dpmats, self.prior)
+        return -(grads * np.stack([alpha, beta])).T
+
+
+    def grid_search(self, evaluate, lbound, ubound):
+        """
+        Evaluates a grid of ngrid points spanning [lbound, ubound] and 
+        refines the two lowest local minima of the grid by golden 
+        section search between their neighbours, so that the global 
+        minimum is found when the objective has more than one local 
+        minimum (and exactly when it lies on a bound). Returns the x
+        values and objectives at the minimum.
+        """
+        steps = np.linspace(0., 1., self.ngrid)
+        grid = lbound[:, None] + (ubound - lbound)[:, None] * steps
+        allsub = np.arange(lbound.size)
+        fgrid = np.column_stack([evaluate(allsub, grid[:, i]) for i in range(self.ngrid)])
+
+        # rank the local minima of the grid of every problem
+        padded = np.pad(fgrid, ((0, 0), (1, 1)), constant_values=np.inf)
+        ismin = (fgrid <= padded[:, :-2]) & (fgrid <= padded[:, 2:])
+        ranked = np.where(ismin, fgrid, np.inf).argsort(axis=1, kind="stable")
+
+        logx = grid[allsub, ranked[:, 0]]
+        fx = fgrid[allsub, ranked[:, 0]]
+        for rank in range(2):
+            best = ranked[:, rank]
+            lower = grid[allsub, np.maximum(best - 1, 0)]
+            upper = grid[allsub, np.minimum(best + 1, self.ngrid - 1)]
+            xrefined, frefined = self.line_search(evaluate, lower, upper)
+
+            # golden section never probes the ends of the bracket
+            better = frefined < fx
+            logx[better] = xrefined[better]
+            fx[better] = frefined[better]
+        return logx, fx
+
+
+    def quasi_newton(self, evaluate, gradient, logx, fun):
+        """
+        Vectorized projected BFGS minimization within the log-scale
+        bounds. evaluate(sub, logx) returns the objective of the problems
+        at positions sub given a (len(sub), nparams) array of log 
+        parameters, and gradient(sub, logx) its gradient. Problems
+        leave the active set once a step no longer improves the
+        objective by more than ftol (relative) or their projected
+        gradient vanishes. Returns the log parameters, the objectives
+        and a convergence mask.
+        """
+        nprobs, nparams = logx.shape
+        lbound, ubound = self.bounds
+        hess = np.tile(np.eye(nparams), (nprobs, 1, 1))
+        grad = gradient(np.arange(nprobs), logx)
+        converged = np.zeros(nprobs, dtype=bool)
+        active = np.arange(nprobs)
+
+        for _ in range(self.maxiter):
+            count("bfgs_iterations", active.size)
+            xcur = logx[active]
+            gcur = grad[active]
+
+            # parameters held at a bound by the gradient are not moved
+            fixed = (
+                ((xcur <= lbound) & (gcur > 0)) | 
+                ((xcur >= ubound) & (gcur < 0))
+            )
+            pgrad = np.where(fixed, 0., gcur)
+            done = np.abs(pgrad).max(axis=1) < self.gtol
+            converged[active[done]] = True
+            active, xcur, gcur, fixed, pgrad = (
+                i[~done] for i in (active, xcur, gcur, fixed, pgrad))
+            if not active.size:
+                break
+
+            # quasi-Newton direction, falling back to steepest descent
+            direction = -np.einsum("nij,nj->ni", hess[active], pgrad)
+            direction[fixed] = 0.
+            uphill = (direction * pgrad).sum(axis=1) >= 0
+            direction[uphill] = -pgrad[uphill]
+            hess[active[uphill]] = np.eye(nparams)
+            direction *= np.minimum(1., MAXSTEP / np.abs(direction).max(axis=1))[:, None]
+
+            # backtracking line search for sufficient decrease
+            fcur = fun[active]
+            step = np.ones(active.size)
+            xnew = xcur.copy()
+            fnew = fcur.copy()
+            search = np.arange(active.size)
+            for _ in range(MAXHALVINGS):
+                trial = np.clip(
+                    xcur[search] + step[search, None] * direction[search],
+                    lbound, ubound)
+                ftrial = evaluate(active[search], trial)
+                decrease = (gcur[search] * (trial - xcur[search])).sum(axis=1)
+                ok = ftrial <= fcur[search] + 1e-4 * decrease
+                xnew[search[ok]] = trial[ok]
+                fnew[search[ok]] = ftrial[ok]
+                search = search[~ok]
+                if not search.size:
+                    break
+                step[search] *= 0.5
+
+            # update the inverse Hessian approximation
+            gnew = gradient(active, xnew)
+            svec = xnew - xcur
+            yvec = gnew - gcur
+            curv = (svec * yvec).sum(axis=1)
+            good = curv > 1e-10
+            if good.any():
+                hess[active[good]] = bfgs_update(hess[active[good]], svec[good], yvec[good], curv[good])
+
+            logx[active] = xnew
+            grad[active] = gnew
+            fun[active] = fnew
+
+            # drop problems whose objective stopped improving
+            done = (fcur - fnew) <= self.ftol * np.maximum(1., np.abs(fcur))
+            converged[active[done]] = True
+            active = active[~done]
+            if not active.size:
+                break
+
+        return logx, fun, converged
+
+
+    def line_search(self, evaluate, lower, upper):
+        """
+        Vectorized golden section search. evaluate(sub, x) returns the
+        objective of the problems at positions sub given one x value per
+        problem; lower and upper are the initial brackets of every
+        problem. Returns the x values and objectives at the minimum.
+        """
+        lower = lower.copy()
+        upper = upper.copy()
+        left = lower + GOLDEN * (upper - lower)
+        right = upper - GOLDEN * (upper - lower)
+        active = np.arange(lower.size)
+        fleft = evaluate(active, left)
+        fright = evaluate(active, right)
+
+        while True:
+            active = active[(upper[active] - lower[active]) > self.xtol]
+            if not active.size:
+                break
+            count("golden_iterations", active.size)
+
+            # shrink the bracket towards the lower of the two probes
+            down = fleft[active] < fright[active]
+            sub0 = active[down]
+            upper[sub0] = right[sub0]
+            right[sub0] = left[sub0]
+            fright[sub0] = fleft[sub0]
+            left[sub0] = lower[sub0] + GOLDEN * (upper[sub0] - lower[sub0])
+
+            sub1 = active[~down]
+            lower[sub1] = left[sub1]
+            left[sub1] = right[sub1]
+            fleft[sub1] = fright[sub1]
+            right[sub1] = upper[sub1] - GOLDEN * (upper[sub1] - lower[sub1])
+
+            # one pruning pass for the new probe of every active problem
+            probes = np.where(down, left[active], right[active])
+            fprobe = evaluate(active, probes)
+            fleft[sub0] = fprobe[down]
+            fright[sub1] = fprobe[~down]
+
+        best = fleft < fright
+        return np.where(best, left, right), np.where(best, fleft, fright)
+
+
+def bfgs_update(hess, svec, yvec, curv):
+    """
+    BFGS update of a stack of (nparams, nparams) inverse Hessian
+    approximations given the steps, gradient changes and s.y products.
+    """
+    nparams = svec.shape[1]
+    rho = 1. / curv
+    left = np.eye(nparams) - rho[:, None, None] * np.einsum("ni,nj->nij", svec, yvec)
+    right = np.eye(nparams) - rho[:, None, None] * np.einsum("ni,nj->nij", yvec, svec)
+    return (
+        np.einsum("nij,njk,nkl->nil", left, hess, right) + 
+        rho[:, None, None] * np.einsum("ni,nj->nij", svec, svec)
+    )
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+"""
+Bit-packed on-disk format for presence/absence matrices. The tip
+states of each column are packed into ceil(ntips / 8) bytes, so a
+matrix takes one bit per cell instead of a csv character or an int64,
+and is memory-mapped on reading so that slicing columns does not
+parse or copy the file.
+
+Layout of a .hbm file (little-endian):
+
+    header      magic, version, ntips, ncolumns, idwidth,
+                data offset, ids offset
+    tip names   json list
+    data        (ncolumns, ceil(ntips / 8)) uint8, np.packbits of
+                each column
+    column ids  (ncolumns,) fixed width byte strings
+"""
+
+import gzip
+import json
+import struct
+import tempfile
+import numpy as np
+import pandas as pd
+from hogtie.matrix_reader import ColumnBlockReader
+
+
+MAGIC = b"HOGTIEBM"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQQQ")
+ALIGN = 64
+
+
+def is_binary_matrix(path):
+    """
+    Returns True if path is a file starting with the .hbm magic bytes.
+    """
+    if not isinstance(path, str):
+        return False
+    try:
+        with open(path, "rb") as infile:
+            return infile.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class BinaryMatrix:
+    """
+    Memory-mapped view of a bit-packed matrix file.
+
+    Parameters
+    ----------
+    path: str
+        path to a file written by write_binary_matrix().
+    chunksize: int
+        number of columns in each block yielded when iterating.
+
+    Attributes
+    ----------
+    tip_names: list
+        name of the tip of each row.
+    packed: numpy.memmap
+        (ncolumns, ceil(ntips / 8)) bit-packed tip states of each
+        column, which are also the pattern keys used by PatternIndex.
+    column_ids: numpy.memmap
+        (ncolumns,) column ids as fixed width byte strings.
+    """
+    def __init__(self, path, chunksize=100000):
+        self.path = path
+        self.chunksize = int(chunksize)
+        with open(path, "rb") as infile:
+            header = infile.read(HEADER.size)
+            magic, version, ntips, ncolumns, idwidth, data_offset, ids_offset = (
+                HEADER.unpack(header))
+            if magic != MAGIC:
+                raise Exception(f'{path} is not a hogtie binary matrix')
+            if version != VERSION:
+                raise Exception(f'unsupported binary matrix version {version}')
+            self.tip_names = json.loads(
+                infile.read(data_offset - HEADER.size).rstrip(b"\0"))
+        if not ncolumns:
+            raise Exception(f'{path} has no columns')
+
+        self.packed = np.memmap(
+            path, dtype=np.uint8, mode="r", offset=data_offset,
+            shape=(ncolumns, -(-ntips // 8)),
+        )
+        self.column_ids = np.memmap(
+            path, dtype=f"S{idwidth}", mode="r", offset=ids_offset,
+            shape=(ncolumns,),
+        )
+
+
+    @property
+    def ntips(self):
+        "number of rows (tips) in the matrix"
+        return len(self.tip_names)
+
+    @property
+    def ncolumns(self):
+        "number of columns in the matrix"
+        return self.packed.shape[0]
+
+
+    def columns(self, start, stop):
+        """
+        Returns the (ntips, ncolumns) uint8 states of columns in
+        [start, stop).
+        """
+        return np.unpackbits(
+            self.packed[start:stop], axis=1, count=self.ntips).T
+
+
+    def __iter__(self):
+        """
+        Yields (column_ids, block) with a list of the column ids and a
+        (ntips, ncolumns) uint8 array for each block of columns, like
+        ColumnBlockReader.
+        """
+        for start in range(0, self.ncolumns, self.chunksize):
+            stop = min(start + self.chunksize, self.ncolumns)
+            column_ids = [i.decode() for i in self.column_ids[start:stop]]
+            yield column_ids, self.columns(start, stop)
+
+
+    def to_dataframe(self):
+        """
+        Returns the whole matrix as a DataFrame with tips as rows.
+        """
+        return pd.DataFrame(
+            self.columns(0, self.ncolumns),
+            index=self.tip_names,
+            columns=[i.decode() for i in self.column_ids],
+        )
+
+
+
+def write_binary_matrix(path, blocks, tip_names):
+    """
+    Writes a bit-packed matrix file from an iterable of (column_ids,
+    block) pairs with (ntips, ncolumns) binary blocks, such as a
+    ColumnBlockReader, without holding more than one block in memory.
+    Returns the number of columns written.
+    """
+    tip_names = [str(i) for i in tip_names]
+    names = json.dumps(tip_names).encode()
+    data_offset = -(-(HEADER.size + len(names)) // ALIGN) * ALIGN
+    ncolumns = 0
+    idwidth = 1
+
+    with open(path, "wb") as out, tempfile.TemporaryFile() as idfile:
+        out.write(HEADER.pack(MAGIC, VERSION, len(tip_names), 0, 0, data_offset, 0))
+        out.write(names.ljust(data_offset - HEADER.size, b"\0"))
+
+        for column_ids, block in blocks:
+            block = np.asarray(block)
+            if block.shape[0] != len(tip_names):
+                raise Exception('block row number must equal the number of tip names')
+            out.write(np.packbits(block.T.astype(bool), axis=1).tobytes())
+            for cid in column_ids:
+                cid = str(cid).encode()
+                idwidth = max(idwidth, len(cid))
+                idfile.write(cid + b"\n")
+            ncolumns += len(column_ids)
+
+        # ids are padded to the widest id once all have been seen
+        ids_offset = out.tell()
+        idfile.seek(0)
+        for line in idfile:
+            out.write(line.rstrip(b"\n").ljust(idwidth, b"\0"))
+
+        out.seek(0)
+        out.write(HEADER.pack(
+            MAGIC, VERSION, len(tip_names), ncolumns, idwidth,
+            data_offset, ids_offset))
+    return ncolumns
+
+
+
+def convert_csv(inpath, outpath, chunksize=100000):
+    """
+    Converts a csv matrix with tips as rows into a bit-packed matrix
+    file, streaming it in blocks of chunksize columns.
+    """
+    reader = ColumnBlockReader(inpath, chunksize)
+    return write_binary_matrix(outpath, reader, reader.tip_names)
+
+
+
+def convert_dataframe(matrix, outpath, chunksize=100000):
+    """
+    Writes a DataFrame with tips as rows to a bit-packed matrix file.
+    """
+    values = matrix.to_numpy()
+    blocks = (
+        (matrix.columns[start:start + chunksize], values[:, start:start + chunksize])
+        for start in range(0, values.shape[1], chunksize)
+    )
+    return write_binary_matrix(outpath, blocks, matrix.index)
+
+
+
+def read_vcf_blocks(inpath, chunksize=100000):
+    """
+    Returns the sample names of a (optionally gzipped) vcf and a
+    generator of (column_ids, block) pairs with one column per variant.
+    A sample is coded 1 if any allele of its genotype is not the
+    reference (or missing) allele, and 0 otherwise. Column ids are the
+    variant ID, or CHROM:POS if it has none.
+    """
+    opener = gzip.open if inpath.endswith(".gz") else open
+    infile = opener(inpath, "rt")
+    for line in infile:
+        if line.startswith("#CHROM"):
+            samples = line.rstrip("\n").split("\t")[9:]
+            break
+    else:
+        infile.close()
+        raise Exception(f'{inpath} has no #CHROM header line')
+
+    def blocks():
+        with infile:
+            column_ids = []
+            states = []
+            for line in infile:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 10:
+                    continue
+                vid = fields[2] if fields[2] != "." else f"{fields[0]}:{fields[1]}"
+                column_ids.append(vid)
+                states.append([_vcf_presence(i) for i in fields[9:]])
+                if len(column_ids) == chunksize:
+                    yield column_ids, np.array(states, dtype=np.uint8).T
+                    column_ids = []
+                    states = []
+            if column_ids:
+                yield column_ids, np.array(states, dtype=np.uint8).T
+
+    return samples, blocks()
+
+
+def _vcf_presence(sample):
+    """
+    Returns 1 if a vcf sample field has a non-reference allele.
+    """
+    genotype = sample.split(":", 1)[0].replace("|", "/")
+    return int(any(i not in ("0", ".") for i in genotype.split("/")))
+
+
+
+def convert_vcf(inpath, outpath, chunksize=100000):
+    """
+    Converts a vcf into a bit-packed matrix file with samples as tips
+    and variants as columns.
+    """
+    samples, blocks = read_vcf_blocks(inpath, chunksize)
+    return write_binary_matrix(outpath, blocks, samples)
+
+
+
+def convert_matrix(inpath, outpath, chunksize=100000):
+    """
+    Converts a csv or vcf (by file extension) matrix file into a
+    bit-packed matrix file. Returns the number of columns written.
+    """
+    if inpath.endswith((".vcf", ".vcf.gz")):
+        return convert_vcf(inpath, outpath, chunksize)
+    return convert_csv(inpath, outpath, chunksize)
+
+
+
+if __name__ == "__main__":
+    import os
+    HOGTIEDIR = os.path.dirname(os.getcwd())
+    file1 = os.path.join(HOGTIEDIR, "sampledata", "testmatrix.csv")
+    outfile = os.path.join(tempfile.gettempdir(), "testmatrix.hbm")
+    convert_matrix(file1, outfile)
+    bmat = BinaryMatrix(outfile)
+    print(bmat.ntips, bmat.ncolumns, os.path.getsize(outfile), os.path.getsize(file1))
+    print(bmat.to_dataframe())
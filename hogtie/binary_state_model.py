@@ -7,9 +7,11 @@ reconstruction.
 
 import numpy as np
 import toytree
-from scipy.optimize import minimize
-from scipy.linalg import expm
 from loguru import logger
+from hogtie.batch_optimizer import boundary_optimum
+from hogtie.compiled_tree import compile_tree
+from hogtie.likelihood import LikelihoodEngine
+from hogtie.transition import TransitionCache
 
 
 
@@ -31,7 +33,7 @@ class BinaryStateModel:
 
     Parameters
     ----------
-    tree: newick string or toytree object
+    tree: newick string, toytree object or CompiledTree
         species tree to be used. ntips = number of rows in data matrix
     data: ndarray
         array of integer binary data in order of node indices (0-ntips).
@@ -48,14 +50,25 @@ class BinaryStateModel:
         self.model = model
         self.prior_root_is_1 = prior
 
+        # array representation of the tree used by the pruning pass
+        self.ctree = compile_tree(tree)
+        self.engine = None
+
         # model parameters to be estimated (in ER model only alpha)
         # set to initial values based on the tree height units.
         self.qmat = None
-        self.alpha = 1 / tree.treenode.height
-        self.beta = 1 / tree.treenode.height
+        self.alpha = 1 / self.ctree.height
+        self.beta = 1 / self.ctree.height
         self.log_lik = 0.
 
-        if len(data) != tree.ntips:
+        # marginal probability that each node is in state 1, set by optimize()
+        self.ancestral_states = None
+
+        # transition matrices of every edge, cached by (alpha, beta)
+        self.pmats = None
+        self.pmat_cache = TransitionCache(self.ctree.dists)
+
+        if len(data) != self.ctree.ntips:
             raise Exception('Matrix row number must equal ntips on tree')
 
         # set likelihoods to 1 for data at tips, and None for internal
@@ -82,87 +95,55 @@ class BinaryStateModel:
         else:
            raise Exception("model must be specified as either 'ER' or 'ARD'")
 
+        # transition probabilities over every edge for the current rates
+        self.pmats = self.pmat_cache.get(self.qmat[0, 1], self.qmat[1, 0])
+
 
     def set_initial_likelihoods(self):
         """
-        Sets the observed states at the tips as attributes of the nodes.
+        Sets the observed states at the tips in the likelihood engine
+        buffer as [1, 0] (state 0) or [0, 1] (state 1).
         """
-        # get values as lists of [0, 1] or [1, 0]
-        values = ([float(1 - i), float(i)] for i in self.data)
-
-        # get range of tip idxs (0-ntips)
-        keys = range(0, len(self.data))
+        self.engine = LikelihoodEngine(self.ctree, np.asarray(self.data)[None, :])
+        logger.debug(f"set tips values: {np.asarray(self.data)}")
 
-        # map values to tips {0:x, 1:y, 2:z...}
-        valuesdict = dict(zip(keys, values))
 
-        # set as .likelihood attributes on tip nodes.
-        self.tree = self.tree.set_node_values(
-            feature="likelihood", 
-            values=valuesdict,
-            default=None,
-        )
-
-        logger.debug(f"set tips values: {valuesdict}")
-
-
-    def node_conditional_likelihood(self, node):
+    def pruning_algorithm(self):
         """
-        Returns the conditional likelihood at a single node given the
-        likelihood's of data at its child nodes.
+        Traverse tree from tips to root calculating conditional 
+        likelihood at each internal node on the way, and compute final
+        conditional likelihood at root based on priors for root state.
         """
-        # get transition probabilities over each branch length
-        prob_child0 = expm(self.qmat * node.children[0].dist)
-        prob_child1 = expm(self.qmat * node.children[1].dist)
-
-        # likelihood that child 0 observation occurs if anc==0
-        child0_is0 = (
-            prob_child0[0, 0] * node.children[0].likelihood[0] + 
-            prob_child0[0, 1] * node.children[0].likelihood[1]
-        )
-        # likelihood that child 1 observation occurs if anc==0
-        child1_is0 = (
-            prob_child1[0, 0] * node.children[1].likelihood[0] + 
-            prob_child1[0, 1] * node.children[1].likelihood[1]
-        )
-        anc_lik_0 = child0_is0 * child1_is0
+        # traverse compiled tree to get conditional likelihood at root.
+        self.set_qmat()
+        loglik = self.engine.log_likelihoods(self.pmats, self.prior_root_is_1)
+        logger.debug(f"alpha={self.alpha:.6f}; beta={self.beta:.6f}; loglik={loglik[0]:.6f}")
+        return np.exp(loglik[0])
 
-        # likelihood that child 0 observation occurs if anc==1
-        child0_is1 = (
-            prob_child0[1, 0] * node.children[0].likelihood[0] + 
-            prob_child0[1, 1] * node.children[0].likelihood[1]
-        )
-        child1_is1 = (
-            prob_child1[1, 0] * node.children[1].likelihood[0] + 
-            prob_child1[1, 1] * node.children[1].likelihood[1]
-        )
-        anc_lik_1 = child0_is1 * child1_is1
 
-        # set estimated conditional likelihood on this node
-        node.likelihood = [anc_lik_0, anc_lik_1]
+    def get_dpmats(self):
+        """
+        Derivatives of the transition matrices with respect to each
+        estimated parameter: alpha and beta (ARD), or the shared rate
+        alpha = beta (ER).
+        """
+        dalpha, dbeta = self.pmat_cache.get_derivatives(self.qmat[0, 1], self.qmat[1, 0])
+        if self.model == 'ARD':
+            return (dalpha, dbeta)
+        return (dalpha + dbeta,)
 
 
-    def pruning_algorithm(self):
+    def pruning_algorithm_with_gradients(self):
         """
-        Traverse tree from tips to root calculating conditional 
-        likelihood at each internal node on the way, and compute final
-        conditional likelihood at root based on priors for root state.
+        Same as pruning_algorithm() but also returns the gradient of the
+        likelihood with respect to the estimated parameters, computed 
+        exactly by propagating derivatives through the pruning pass.
         """
-        # traverse tree to get conditional likelihood estimate at root.
         self.set_qmat()
-        for node in self.tree.treenode.traverse("postorder"):
-            if not node.is_leaf():               
-                self.node_conditional_likelihood(node)
-                logger.debug(
-                    f"node={node.idx}; likelihood=[{node.likelihood[0]:.6f}, {node.likelihood[1]:.6f}]")                
-
-        # multiply root prior times the conditional likelihood at root
-        root = self.tree.treenode
-        lik = (
-            (1 - self.prior_root_is_1) * root.likelihood[0] + 
-            self.prior_root_is_1 * root.likelihood[1]
-        )
-        return lik
+        loglik, grads = self.engine.log_likelihoods_and_gradients(
+            self.pmats, self.get_dpmats(), self.prior_root_is_1)
+        lik = np.exp(loglik[0])
+        return lik, lik * grads[:, 0]
 
 
     def optimize(self):
@@ -174,13 +155,37 @@ class BinaryStateModel:
         tree heights (e.g., 1) the max should likely be higher. If the 
         estimated parameters is at the max bound we should report a 
         logger.warning(message).
+
+        Constant patterns skip the search and are set directly to their
+        closed-form optimum at the bounds (see 
+        batch_optimizer.boundary_optimum()).
         """  
+        closed, alpha, beta = boundary_optimum(
+            np.asarray(self.data)[None, :], self.model, self.prior_root_is_1, (0, 50))
+        if closed[0]:
+            params = np.array([alpha[0], beta[0]]) if self.model == 'ARD' else alpha
+            fun, _ = optim_func(params, self)
+            result = {
+                "alpha": alpha[0],
+                "Lik": fun,
+                "negLogLik": -np.log(-fun),
+                "convergence": True,
+            }
+            if self.model == 'ARD':
+                result["beta"] = beta[0]
+            logger.debug(result)
+            self._set_fit(result)
+            return
+
+        # scipy is only loaded once a model is actually optimized
+        from scipy.optimize import minimize
         if self.model == 'ARD':
             estimate = minimize(
                 fun=optim_func,
                 x0=np.array([self.alpha, self.beta]),
                 args=(self,),
                 method='L-BFGS-B',
+                jac=True,
                 bounds=((0, 50), (0, 50)),
             )
             # logger.info(estimate)
@@ -201,6 +206,7 @@ class BinaryStateModel:
                 x0=np.array([self.alpha]),
                 args=(self,),
                 method='L-BFGS-B',
+                jac=True,
                 bounds=[(0, 50)],
             )
 
@@ -215,21 +221,36 @@ class BinaryStateModel:
         else:
             raise Exception('model must be specified as either ARD or ER')
 
-        # get scaled likelihood values
+        # refill the buffer at the estimated parameters
+        optim_func(estimate.x, self)
+        self._set_fit(result)
+
+
+    def _set_fit(self, result):
+        """
+        Stores the fit and the ancestral states at the parameters the
+        buffer was last filled with.
+        """
+        # marginal posterior probabilities of each state at every node
         self.log_lik = result["negLogLik"]
-        self.tree = self.tree.set_node_values(
-            'likelihood',
-            values={
-                node.idx: np.array(node.likelihood) / sum(node.likelihood)
-                for node in self.tree.idx_dict.values()
-            }
-        )
+        self.ancestral_states = self.engine.marginal_states(
+            self.pmats, self.prior_root_is_1)[:, 0]
+        if isinstance(self.tree, toytree.tree):
+            self.tree = self.tree.set_node_values(
+                'likelihood',
+                values={
+                    idx: np.array([1. - prob, prob])
+                    for idx, prob in enumerate(self.ancestral_states)
+                }
+            )
 
 
     def draw_states(self):
         """
         Draw tree with nodes colored by state
         """
+        if not isinstance(self.tree, toytree.tree):
+            raise Exception('draw_states requires a toytree object as tree')
         drawing = self.tree.draw(
             width=400,
             height=300,
@@ -250,17 +271,18 @@ def optim_func(params, model):
     """
     Function to optimize. Takes an iterable as the first argument 
     containing the parameters to be estimated (alpha, beta), and the
-    BinaryStateModel class instance as the second argument.
+    BinaryStateModel class instance as the second argument. Returns
+    the negative likelihood and its gradient.
     """
     if model.model == 'ARD':
         model.alpha, model.beta = params
-        lik = model.pruning_algorithm()
+        lik, grad = model.pruning_algorithm_with_gradients()
 
     else:
         model.alpha = params[0]
-        lik = model.pruning_algorithm()
+        lik, grad = model.pruning_algorithm_with_gradients()
     
-    return -lik
+    return -lik, -grad
 
 
 if __name__ == "__main__":
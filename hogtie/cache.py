@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""
+Persistent cache of fitted model parameters and likelihoods. Fits
+are stored in a SQLite database keyed by the tree, model, root prior
+and bit-packed pattern, so that patterns seen in earlier runs on the
+same tree do not have to be refit.
+"""
+
+import sqlite3
+import numpy as np
+from loguru import logger
+from hogtie.profiling import count
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fits (
+    tree TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prior REAL NOT NULL,
+    pattern BLOB NOT NULL,
+    alpha REAL,
+    beta REAL,
+    negloglik REAL,
+    convergence INTEGER,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (tree, model, prior, pattern)
+);
+CREATE INDEX IF NOT EXISTS fits_used ON fits (used);
+"""
+
+
+class LikelihoodCache:
+    """
+    SQLite store of fits keyed by (tree, model, prior, pattern). When
+    the number of entries exceeds maxsize the least recently used are
+    evicted.
+
+    Parameters
+    ----------
+    path: str
+        path to the database file, created if it does not exist.
+    maxsize: int
+        maximum number of fits to keep.
+
+    Attributes
+    ----------
+    hits: int
+        number of patterns found in the cache by lookup().
+    misses: int
+        number of patterns not found in the cache by lookup().
+    """
+    def __init__(self, path, maxsize=10000000):
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+        # recency stamp, increased once per lookup or store
+        self.clock = self.conn.execute(
+            "SELECT COALESCE(MAX(used), 0) FROM fits").fetchone()[0]
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+
+
+    def close(self):
+        "Closes the database connection."
+        self.conn.close()
+
+
+    def stats(self):
+        """
+        Returns a dict with the hit and miss counts, the hit rate and
+        the number of stored fits.
+        """
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.,
+            "size": len(self),
+            "maxsize": self.maxsize,
+        }
+
+
+    def lookup(self, tree, model, prior, keys):
+        """
+        Looks up the fits of a sequence of pattern keys (bytes).
+        Returns a boolean array marking the keys that were found, and a
+        dict of alpha, beta, negLogLik and convergence arrays with the
+        cached values of the found keys (nan or False elsewhere).
+        """
+        nkeys = len(keys)
+        fits = {
+            "alpha": np.full(nkeys, np.nan),
+            "beta": np.full(nkeys, np.nan),
+            "negLogLik": np.full(nkeys, np.nan),
+            "convergence": np.zeros(nkeys, dtype=bool),
+        }
+        found = np.zeros(nkeys, dtype=bool)
+        self.clock += 1
+
+        with self.conn:
+            self.conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS lookup "
+                "(pos INTEGER PRIMARY KEY, pattern BLOB)")
+            self.conn.execute("DELETE FROM lookup")
+            self.conn.executemany(
+                "INSERT INTO lookup VALUES (?, ?)",
+                ((pos, bytes(key)) for pos, key in enumerate(keys)),
+            )
+            rows = self.conn.execute(
+                "SELECT lookup.pos, alpha, beta, negloglik, convergence "
+                "FROM lookup JOIN fits ON fits.pattern = lookup.pattern "
+                "WHERE fits.tree = ? AND fits.model = ? AND fits.prior = ?",
+                (tree, model, float(prior)),
+            ).fetchall()
+            self.conn.execute(
+                "UPDATE fits SET used = ? WHERE tree = ? AND model = ? "
+                "AND prior = ? AND pattern IN (SELECT pattern FROM lookup)",
+                (self.clock, tree, model, float(prior)),
+            )
+
+        if rows:
+            pos, alpha, beta, negloglik, convergence = (
+                np.array(i) for i in zip(*rows))
+            found[pos] = True
+            fits["alpha"][pos] = np.array(alpha, dtype=float)
+            fits["beta"][pos] = np.array(beta, dtype=float)
+            fits["negLogLik"][pos] = negloglik
+            fits["convergence"][pos] = convergence.astype(bool)
+
+        self.hits += int(found.sum())
+        self.misses += nkeys - int(found.sum())
+        count("likelihood_cache_hits", int(found.sum()))
+        count("likelihood_cache_misses", nkeys - int(found.sum()))
+        return found, fits
+
+
+    def store(self, tree, model, prior, keys, fits):
+        """
+        Stores the fits of a sequence of pattern keys (bytes), given a
+        dict of alpha, beta, negLogLik and convergence arrays, and
+        evicts the least recently used fits beyond maxsize.
+        """
+        self.clock += 1
+        rows = (
+            (tree, model, float(prior), bytes(key),
+             _nullable(alpha), _nullable(beta), float(negloglik),
+             int(convergence), self.clock)
+            for key, alpha, beta, negloglik, convergence in zip(
+                keys, fits["alpha"], fits["beta"], fits["negLogLik"],
+                fits["convergence"])
+        )
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows)
+        self.evict()
+
+
+    def evict(self):
+        """
+        Deletes the least recently used fits beyond maxsize.
+        """
+        excess = len(self) - self.maxsize
+        if excess > 0:
+            with self.conn:
+                self.conn.execute(
+                    "DELETE FROM fits WHERE rowid IN "
+                    "(SELECT rowid FROM fits ORDER BY used LIMIT ?)",
+                    (excess,))
+            logger.debug(f"evicted {excess} fits from likelihood cache")
+
+
+    def clear(self):
+        """
+        Deletes all stored fits and resets the statistics.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM fits")
+        self.hits = 0
+        self.misses = 0
+
+
+def _nullable(value):
+    "Returns None for nan so it is stored as NULL"
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+def open_cache(cache):
+    """
+    Returns a LikelihoodCache from a LikelihoodCache, a database path,
+    or None.
+    """
+    if cache is None or isinstance(cache, LikelihoodCache):
+        return cache
+    return LikelihoodCache(cache)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+"""
+Array-backed representation of a bifurcating tree for the pruning
+algorithm. The tree is parsed (from newick or a toytree object) once
+into index arrays that can be saved to and loaded from disk.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+
+class CompiledTree:
+    """
+    Flat array representation of a rooted bifurcating tree. Node indices
+    follow toytree: tips are 0-(ntips-1) in tip label order and internal
+    nodes are numbered ntips-(nnodes-1).
+
+    Parameters
+    ----------
+    tree: newick string or toytree object
+        species tree to be compiled. Must be bifurcating.
+
+    Attributes
+    ----------
+    tip_names: ndarray
+        Tip labels in node idx order.
+    dists: ndarray
+        Branch length above every node, shape (nnodes,).
+    parents: ndarray
+        Parent idx of every node, shape (nnodes,); -1 at the root.
+    children: ndarray
+        Child idx pairs of every node, shape (nnodes, 2); -1 at tips.
+    postorder: ndarray
+        Internal node idxs in postorder (children before parents), the
+        order in which conditional likelihoods are computed.
+    """
+    def __init__(self, tree=None):
+
+        self.tip_names = None
+        self.dists = None
+        self.parents = None
+        self.children = None
+        self.postorder = None
+        if tree is not None:
+            self.compile(tree)
+
+
+    def compile(self, tree):
+        """
+        Fills the index arrays from a toytree object or newick string.
+        """
+        # imported here so that loading a saved tree does not need toytree
+        import toytree
+        if isinstance(tree, str):
+            tree = toytree.tree(tree, tree_format=0)
+        if not isinstance(tree, toytree.tree):
+            raise Exception('tree must be either a newick string or toytree object')
+
+        nnodes = tree.nnodes
+        self.tip_names = np.array(tree.get_tip_labels())
+        self.dists = np.zeros(nnodes, dtype=float)
+        self.parents = np.full(nnodes, -1, dtype=np.int64)
+        self.children = np.full((nnodes, 2), -1, dtype=np.int64)
+
+        postorder = []
+        for node in tree.treenode.traverse("postorder"):
+            self.dists[node.idx] = node.dist
+            if node.is_leaf():
+                continue
+            if len(node.children) != 2:
+                raise Exception(
+                    f"tree must be bifurcating (node {node.idx} has "
+                    f"{len(node.children)} children)")
+            for cidx, child in enumerate(node.children):
+                self.children[node.idx, cidx] = child.idx
+                self.parents[child.idx] = node.idx
+            postorder.append(node.idx)
+        self.postorder = np.array(postorder, dtype=np.int64)
+
+        # the root edge carries no transition
+        self.dists[self.root] = 0.
+
+
+    @property
+    def ntips(self):
+        "number of tips in the tree"
+        return self.tip_names.size
+
+    @property
+    def nnodes(self):
+        "number of nodes (tips and internal) in the tree"
+        return self.dists.size
+
+    @property
+    def root(self):
+        "idx of the root node"
+        return int(self.postorder[-1])
+
+    @property
+    def height(self):
+        "maximum root to tip distance"
+        depths = np.zeros(self.nnodes)
+        for node in self.postorder[::-1]:
+            depths[self.children[node]] = depths[node] + self.dists[self.children[node]]
+        return float(depths[:self.ntips].max())
+
+
+    def allocate(self, npatterns):
+        """
+        Returns an empty (nnodes, npatterns, 2) buffer to hold the
+        conditional likelihoods of every node for npatterns patterns.
+        """
+        return np.empty((self.nnodes, npatterns, 2), dtype=float)
+
+
+    def digest(self):
+        """
+        Returns a hex hash of the tip labels, topology and branch
+        lengths, which identifies the tree in persistent caches.
+        """
+        sha = hashlib.sha1()
+        sha.update("\0".join(str(i) for i in self.tip_names).encode())
+        for arr in (self.dists, self.parents, self.children):
+            sha.update(np.ascontiguousarray(arr, dtype=float).tobytes())
+        return sha.hexdigest()
+
+
+    def copy(self):
+        """
+        Returns a CompiledTree with copies of the index arrays, which
+        can be edited without changing this one.
+        """
+        ctree = CompiledTree()
+        ctree.tip_names = self.tip_names.copy()
+        ctree.dists = self.dists.copy()
+        ctree.parents = self.parents.copy()
+        ctree.children = self.children.copy()
+        ctree.postorder = self.postorder.copy()
+        return ctree
+
+
+    def path_to_root(self, node):
+        """
+        Returns the idxs of node and all of its ancestors up to the root.
+        """
+        path = []
+        while node != -1:
+            path.append(node)
+            node = self.parents[node]
+        return np.array(path, dtype=np.int64)
+
+
+    def regraft(self, node, target, dist=None):
+        """
+        Moves the subtree below node onto the edge above target in
+        place (a subtree prune and regraft). The parent of node is
+        removed from its edge, which is merged with the edge of node's
+        sibling, and reinserted at dist above target (default half of 
+        target's edge). Node idxs are kept. Returns the idxs of the
+        nodes whose edge lengths changed.
+        """
+        parent = self.parents[node]
+        if parent == -1:
+            raise Exception('cannot regraft the root')
+        if target == self.root or target == parent:
+            raise Exception('target must be a non-root node other than the parent of node')
+        if node in self.path_to_root(target):
+            raise Exception('target must not be in the subtree of node')
+
+        # detach parent: the sibling takes its place
+        sibling = self.children[parent][self.children[parent] != node][0]
+        grandparent = self.parents[parent]
+        if grandparent == -1 and target == sibling:
+            raise Exception('target must not become the root')
+
+        # the edge of the sibling is merged with the edge of the parent
+        length = self.dists[target]
+        if target == sibling:
+            length += self.dists[parent]
+        dist = length / 2. if dist is None else dist
+        if not 0 <= dist <= length:
+            raise Exception('dist must be between 0 and the edge length of target')
+
+        self.parents[sibling] = grandparent
+        if grandparent == -1:
+            self.dists[sibling] = 0.
+        else:
+            self.children[grandparent][self.children[grandparent] == parent] = sibling
+            self.dists[sibling] += self.dists[parent]
+
+        # insert parent on the edge above target
+        above = self.parents[target]
+        self.children[above][self.children[above] == target] = parent
+        self.parents[parent] = above
+        self.dists[parent] = length - dist
+        self.children[parent] = (node, target)
+        self.parents[target] = parent
+        self.dists[target] = dist
+
+        root = sibling if grandparent == -1 else self.root
+        self.postorder = self._postorder(root)
+        return np.array([sibling, parent, target], dtype=np.int64)
+
+
+    def _postorder(self, root):
+        """
+        Returns the internal node idxs below root in postorder.
+        """
+        postorder = []
+        stack = [(root, False)]
+        while stack:
+            node, visited = stack.pop()
+            if node < self.ntips:
+                continue
+            if visited:
+                postorder.append(node)
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in self.children[node][::-1])
+        return np.array(postorder, dtype=np.int64)
+
+
+    def save(self, path):
+        """
+        Writes the compiled tree to a .npz file that can be reloaded
+        with CompiledTree.load() without parsing newick again.
+        """
+        np.savez(
+            path,
+            tip_names=self.tip_names,
+            dists=self.dists,
+            parents=self.parents,
+            children=self.children,
+            postorder=self.postorder,
+        )
+
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a compiled tree written by CompiledTree.save().
+        """
+        ctree = cls()
+        with np.load(path) as arrs:
+            ctree.tip_names = arrs["tip_names"]
+            ctree.dists = arrs["dists"]
+            ctree.parents = arrs["parents"]
+            ctree.children = arrs["children"]
+            ctree.postorder = arrs["postorder"]
+        return ctree
+
+
+def compile_tree(tree):
+    """
+    Returns a CompiledTree from a CompiledTree, a toytree object, a
+    newick string, or a path to a newick file or saved .npz tree.
+    """
+    if isinstance(tree, CompiledTree):
+        return tree
+    if isinstance(tree, str) and os.path.isfile(tree):
+        if tree.endswith(".npz"):
+            return CompiledTree.load(tree)
+        with open(tree, 'r') as infile:
+            tree = infile.read().strip()
+    return CompiledTree(tree)
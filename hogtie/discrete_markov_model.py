@@ -5,11 +5,15 @@ Simpler form of binary_state_model to estimate model params for
 an array of data.
 """
 
+import hashlib
 import numpy as np
-import toytree
-from scipy.optimize import minimize
-from scipy.linalg import expm
 from loguru import logger
+from hogtie.cache import open_cache
+from hogtie.compiled_tree import compile_tree
+from hogtie.jit import resolve_backend
+from hogtie.likelihood import LikelihoodEngine, SubtreeLikelihoodEngine
+from hogtie.patterns import PatternIndex, PatternSymmetry, pack_patterns
+from hogtie.transition import TransitionCache
 
 
 
@@ -17,29 +21,64 @@ class DiscreteMarkovModel:
     """
     Ancestral State Reconstruction for discrete binary state characters
     on a phylogeny. 
+
+    Parameters
+    ----------
+    tree: newick string, toytree object or CompiledTree
+        species tree to be used.
+    data: pandas.DataFrame
+        binary data with one row per site and one column per tip, where
+        column names match the tree tip names.
+    model: str
+        Either equal rates ('ER') or all rates different ('ARD').
+    prior: float
+        Prior probability that the root state is 1 (default=0.5).
+    cache: str or LikelihoodCache
+        Optional persistent likelihood cache. A fit to the same set of
+        site patterns on the same tree is read from the cache instead 
+        of being optimized again.
+    counts: ndarray
+        Optional number of sites with each row of data. If given, the 
+        rows of data are taken to be unique site patterns and are not
+        deduplicated again.
+    backend: str
+        Backend of the likelihood engine: 'numpy', 'numba' (compiled
+        pruning passes) or 'auto' to use numba when it is installed
+        (default='auto').
     """
-    def __init__(self, tree, data, model, prior=0.5):
+    def __init__(self, tree, data, model, prior=0.5, cache=None, counts=None, backend="auto"):
       
         # store user inputs
         self.tree = tree
         self.data = data
         self.model = model
         self.prior_root_is_1 = prior
+        self.cache = open_cache(cache)
+        self.backend = resolve_backend(backend)
+
+        # array representation of the tree used by the pruning pass
+        self.ctree = compile_tree(tree)
+        self.engine = None
 
         # set to initial values based on the tree height units.
         self.qmat = None
-        self.alpha = 1 / tree.treenode.height
-        self.beta = 1 / tree.treenode.height
+        self.alpha = 1 / self.ctree.height
+        self.beta = 1 / self.ctree.height
+
+        # transition matrices of every edge, cached by (alpha, beta)
+        self.pmats = None
+        self.pmat_cache = TransitionCache(self.ctree.dists)
 
-        assert set(data.columns) == set(tree.get_tip_labels()), (
+        assert set(data.columns) == set(self.ctree.tip_names), (
             "data column names must match tree tip names\n"
             f"data: {data.columns}\n"
-            f"tips: {tree.get_tip_labels()}"
+            f"tips: {self.ctree.tip_names}"
         )
 
         # set likelihoods to 1 for data at tips, and None for internal
         self.unique = None
         self.inverse = None
+        self.counts = counts
         self.get_unique_data()
         self.set_node_arrays_to_tree()
         self.set_qmat()
@@ -69,74 +108,65 @@ class DiscreteMarkovModel:
         else:
             raise Exception("model must be specified as either 'ER' or 'ARD'")
 
+        # transition probabilities over every edge for the current rates
+        self.pmats = self.pmat_cache.get(self.qmat[0, 1], self.qmat[1, 0])
+
 
     def set_node_arrays_to_tree(self):
         """
-        Set observation states at the tips for all nodes based on the
-        data in self.data using the column labels to align with tip 
-        labels.
+        Set observation states at the tips for all unique patterns in
+        the likelihood engine, using the column labels of self.data to
+        align with tip labels. All patterns share the same rates, so 
+        partials are memoized by subtree pattern.
         """
-        for node in self.tree.idx_dict.values():
-            if node.is_leaf():
-                # get column index from orig data
-                cidx = self.data.columns.tolist().index(node.name)
-                # get column from unique and enter to node as [1, 0]
-                dat = self.unique[:, cidx]
-                stack = np.column_stack([dat, 1 - dat])
-                node.likelihood = stack
-            else:
-                node.likelihood = None
+        cidxs = [self.data.columns.get_loc(name) for name in self.ctree.tip_names]
+        self.engine = SubtreeLikelihoodEngine(self.ctree, self.unique[:, cidxs], self.backend)
 
 
     def get_unique_data(self):
         """
         Gets matrix that contains only columns with unique pattern of 
-        1's and 0's
+        1's and 0's. Patterns related by a symmetry of the tree and 
+        model (see PatternSymmetry) share a likelihood, so each is 
+        replaced by its canonical pattern and counted once.
         """
-        # get unique patterns
-        self.unique, self.inverse = np.unique(
-            self.data,
-            return_inverse=True,
-            axis=0,
-        )
+        # rows are already unique patterns with known counts
+        if self.counts is not None:
+            self.unique = np.asarray(self.data)
+            self.inverse = np.arange(self.unique.shape[0])
+            self.counts = np.asarray(self.counts)
+        else:
+            self.unique, self.inverse, self.counts = np.unique(
+                self.data,
+                return_inverse=True,
+                return_counts=True,
+                axis=0,
+            )
+            self.inverse = self.inverse.ravel()
+
+        # merge patterns with the same canonical pattern
+        symmetry = PatternSymmetry(self.ctree, self.model, self.prior_root_is_1)
+        if not symmetry.trivial:
+            cidxs = [self.data.columns.get_loc(name) for name in self.ctree.tip_names]
+            index = PatternIndex(symmetry.canonical(self.unique[:, cidxs]).T)
+            if index.npatterns < self.unique.shape[0]:
+                self.unique = np.empty((index.npatterns, self.unique.shape[1]), dtype=self.unique.dtype)
+                self.unique[:, cidxs] = index.patterns
+                self.counts = np.bincount(index.inverse, weights=self.counts).astype(self.counts.dtype)
+                self.inverse = index.inverse[self.inverse]
         logger.debug(f"uniq array shape: {self.unique.shape}")
 
 
-    def node_conditional_likelihood(self, node):
+    def data_key(self):
         """
-        Returns the conditional likelihood at a single node given the
-        likelihood's of data at its child nodes.
+        Returns a bytes key identifying the multiset of site patterns,
+        with tips in tree order, for the likelihood cache.
         """
-        # get transition probabilities over each branch length
-        prob_child0 = expm(self.qmat * node.children[0].dist)
-        prob_child1 = expm(self.qmat * node.children[1].dist)
-
-        # likelihood that child 0 observation occurs if anc==0
-        child0_is0 = (
-            prob_child0[0, 0] * node.children[0].likelihood[:, 0] + 
-            prob_child0[0, 1] * node.children[0].likelihood[:, 1]
-        )
-
-        # likelihood that child 1 observation occurs if anc==0
-        child1_is0 = (
-            prob_child1[0, 0] * node.children[1].likelihood[:, 0] + 
-            prob_child1[0, 1] * node.children[1].likelihood[:, 1]
-        )
-        anc_lik_0 = child0_is0 * child1_is0
-
-        # likelihood that child 0 observation occurs if anc==1
-        child0_is1 = (
-            prob_child0[1, 0] * node.children[0].likelihood[:, 0] + 
-            prob_child0[1, 1] * node.children[0].likelihood[:, 1]
-        )
-        child1_is1 = (
-            prob_child1[1, 0] * node.children[1].likelihood[:, 0] + 
-            prob_child1[1, 1] * node.children[1].likelihood[:, 1]
-        )
-        anc_lik_1 = child0_is1 * child1_is1
-
-        # set estimated conditional likelihood on this node
-        node.likelihood = np.column_stack([anc_lik_0, anc_lik_1])
+        cidxs = [self.data.columns.get_loc(name) for name in self.ctree.tip_names]
+        sha = hashlib.sha1()
+        sha.update(pack_patterns(self.unique[:, cidxs]).tobytes())
+        sha.update(np.asarray(self.counts, dtype=np.int64).tobytes())
+        return b"sites:" + sha.digest()
 
 
     def pruning_algorithm(self):
@@ -144,20 +174,31 @@ class DiscreteMarkovModel:
         Traverse tree from tips to root calculating conditional 
         likelihood at each internal node on the way, and compute final
         conditional likelihood at root based on priors for root state.
+        Returns the log-likelihood of each unique pattern.
         """
-        # traverse tree in order **from tips to root**
-        # to get conditional likelihood estimate at root.
-        for node in self.tree.treenode.traverse("postorder"):
-            if not node.is_leaf():               
-                self.node_conditional_likelihood(node)
-
-        # multiply root prior times the conditional likelihood at root
-        root = self.tree.treenode
-        lik = (
-            (1. - self.prior_root_is_1) * root.likelihood[:, 0] + 
-            self.prior_root_is_1 * root.likelihood[:, 1]
-        )
-        return lik[self.inverse]
+        return self.engine.log_likelihoods(self.pmats, self.prior_root_is_1)
+
+
+    def get_dpmats(self):
+        """
+        Derivatives of the transition matrices with respect to each
+        estimated parameter: alpha and beta (ARD), or the shared rate
+        alpha = beta (ER).
+        """
+        dalpha, dbeta = self.pmat_cache.get_derivatives(self.qmat[0, 1], self.qmat[1, 0])
+        if self.model == 'ARD':
+            return (dalpha, dbeta)
+        return (dalpha + dbeta,)
+
+
+    def pruning_algorithm_with_gradients(self):
+        """
+        Same as pruning_algorithm() but also returns the gradient of the
+        log-likelihood of each unique pattern with respect to the 
+        estimated parameters, shape (nparams, npatterns).
+        """
+        return self.engine.log_likelihoods_and_gradients(
+            self.pmats, self.get_dpmats(), self.prior_root_is_1)
 
 
     def optimize(self):
@@ -170,12 +211,23 @@ class DiscreteMarkovModel:
         estimated parameters is at the max bound we should report a 
         logger.warning(message).
         """  
+        if self.cache is not None:
+            treekey = self.ctree.digest()
+            key = [self.data_key()]
+            found, fits = self.cache.lookup(treekey, self.model, self.prior_root_is_1, key)
+            if found[0]:
+                self.set_model_fit({i: j[0] for i, j in fits.items()})
+                return
+
+        # scipy is only loaded once a model is actually optimized
+        from scipy.optimize import minimize
         if self.model == 'ARD':
             estimate = minimize(
                 fun=optim_func,
                 x0=np.array([self.alpha, self.beta]),
                 args=(self,),
                 method='L-BFGS-B',
+                jac=True,
                 bounds=((1e-12, 500), (1e-12, 500)),
             )
         elif self.model == 'ER':
@@ -184,43 +236,76 @@ class DiscreteMarkovModel:
                 x0=np.array([self.alpha]),
                 args=(self,),
                 method='L-BFGS-B',
+                jac=True,
                 bounds=[(1e-12, 50)],
             )
 
         # store results
-        self.alpha = estimate.x[0]
-        self.beta = estimate.x[1] if self.model == "ARD" else np.nan
+        self.set_model_fit({
+            "alpha": estimate.x[0],
+            "beta": estimate.x[1] if self.model == "ARD" else np.nan,
+            "negLogLik": estimate.fun,
+            "convergence": estimate.success,
+        })
+        if self.cache is not None:
+            self.cache.store(
+                treekey, self.model, self.prior_root_is_1, key,
+                {i: np.array([j]) for i, j in self.model_fit.items()},
+            )
+
+
+    def set_model_fit(self, fit):
+        """
+        Stores fitted parameters and sets the per-site log-likelihoods
+        with one last pass over the data at the estimated parameters.
+        """
+        self.alpha = fit["alpha"]
+        self.beta = fit["beta"]
         self.model_fit = {
             "alpha": self.alpha,
             "beta": self.beta,
-            "negLogLik": estimate.fun,
-            "convergence": estimate.success,
+            "negLogLik": fit["negLogLik"],
+            "convergence": bool(fit["convergence"]),
         }
+        self.set_qmat()
+        self.log_likelihoods = -self.pruning_algorithm()[self.inverse]
+
 
-        # one last fit to the data using estimate parameters
+    def ancestral_states(self):
+        """
+        Returns the marginal probability that each node is in state 1
+        for each site at the current rates, shape (nnodes, nsites).
+        States are not symmetric like likelihoods, so each distinct 
+        site pattern is reconstructed rather than its canonical pattern.
+        """
         self.set_qmat()
-        self.log_likelihoods = -np.log(self.pruning_algorithm())
+        cidxs = [self.data.columns.get_loc(name) for name in self.ctree.tip_names]
+        index = PatternIndex(np.asarray(self.data)[:, cidxs].T)
+        engine = LikelihoodEngine(self.ctree, index.patterns, self.backend)
+        return index.expand(engine.marginal_states(self.pmats, self.prior_root_is_1).T).T
 
 
 def optim_func(params, model):
     """
     Function to optimize. Takes an iterable as the first argument 
     containing the parameters to be estimated (alpha, beta), and the
-    BinaryStateModel class instance as the second argument.
+    DiscreteMarkovModel class instance as the second argument. Returns
+    the negative log-likelihood summed over sites and its gradient.
     """
     if model.model == 'ARD':
         model.alpha, model.beta = params
     else:
         model.alpha = params[0]        
     model.set_qmat()
-    liks = model.pruning_algorithm()
-    return -np.log(liks).sum()
+    logliks, grads = model.pruning_algorithm_with_gradients()
+    return -(model.counts * logliks).sum(), -(model.counts * grads).sum(axis=1)
 
 
 
 if __name__ == "__main__":
 
     import ipcoal
+    import toytree
     from hogtie.utils import set_loglevel
     set_loglevel("DEBUG")
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""
+Likelihoods of a fixed set of patterns kept up to date while the tree
+or rates are edited. Partials of every node are cached and nodes are
+flagged dirty when an edit changes the data or transition matrices
+below them, so each update recomputes only the paths from the edited
+nodes to the root instead of the whole tree.
+"""
+
+import numpy as np
+from hogtie.compiled_tree import compile_tree
+from hogtie.likelihood import LikelihoodEngine
+from hogtie.transition import transition_matrices
+
+
+class IncrementalLikelihood:
+    """
+    Per-pattern log-likelihoods under edits to branch lengths, topology
+    (subtree prune and regraft) and rates.
+
+    Parameters
+    ----------
+    tree: newick string, toytree object or CompiledTree
+        species tree to be used. It is copied, edits do not change it.
+    patterns: ndarray
+        integer binary data of shape (npatterns, ntips) with tips in
+        node idx order.
+    alpha: float or ndarray
+        Rate of transition from state 0 to state 1, shared or one per
+        pattern.
+    beta: float or ndarray
+        Rate of transition from state 1 to state 0.
+    prior: float
+        Probability that the root state is 1 (default=0.5).
+
+    Attributes
+    ----------
+    ctree: CompiledTree
+        the edited copy of the tree.
+    dirty: ndarray
+        (nnodes,) whether each node's partials are out of date.
+    """
+    def __init__(self, tree, patterns, alpha, beta, prior=0.5):
+        self.ctree = compile_tree(tree).copy()
+        self.engine = LikelihoodEngine(self.ctree, patterns)
+        self.prior = prior
+        self.alpha = None
+        self.beta = None
+        self.pmats = None
+        self.dirty = np.ones(self.ctree.nnodes, dtype=bool)
+        self.set_rates(alpha, beta)
+
+
+    def set_patterns(self, patterns):
+        """
+        Replaces the observed patterns, which invalidates every node.
+        """
+        self.engine.set_patterns(patterns)
+        self.dirty[:] = True
+
+
+    def set_rates(self, alpha, beta):
+        """
+        Sets the transition rates, which changes every edge.
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.pmats = transition_matrices(alpha, beta, self.ctree.dists)
+        self.dirty[:] = True
+
+
+    def set_prior(self, prior):
+        """
+        Sets the prior probability that the root state is 1. Only the
+        final sum at the root depends on it, so no node is invalidated.
+        """
+        self.prior = prior
+
+
+    def set_branch_length(self, node, dist):
+        """
+        Sets the length of the edge above node. Only the ancestors of
+        node need to be recomputed.
+        """
+        if node == self.ctree.root:
+            raise Exception('the root edge carries no transition')
+        self.ctree.dists[node] = dist
+        self._update_edges([node])
+
+
+    def regraft(self, node, target, dist=None):
+        """
+        Moves the subtree below node onto the edge above target (see
+        CompiledTree.regraft()). Only the nodes on the paths from the
+        old and new attachment points to the root are recomputed.
+        """
+        self._update_edges(self.ctree.regraft(node, target, dist))
+
+
+    def _update_edges(self, nodes):
+        """
+        Recomputes the transition matrices of the edges above nodes and
+        marks their ancestors dirty.
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        self.pmats[nodes] = transition_matrices(self.alpha, self.beta, self.ctree.dists[nodes])
+        for node in nodes:
+            self.dirty[self.ctree.path_to_root(self.ctree.parents[node])] = True
+
+
+    def log_likelihoods(self):
+        """
+        Returns the log-likelihood of each pattern, recomputing only
+        the dirty nodes.
+        """
+        postorder = self.ctree.postorder
+        nodes = postorder[self.dirty[postorder]]
+        loglik = self.engine.log_likelihoods(self.pmats, self.prior, nodes)
+        self.dirty[:] = False
+        return loglik
+
+
+
+if __name__ == "__main__":
+    import time
+    import toytree
+    TREE = toytree.rtree.unittree(ntips=500, treeheight=1, seed=123)
+    PATTERNS = np.random.default_rng(123).integers(0, 2, (10000, 500))
+    LIK = IncrementalLikelihood(TREE, PATTERNS, 0.5, 1.0)
+    START = time.time()
+    LIK.log_likelihoods()
+    print(f"full pass: {time.time() - START:.3f}s")
+    START = time.time()
+    LIK.set_branch_length(0, 0.5)
+    LIK.log_likelihoods()
+    print(f"after one branch length edit: {time.time() - START:.3f}s")
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Selection of the backend of the pruning passes. The 'numba' backend
+runs each pass, fused with the combination with the root prior, as
+one compiled loop over nodes and patterns (see hogtie.kernels) that
+writes into the engines' preallocated buffers instead of allocating
+temporaries at every node. numba is only imported when a kernel is
+first used, and the 'auto' backend falls back to NumPy when numba is
+not installed. Run this module to check that both backends agree.
+"""
+
+import importlib.util
+import numpy as np
+from loguru import logger
+
+
+BACKENDS = ("auto", "numpy", "numba")
+
+
+def numba_available():
+    "Returns whether numba can be imported, without importing it."
+    return importlib.util.find_spec("numba") is not None
+
+
+def resolve_backend(backend):
+    """
+    Returns 'numba' or 'numpy' for a requested backend: 'auto' uses
+    numba when it is installed, and 'numba' falls back to NumPy with a
+    warning when it is not.
+    """
+    if backend not in BACKENDS:
+        raise Exception(f"backend must be one of {BACKENDS}")
+    if backend == "numpy":
+        return "numpy"
+    if numba_available():
+        return "numba"
+    if backend == "numba":
+        logger.warning("numba is not installed, using the numpy backend")
+    return "numpy"
+
+
+def kernels():
+    """
+    Returns the module of compiled kernels, importing numba on the
+    first call. Kernels are compiled on their first call and cached on
+    disk by numba.
+    """
+    from hogtie import kernels as module
+    return module
+
+
+def per_pattern(pmats, npatterns):
+    """
+    Returns (nnodes, 2, 2) transition matrices shared by all patterns
+    as a read-only (nnodes, 2, 2, npatterns) view, or per-pattern
+    matrices unchanged.
+    """
+    if pmats.ndim == 3:
+        return np.broadcast_to(pmats[..., None], pmats.shape + (npatterns,))
+    return pmats
+
+
+
+if __name__ == "__main__":
+    # equivalence of the numba and numpy backends, and their timings
+    import time
+    import toytree
+    from hogtie.compiled_tree import compile_tree
+    from hogtie.likelihood import LikelihoodEngine, SubtreeLikelihoodEngine
+    from hogtie.transition import transition_derivatives, transition_matrices
+
+    if not numba_available():
+        raise SystemExit("numba is not installed")
+    TREE = compile_tree(toytree.rtree.unittree(ntips=200, treeheight=1, seed=123))
+    RNG = np.random.default_rng(123)
+    PATTERNS = RNG.integers(0, 2, (20000, TREE.ntips), dtype=np.uint8)
+    ALPHA = RNG.uniform(0.1, 5., PATTERNS.shape[0])
+    BETA = RNG.uniform(0.1, 5., PATTERNS.shape[0])
+    CASES = {
+        "shared": (transition_matrices(0.7, 1.3, TREE.dists), transition_derivatives(0.7, 1.3, TREE.dists)),
+        "per-pattern": (transition_matrices(ALPHA, BETA, TREE.dists), transition_derivatives(ALPHA, BETA, TREE.dists)),
+    }
+    for ENGINE in (LikelihoodEngine, SubtreeLikelihoodEngine):
+        for LABEL, (PMATS, DPMATS) in CASES.items():
+            if ENGINE is SubtreeLikelihoodEngine and LABEL == "per-pattern":
+                continue
+            RESULTS = {}
+            for BACKEND in ("numpy", "numba"):
+                LIK = ENGINE(TREE, PATTERNS, backend=BACKEND)
+                LIK.log_likelihoods(PMATS, 0.5)  # compile
+                START = time.perf_counter()
+                LOGLIK = LIK.log_likelihoods(PMATS, 0.5)
+                ELAPSED = time.perf_counter() - START
+                _, GRADS = LIK.log_likelihoods_and_gradients(PMATS, DPMATS, 0.5)
+                RESULTS[BACKEND] = (LOGLIK, GRADS, ELAPSED)
+            LDIFF = np.abs(RESULTS["numpy"][0] - RESULTS["numba"][0]).max()
+            GDIFF = np.abs(RESULTS["numpy"][1] - RESULTS["numba"][1]).max()
+            assert np.allclose(RESULTS["numpy"][0], RESULTS["numba"][0], rtol=1e-12, atol=1e-10)
+            assert np.allclose(RESULTS["numpy"][1], RESULTS["numba"][1], rtol=1e-9, atol=1e-9)
+            print(
+                f"{ENGINE.__name__} {LABEL}: max loglik diff {LDIFF:.2e}, "
+                f"max gradient diff {GDIFF:.2e}, numpy {RESULTS['numpy'][2]:.3f}s, "
+                f"numba {RESULTS['numba'][2]:.3f}s")
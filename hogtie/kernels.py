@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""
+Compiled pruning kernels of the numba backend (see hogtie.jit). This
+module imports numba and is only imported once a kernel is requested.
+Each kernel runs a whole postorder pass, and the combination with the
+root prior, in one loop over nodes and patterns that writes into the
+engines' preallocated buffers.
+"""
+
+import numba
+import numpy as np
+
+
+jit = numba.njit(cache=True, error_model="numpy")
+
+
+@jit
+def prune(partials, lnscale, children, nodes, pmats):
+    """
+    Postorder pass of LikelihoodEngine.prune() over the given internal
+    nodes, rescaling each node's partials by their maximum.
+    """
+    for node in nodes:
+        child0 = children[node, 0]
+        child1 = children[node, 1]
+        for pat in range(partials.shape[1]):
+            a0 = partials[child0, pat, 0]
+            a1 = partials[child0, pat, 1]
+            b0 = partials[child1, pat, 0]
+            b1 = partials[child1, pat, 1]
+            left0 = pmats[child0, 0, 0, pat] * a0 + pmats[child0, 0, 1, pat] * a1
+            left1 = pmats[child0, 1, 0, pat] * a0 + pmats[child0, 1, 1, pat] * a1
+            right0 = pmats[child1, 0, 0, pat] * b0 + pmats[child1, 0, 1, pat] * b1
+            right1 = pmats[child1, 1, 0, pat] * b0 + pmats[child1, 1, 1, pat] * b1
+            lik0 = left0 * right0
+            lik1 = left1 * right1
+            scale = max(lik0, lik1)
+            if scale == 0.:
+                scale = 1.
+            partials[node, pat, 0] = lik0 / scale
+            partials[node, pat, 1] = lik1 / scale
+            lnscale[node, pat] = lnscale[child0, pat] + lnscale[child1, pat] + np.log(scale)
+
+
+@jit
+def log_likelihoods(partials, lnscale, children, nodes, pmats, root, prior, out):
+    """
+    Runs prune() and writes the log-likelihood of each pattern to out.
+    """
+    prune(partials, lnscale, children, nodes, pmats)
+    for pat in range(partials.shape[1]):
+        lik = (1. - prior) * partials[root, pat, 0] + prior * partials[root, pat, 1]
+        out[pat] = np.log(lik) + lnscale[root, pat]
+
+
+@jit
+def log_likelihoods_and_gradients(partials, dpartials, lnscale, children, nodes, pmats, dpmats, root, prior, out, grads):
+    """
+    Pruning pass of LikelihoodEngine.prune_with_gradients() with the
+    derivatives of the transition matrices stacked as (nparams, nnodes,
+    2, 2, npatterns). Writes the log-likelihoods to out and their
+    gradients to grads.
+    """
+    nparams = dpartials.shape[0]
+    for node in nodes:
+        child0 = children[node, 0]
+        child1 = children[node, 1]
+        for pat in range(partials.shape[1]):
+            a0 = partials[child0, pat, 0]
+            a1 = partials[child0, pat, 1]
+            b0 = partials[child1, pat, 0]
+            b1 = partials[child1, pat, 1]
+            left0 = pmats[child0, 0, 0, pat] * a0 + pmats[child0, 0, 1, pat] * a1
+            left1 = pmats[child0, 1, 0, pat] * a0 + pmats[child0, 1, 1, pat] * a1
+            right0 = pmats[child1, 0, 0, pat] * b0 + pmats[child1, 0, 1, pat] * b1
+            right1 = pmats[child1, 1, 0, pat] * b0 + pmats[child1, 1, 1, pat] * b1
+            lik0 = left0 * right0
+            lik1 = left1 * right1
+            scale = max(lik0, lik1)
+            if scale == 0.:
+                scale = 1.
+            for pidx in range(nparams):
+                dleft0 = (
+                    dpmats[pidx, child0, 0, 0, pat] * a0 + dpmats[pidx, child0, 0, 1, pat] * a1 +
+                    pmats[child0, 0, 0, pat] * dpartials[pidx, child0, pat, 0] +
+                    pmats[child0, 0, 1, pat] * dpartials[pidx, child0, pat, 1]
+                )
+                dleft1 = (
+                    dpmats[pidx, child0, 1, 0, pat] * a0 + dpmats[pidx, child0, 1, 1, pat] * a1 +
+                    pmats[child0, 1, 0, pat] * dpartials[pidx, child0, pat, 0] +
+                    pmats[child0, 1, 1, pat] * dpartials[pidx, child0, pat, 1]
+                )
+                dright0 = (
+                    dpmats[pidx, child1, 0, 0, pat] * b0 + dpmats[pidx, child1, 0, 1, pat] * b1 +
+                    pmats[child1, 0, 0, pat] * dpartials[pidx, child1, pat, 0] +
+                    pmats[child1, 0, 1, pat] * dpartials[pidx, child1, pat, 1]
+                )
+                dright1 = (
+                    dpmats[pidx, child1, 1, 0, pat] * b0 + dpmats[pidx, child1, 1, 1, pat] * b1 +
+                    pmats[child1, 1, 0, pat] * dpartials[pidx, child1, pat, 0] +
+                    pmats[child1, 1, 1, pat] * dpartials[pidx, child1, pat, 1]
+                )
+                dpartials[pidx, node, pat, 0] = (dleft0 * right0 + left0 * dright0) / scale
+                dpartials[pidx, node, pat, 1] = (dleft1 * right1 + left1 * dright1) / scale
+            partials[node, pat, 0] = lik0 / scale
+            partials[node, pat, 1] = lik1 / scale
+            lnscale[node, pat] = lnscale[child0, pat] + lnscale[child1, pat] + np.log(scale)
+
+    for pat in range(partials.shape[1]):
+        lik = (1. - prior) * partials[root, pat, 0] + prior * partials[root, pat, 1]
+        out[pat] = np.log(lik) + lnscale[root, pat]
+        for pidx in range(nparams):
+            dlik = (1. - prior) * dpartials[pidx, root, pat, 0] + prior * dpartials[pidx, root, pat, 1]
+            grads[pidx, pat] = dlik / lik
+
+
+@jit
+def subtree_prune(partials, lnscale, offsets, child_ids, children, nodes, pmats):
+    """
+    Postorder pass of SubtreeLikelihoodEngine.prune() over flat
+    buffers, where the unique sub-patterns of node n are rows
+    offsets[n] to offsets[n + 1] and child_ids holds the sub-pattern
+    ids of each row's two children. pmats are (nnodes, 2, 2).
+    """
+    for node in nodes:
+        child0 = children[node, 0]
+        child1 = children[node, 1]
+        start0 = offsets[child0]
+        start1 = offsets[child1]
+        for row in range(offsets[node], offsets[node + 1]):
+            idx0 = start0 + child_ids[0, row]
+            idx1 = start1 + child_ids[1, row]
+            a0 = partials[idx0, 0]
+            a1 = partials[idx0, 1]
+            b0 = partials[idx1, 0]
+            b1 = partials[idx1, 1]
+            left0 = pmats[child0, 0, 0] * a0 + pmats[child0, 0, 1] * a1
+            left1 = pmats[child0, 1, 0] * a0 + pmats[child0, 1, 1] * a1
+            right0 = pmats[child1, 0, 0] * b0 + pmats[child1, 0, 1] * b1
+            right1 = pmats[child1, 1, 0] * b0 + pmats[child1, 1, 1] * b1
+            lik0 = left0 * right0
+            lik1 = left1 * right1
+            scale = max(lik0, lik1)
+            if scale == 0.:
+                scale = 1.
+            partials[row, 0] = lik0 / scale
+            partials[row, 1] = lik1 / scale
+            lnscale[row] = lnscale[idx0] + lnscale[idx1] + np.log(scale)
+
+
+@jit
+def subtree_log_likelihoods(partials, lnscale, offsets, child_ids, children, nodes, pmats, root, prior, pattern_ids, out):
+    """
+    Runs subtree_prune() and writes the log-likelihood of each pattern
+    to out.
+    """
+    subtree_prune(partials, lnscale, offsets, child_ids, children, nodes, pmats)
+    start = offsets[root]
+    for pat in range(pattern_ids.size):
+        row = start + pattern_ids[pat]
+        lik = (1. - prior) * partials[row, 0] + prior * partials[row, 1]
+        out[pat] = np.log(lik) + lnscale[row]
+
+
+@jit
+def subtree_log_likelihoods_and_gradients(partials, dpartials, lnscale, offsets, child_ids, children, nodes, pmats, dpmats, root, prior, pattern_ids, out, grads):
+    """
+    Pruning pass of SubtreeLikelihoodEngine.prune_with_gradients() over
+    flat buffers (see subtree_prune()) with the derivatives of the
+    transition matrices stacked as (nparams, nnodes, 2, 2). Writes the
+    log-likelihoods to out and their gradients to grads.
+    """
+    nparams = dpartials.shape[0]
+    for node in nodes:
+        child0 = children[node, 0]
+        child1 = children[node, 1]
+        start0 = offsets[child0]
+        start1 = offsets[child1]
+        for row in range(offsets[node], offsets[node + 1]):
+            idx0 = start0 + child_ids[0, row]
+            idx1 = start1 + child_ids[1, row]
+            a0 = partials[idx0, 0]
+            a1 = partials[idx0, 1]
+            b0 = partials[idx1, 0]
+            b1 = partials[idx1, 1]
+            left0 = pmats[child0, 0, 0] * a0 + pmats[child0, 0, 1] * a1
+            left1 = pmats[child0, 1, 0] * a0 + pmats[child0, 1, 1] * a1
+            right0 = pmats[child1, 0, 0] * b0 + pmats[child1, 0, 1] * b1
+            right1 = pmats[child1, 1, 0] * b0 + pmats[child1, 1, 1] * b1
+            lik0 = left0 * right0
+            lik1 = left1 * right1
+            scale = max(lik0, lik1)
+            if scale == 0.:
+                scale = 1.
+            for pidx in range(nparams):
+                dleft0 = (
+                    dpmats[pidx, child0, 0, 0] * a0 + dpmats[pidx, child0, 0, 1] * a1 +
+                    pmats[child0, 0, 0] * dpartials[pidx, idx0, 0] +
+                    pmats[child0, 0, 1] * dpartials[pidx, idx0, 1]
+                )
+                dleft1 = (
+                    dpmats[pidx, child0, 1, 0] * a0 + dpmats[pidx, child0, 1, 1] * a1 +
+                    pmats[child0, 1, 0] * dpartials[pidx, idx0, 0] +
+                    pmats[child0, 1, 1] * dpartials[pidx, idx0, 1]
+                )
+                dright0 = (
+                    dpmats[pidx, child1, 0, 0] * b0 + dpmats[pidx, child1, 0, 1] * b1 +
+                    pmats[child1, 0, 0] * dpartials[pidx, idx1, 0] +
+                    pmats[child1, 0, 1] * dpartials[pidx, idx1, 1]
+                )
+                dright1 = (
+                    dpmats[pidx, child1, 1, 0] * b0 + dpmats[pidx, child1, 1, 1] * b1 +
+                    pmats[child1, 1, 0] * dpartials[pidx, idx1, 0] +
+                    pmats[child1, 1, 1] * dpartials[pidx, idx1, 1]
+                )
+                dpartials[pidx, row, 0] = (dleft0 * right0 + left0 * dright0) / scale
+                dpartials[pidx, row, 1] = (dleft1 * right1 + left1 * dright1) / scale
+            partials[row, 0] = lik0 / scale
+            partials[row, 1] = lik1 / scale
+            lnscale[row] = lnscale[idx0] + lnscale[idx1] + np.log(scale)
+
+    start = offsets[root]
+    for pat in range(pattern_ids.size):
+        row = start + pattern_ids[pat]
+        lik = (1. - prior) * partials[row, 0] + prior * partials[row, 1]
+        out[pat] = np.log(lik) + lnscale[row]
+        for pidx in range(nparams):
+            dlik = (1. - prior) * dpartials[pidx, row, 0] + prior * dpartials[pidx, row, 1]
+            grads[pidx, pat] = dlik / lik
+
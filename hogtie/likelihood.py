@@ -0,0 +1,624 @@
+#!/usr/bin/env python
+
+"""
+Vectorized pruning algorithm over a CompiledTree. Conditional
+likelihoods of every node for a set of tip patterns are stored in a
+single preallocated buffer and rescaled at each node to avoid
+underflow on large trees. A second, preorder pass computes the 
+likelihood of the data outside each subtree, which combined with the
+pruning partials gives marginal ancestral states.
+"""
+
+import numpy as np
+from hogtie.jit import kernels, per_pattern, resolve_backend
+from hogtie.profiling import count
+
+
+class LikelihoodEngine:
+    """
+    Felsenstein's pruning algorithm for binary characters computed for
+    many tip patterns at once on a CompiledTree.
+
+    Parameters
+    ----------
+    ctree: CompiledTree
+        compiled species tree.
+    patterns: ndarray
+        integer binary data of shape (npatterns, ntips) with tips in
+        node idx order.
+    backend: str
+        'numpy', 'numba' (compiled pruning passes, see hogtie.jit) or
+        'auto' to use numba when it is installed (default='numpy').
+
+    Attributes
+    ----------
+    partials: ndarray
+        (nnodes, npatterns, 2) conditional likelihoods of the data below
+        each node given the node is in state 0 or 1, rescaled so that
+        the larger of the two values is 1.
+    lnscale: ndarray
+        (nnodes, npatterns) log of the scaling factors accumulated in
+        the subtree below each node.
+    dpartials: ndarray
+        (nparams, nnodes, npatterns, 2) derivatives of the partials with
+        respect to each model parameter, allocated on the first call to
+        log_likelihoods_and_gradients() and scaled like the partials.
+    upper: ndarray
+        (nnodes, npatterns, 2) likelihoods of the data outside the 
+        subtree of each node jointly with the node being in state 0 or
+        1, allocated on the first call to prune_upward() and rescaled 
+        like the partials.
+    uplnscale: ndarray
+        (nnodes, npatterns) log of the scaling factors of upper.
+    """
+    def __init__(self, ctree, patterns, backend="numpy"):
+        self.ctree = ctree
+        self.backend = resolve_backend(backend)
+        self.partials = None
+        self.lnscale = None
+        self.dpartials = None
+        self.upper = None
+        self.uplnscale = None
+        self.set_patterns(patterns)
+
+
+    @property
+    def npatterns(self):
+        "number of patterns in the buffer"
+        return self.partials.shape[1]
+
+
+    def set_patterns(self, patterns):
+        """
+        Sets the observed states at the tips. The buffers are only
+        reallocated when the number of patterns changes.
+        """
+        patterns = np.asarray(patterns)
+        if patterns.ndim != 2 or patterns.shape[1] != self.ctree.ntips:
+            raise Exception('Matrix row number must equal ntips on tree')
+
+        if self.partials is None or self.partials.shape[1] != patterns.shape[0]:
+            self.partials = self.ctree.allocate(patterns.shape[0])
+            self.lnscale = np.zeros(self.partials.shape[:2])
+            self.dpartials = None
+            self.upper = None
+            self.uplnscale = None
+
+        ntips = self.ctree.ntips
+        self.partials[:ntips, :, 0] = 1 - patterns.T
+        self.partials[:ntips, :, 1] = patterns.T
+        self.lnscale[:ntips] = 0.
+
+
+    def prune(self, pmats, nodes=None):
+        """
+        Traverse tree from tips to root computing the conditional
+        likelihood at each internal node into the partials buffer.
+
+        Parameters
+        ----------
+        pmats: ndarray
+            transition matrices of every edge from transition_matrices(),
+            either (nnodes, 2, 2) shared by all patterns or
+            (nnodes, 2, 2, npatterns) with one set per pattern.
+        nodes: ndarray
+            Optional internal nodes to recompute, in postorder. The 
+            partials of all other nodes are reused from previous passes.
+            Default is every internal node.
+        """
+        nodes = self.ctree.postorder if nodes is None else nodes
+        count("pruning_passes")
+        count("pruned_patterns", self.npatterns)
+        count("pruned_nodes", len(nodes))
+        if self.backend == "numba":
+            kernels().prune(
+                self.partials, self.lnscale, self.ctree.children,
+                np.asarray(nodes, dtype=np.int64), per_pattern(pmats, self.npatterns),
+            )
+            return
+        partials = self.partials
+        lnscale = self.lnscale
+        children = self.ctree.children
+        for node in nodes:
+            child0, child1 = children[node]
+            out = partials[node]
+            np.multiply(
+                propagate(pmats[child0], partials[child0]),
+                propagate(pmats[child1], partials[child1]),
+                out=out,
+            )
+            lnscale[node] = lnscale[child0] + lnscale[child1]
+            rescale(out, lnscale[node])
+
+
+    def log_likelihoods(self, pmats, prior, nodes=None):
+        """
+        Returns the log-likelihood of each pattern given the transition
+        matrices and the prior probability that the root state is 1.
+        Only the given internal nodes are recomputed (see prune()).
+        """
+        if self.backend == "numba":
+            nodes = self.ctree.postorder if nodes is None else nodes
+            count("pruning_passes")
+            count("pruned_patterns", self.npatterns)
+            count("pruned_nodes", len(nodes))
+            loglik = np.empty(self.npatterns)
+            kernels().log_likelihoods(
+                self.partials, self.lnscale, self.ctree.children,
+                np.asarray(nodes, dtype=np.int64), per_pattern(pmats, self.npatterns),
+                self.ctree.root, prior, loglik,
+            )
+            return loglik
+
+        self.prune(pmats, nodes)
+        root = self.ctree.root
+        lik = (
+            (1. - prior) * self.partials[root, :, 0] +
+            prior * self.partials[root, :, 1]
+        )
+        with np.errstate(divide="ignore"):
+            return np.log(lik) + self.lnscale[root]
+
+
+    def prune_upward(self, pmats, prior):
+        """
+        Traverse tree from root to tips computing the likelihood of the
+        data outside each node's subtree into the upper buffer. Uses 
+        the partials of a prune() pass with the same pmats. For child c
+        of node p with sibling s:
+
+            U_c = (U_p * P_s L_s) @ P_c
+        """
+        count("upward_passes")
+        if self.upper is None:
+            self.upper = np.empty_like(self.partials)
+            self.uplnscale = np.zeros_like(self.lnscale)
+
+        upper = self.upper
+        uplnscale = self.uplnscale
+        partials = self.partials
+        lnscale = self.lnscale
+        children = self.ctree.children
+        root = self.ctree.root
+        upper[root, :, 0] = 1. - prior
+        upper[root, :, 1] = prior
+        uplnscale[root] = 0.
+        for node in self.ctree.postorder[::-1]:
+            child0, child1 = children[node]
+            for child, sibling in ((child0, child1), (child1, child0)):
+                above = upper[node] * propagate(pmats[sibling], partials[sibling])
+                out = upper[child]
+                out[:] = propagate_down(pmats[child], above)
+                uplnscale[child] = uplnscale[node] + lnscale[sibling]
+                rescale(out, uplnscale[child])
+
+
+    def marginal_states(self, pmats, prior):
+        """
+        Returns the marginal posterior probability that each node is in
+        state 1 given all of the data in each pattern, shape (nnodes, 
+        npatterns), from one pruning and one preorder pass. Tips are 
+        returned as observed.
+        """
+        self.prune(pmats)
+        self.prune_upward(pmats, prior)
+        joint = self.upper * self.partials
+        with np.errstate(invalid="ignore"):
+            return joint[:, :, 1] / joint.sum(axis=2)
+
+
+    def leave_one_out_deltas(self, pmats, prior):
+        """
+        Returns the change in log-likelihood of each pattern when each
+        tip in turn is treated as missing, at fixed rates, shape 
+        (npatterns, ntips). The likelihood without tip t is the sum 
+        over its states of its upper likelihoods, so all tips are 
+        covered by one pruning and one preorder pass. Deltas are >= 0,
+        and the largest ones point at the tips the pattern fits worst.
+        """
+        loglik = self.log_likelihoods(pmats, prior)
+        self.prune_upward(pmats, prior)
+        ntips = self.ctree.ntips
+        with np.errstate(divide="ignore", invalid="ignore"):
+            without = np.log(self.upper[:ntips].sum(axis=2)) + self.uplnscale[:ntips]
+            return without.T - loglik[:, None]
+
+
+    def prune_with_gradients(self, pmats, dpmats):
+        """
+        Pruning pass that also propagates the derivatives of every 
+        node's conditional likelihoods with respect to each parameter,
+        given the derivatives of the transition matrices (a sequence 
+        with one array shaped like pmats per parameter):
+
+            d(A * B) = (dP0 L0 + P0 dL0) * B + A * (dP1 L1 + P1 dL1)
+        """
+        count("pruning_passes")
+        count("pruned_patterns", self.npatterns)
+        nparams = len(dpmats)
+        if self.dpartials is None or self.dpartials.shape[0] != nparams:
+            self.dpartials = np.zeros((nparams,) + self.partials.shape)
+
+        partials = self.partials
+        dpartials = self.dpartials
+        lnscale = self.lnscale
+        children = self.ctree.children
+        for node in self.ctree.postorder:
+            child0, child1 = children[node]
+            left = propagate(pmats[child0], partials[child0])
+            right = propagate(pmats[child1], partials[child1])
+            for pidx, dpmat in enumerate(dpmats):
+                dleft = (
+                    propagate(dpmat[child0], partials[child0]) + 
+                    propagate(pmats[child0], dpartials[pidx, child0])
+                )
+                dright = (
+                    propagate(dpmat[child1], partials[child1]) + 
+                    propagate(pmats[child1], dpartials[pidx, child1])
+                )
+                dpartials[pidx, node] = dleft * right + left * dright
+
+            out = partials[node]
+            np.multiply(left, right, out=out)
+            lnscale[node] = lnscale[child0] + lnscale[child1]
+            scale = rescale(out, lnscale[node])
+            dpartials[:, node] /= scale[:, None]
+
+
+    def log_likelihoods_and_gradients(self, pmats, dpmats, prior):
+        """
+        Returns the log-likelihood of each pattern and its gradient with
+        respect to each parameter, shape (nparams, npatterns).
+        """
+        if self.backend == "numba":
+            count("pruning_passes")
+            count("pruned_patterns", self.npatterns)
+            nparams = len(dpmats)
+            if self.dpartials is None or self.dpartials.shape[0] != nparams:
+                self.dpartials = np.zeros((nparams,) + self.partials.shape)
+            dpmats = np.stack(dpmats)
+            if dpmats.ndim == 4:
+                dpmats = np.broadcast_to(dpmats[..., None], dpmats.shape + (self.npatterns,))
+            loglik = np.empty(self.npatterns)
+            grads = np.empty((nparams, self.npatterns))
+            kernels().log_likelihoods_and_gradients(
+                self.partials, self.dpartials, self.lnscale, self.ctree.children,
+                self.ctree.postorder, per_pattern(pmats, self.npatterns), dpmats,
+                self.ctree.root, prior, loglik, grads,
+            )
+            return loglik, grads
+
+        self.prune_with_gradients(pmats, dpmats)
+        root = self.ctree.root
+        lik = (
+            (1. - prior) * self.partials[root, :, 0] +
+            prior * self.partials[root, :, 1]
+        )
+        dlik = (
+            (1. - prior) * self.dpartials[:, root, :, 0] +
+            prior * self.dpartials[:, root, :, 1]
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.log(lik) + self.lnscale[root], dlik / lik
+
+
+class SubtreeLikelihoodEngine:
+    """
+    Pruning algorithm with partial likelihoods memoized by subtree
+    pattern, for many tip patterns evaluated with the same transition
+    matrices. Patterns that agree on the tips below a node share its
+    conditional likelihoods, so each node's partials are computed only
+    once per unique sub-pattern and its parent indexes into them. On
+    clade-structured data most nodes see far fewer unique sub-patterns
+    than there are whole patterns.
+
+    Parameters
+    ----------
+    ctree: CompiledTree
+        compiled species tree.
+    patterns: ndarray
+        integer binary data of shape (npatterns, ntips) with tips in
+        node idx order.
+    backend: str
+        'numpy', 'numba' (compiled pruning passes, see hogtie.jit) or
+        'auto' to use numba when it is installed (default='numpy').
+
+    Attributes
+    ----------
+    offsets: ndarray
+        (nnodes + 1,) the unique sub-patterns of node n are rows
+        offsets[n] to offsets[n + 1] of one flat buffer, of which the
+        per-node arrays below are views.
+    child_ids: list
+        for each internal node, the unique sub-pattern ids of its two
+        children that make up each of its own unique sub-patterns.
+    pattern_ids: ndarray
+        (npatterns,) unique sub-pattern id of each pattern at the root.
+    partials: list
+        (nsub, 2) rescaled conditional likelihoods of each unique 
+        sub-pattern of each node.
+    lnscale: list
+        (nsub,) log of the scaling factors of the partials.
+    dpartials: list
+        (nparams, nsub, 2) derivatives of the partials with respect to
+        each model parameter, allocated on the first call to
+        log_likelihoods_and_gradients().
+    """
+    def __init__(self, ctree, patterns, backend="numpy"):
+        self.ctree = ctree
+        self.backend = resolve_backend(backend)
+        self.offsets = None
+        self.child_ids = None
+        self.pattern_ids = None
+        self.partials = None
+        self.lnscale = None
+        self.dpartials = None
+        self.set_patterns(patterns)
+
+
+    @property
+    def npatterns(self):
+        "number of patterns"
+        return self.pattern_ids.size
+
+
+    @property
+    def nsubpatterns(self):
+        "number of unique sub-patterns summed over internal nodes"
+        return sum(self.partials[node].shape[0] for node in self.ctree.postorder)
+
+
+    def set_patterns(self, patterns):
+        """
+        Sets the observed states at the tips and indexes the unique
+        sub-patterns below every internal node, in postorder, by the
+        pairs of their children's sub-pattern ids.
+        """
+        patterns = np.asarray(patterns)
+        if patterns.ndim != 2 or patterns.shape[1] != self.ctree.ntips:
+            raise Exception('Matrix row number must equal ntips on tree')
+
+        ctree = self.ctree
+        ids = [None] * ctree.nnodes
+        nsub = np.zeros(ctree.nnodes, dtype=np.int64)
+        pairs = [None] * ctree.nnodes
+        self.dpartials = None
+
+        # the two sub-patterns of a tip are its observed states
+        for tip in range(ctree.ntips):
+            ids[tip] = patterns[:, tip].astype(np.int64)
+            nsub[tip] = 2
+
+        for node in ctree.postorder:
+            child0, child1 = ctree.children[node]
+            size = nsub[child0] * nsub[child1]
+            keys = ids[child0] * nsub[child1] + ids[child1]
+            if size <= 4 * keys.size:
+                # few possible pairs: mark the ones present instead of sorting
+                present = np.zeros(size, dtype=bool)
+                present[keys] = True
+                uniq = np.flatnonzero(present)
+                inverse = (np.cumsum(present) - 1)[keys]
+            else:
+                uniq, inverse = np.unique(keys, return_inverse=True)
+            pairs[node] = uniq
+            ids[node] = inverse.ravel()
+            nsub[node] = uniq.size
+            ids[child0] = ids[child1] = None
+        self.pattern_ids = ids[ctree.root]
+
+        # per-node views into flat buffers, which the numba kernels use
+        self.offsets = np.zeros(ctree.nnodes + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(nsub)
+        self._partials = np.empty((self.offsets[-1], 2))
+        self._lnscale = np.zeros(self.offsets[-1])
+        self._child_ids = np.zeros((2, self.offsets[-1]), dtype=np.int64)
+        self._dpartials = None
+        rows = [slice(*self.offsets[node:node + 2]) for node in range(ctree.nnodes)]
+        self.partials = [self._partials[row] for row in rows]
+        self.lnscale = [self._lnscale[row] for row in rows]
+        self.child_ids = [None] * ctree.nnodes
+        for tip in range(ctree.ntips):
+            self.partials[tip][:] = np.eye(2)
+        for node in ctree.postorder:
+            child1 = ctree.children[node, 1]
+            self._child_ids[0, rows[node]] = pairs[node] // nsub[child1]
+            self._child_ids[1, rows[node]] = pairs[node] % nsub[child1]
+            self.child_ids[node] = tuple(self._child_ids[:, rows[node]])
+
+
+    def prune(self, pmats):
+        """
+        Traverse tree from tips to root computing the conditional
+        likelihood of each unique sub-pattern at each internal node.
+
+        Parameters
+        ----------
+        pmats: ndarray
+            (nnodes, 2, 2) transition matrices of every edge shared by
+            all patterns, from transition_matrices().
+        """
+        if pmats.ndim != 3:
+            raise Exception('subtree memoization requires transition matrices shared by all patterns')
+        count("pruning_passes")
+        count("pruned_patterns", self.npatterns)
+        count("pruned_subpatterns", self.nsubpatterns)
+        if self.backend == "numba":
+            kernels().subtree_prune(
+                self._partials, self._lnscale, self.offsets, self._child_ids,
+                self.ctree.children, self.ctree.postorder, pmats,
+            )
+            return
+        partials = self.partials
+        lnscale = self.lnscale
+        children = self.ctree.children
+        for node in self.ctree.postorder:
+            child0, child1 = children[node]
+            ids0, ids1 = self.child_ids[node]
+            out = partials[node]
+            np.multiply(
+                propagate(pmats[child0], partials[child0])[ids0],
+                propagate(pmats[child1], partials[child1])[ids1],
+                out=out,
+            )
+            np.add(lnscale[child0][ids0], lnscale[child1][ids1], out=lnscale[node])
+            rescale(out, lnscale[node])
+
+
+    def log_likelihoods(self, pmats, prior):
+        """
+        Returns the log-likelihood of each pattern given the transition
+        matrices and the prior probability that the root state is 1.
+        """
+        if self.backend == "numba":
+            if pmats.ndim != 3:
+                raise Exception('subtree memoization requires transition matrices shared by all patterns')
+            count("pruning_passes")
+            count("pruned_patterns", self.npatterns)
+            count("pruned_subpatterns", self.nsubpatterns)
+            loglik = np.empty(self.npatterns)
+            kernels().subtree_log_likelihoods(
+                self._partials, self._lnscale, self.offsets, self._child_ids,
+                self.ctree.children, self.ctree.postorder, pmats,
+                self.ctree.root, prior, self.pattern_ids, loglik,
+            )
+            return loglik
+
+        self.prune(pmats)
+        root = self.ctree.root
+        lik = (
+            (1. - prior) * self.partials[root][:, 0] +
+            prior * self.partials[root][:, 1]
+        )
+        with np.errstate(divide="ignore"):
+            return (np.log(lik) + self.lnscale[root])[self.pattern_ids]
+
+
+    def allocate_dpartials(self, nparams):
+        """
+        Allocates the derivative buffers for nparams parameters, as
+        per-node views of one flat (nparams, nrows, 2) array.
+        """
+        if self._dpartials is None or self._dpartials.shape[0] != nparams:
+            self._dpartials = np.zeros((nparams,) + self._partials.shape)
+            self.dpartials = [
+                self._dpartials[:, start:stop]
+                for start, stop in zip(self.offsets[:-1], self.offsets[1:])
+            ]
+
+
+    def prune_with_gradients(self, pmats, dpmats):
+        """
+        Pruning pass over unique sub-patterns that also propagates the
+        derivatives of the partials with respect to each parameter, as
+        in LikelihoodEngine.prune_with_gradients().
+        """
+        if pmats.ndim != 3:
+            raise Exception('subtree memoization requires transition matrices shared by all patterns')
+        count("pruning_passes")
+        count("pruned_patterns", self.npatterns)
+        count("pruned_subpatterns", self.nsubpatterns)
+        self.allocate_dpartials(len(dpmats))
+
+        partials = self.partials
+        dpartials = self.dpartials
+        lnscale = self.lnscale
+        children = self.ctree.children
+        for node in self.ctree.postorder:
+            child0, child1 = children[node]
+            ids0, ids1 = self.child_ids[node]
+            left = propagate(pmats[child0], partials[child0])
+            right = propagate(pmats[child1], partials[child1])
+            for pidx, dpmat in enumerate(dpmats):
+                dleft = (
+                    propagate(dpmat[child0], partials[child0]) +
+                    propagate(pmats[child0], dpartials[child0][pidx])
+                )
+                dright = (
+                    propagate(dpmat[child1], partials[child1]) +
+                    propagate(pmats[child1], dpartials[child1][pidx])
+                )
+                dpartials[node][pidx] = dleft[ids0] * right[ids1] + left[ids0] * dright[ids1]
+
+            out = partials[node]
+            np.multiply(left[ids0], right[ids1], out=out)
+            np.add(lnscale[child0][ids0], lnscale[child1][ids1], out=lnscale[node])
+            scale = rescale(out, lnscale[node])
+            dpartials[node] /= scale[:, None]
+
+
+    def log_likelihoods_and_gradients(self, pmats, dpmats, prior):
+        """
+        Returns the log-likelihood of each pattern and its gradient with
+        respect to each parameter, shape (nparams, npatterns).
+        """
+        if self.backend == "numba":
+            if pmats.ndim != 3:
+                raise Exception('subtree memoization requires transition matrices shared by all patterns')
+            count("pruning_passes")
+            count("pruned_patterns", self.npatterns)
+            count("pruned_subpatterns", self.nsubpatterns)
+            self.allocate_dpartials(len(dpmats))
+            loglik = np.empty(self.npatterns)
+            grads = np.empty((len(dpmats), self.npatterns))
+            kernels().subtree_log_likelihoods_and_gradients(
+                self._partials, self._dpartials, self._lnscale, self.offsets,
+                self._child_ids, self.ctree.children, self.ctree.postorder,
+                pmats, np.stack(dpmats), self.ctree.root, prior,
+                self.pattern_ids, loglik, grads,
+            )
+            return loglik, grads
+
+        self.prune_with_gradients(pmats, dpmats)
+        root = self.ctree.root
+        lik = (
+            (1. - prior) * self.partials[root][:, 0] +
+            prior * self.partials[root][:, 1]
+        )
+        dlik = (
+            (1. - prior) * self.dpartials[root][:, :, 0] +
+            prior * self.dpartials[root][:, :, 1]
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            loglik = np.log(lik) + self.lnscale[root]
+            return loglik[self.pattern_ids], (dlik / lik)[:, self.pattern_ids]
+
+
+def propagate(pmat, partial):
+    """
+    Returns the likelihood of the data below a child node conditional
+    on each state at the top of its branch: P(t) @ L for each pattern.
+    """
+    if pmat.ndim == 2:
+        return partial @ pmat.T
+    return np.stack([
+        pmat[0, 0] * partial[:, 0] + pmat[0, 1] * partial[:, 1],
+        pmat[1, 0] * partial[:, 0] + pmat[1, 1] * partial[:, 1],
+    ], axis=1)
+
+
+def propagate_down(pmat, upper):
+    """
+    Returns the joint likelihood of the data outside a child's subtree
+    and each state at the bottom of its branch, given the same at the
+    top of the branch: U @ P(t) for each pattern.
+    """
+    if pmat.ndim == 2:
+        return upper @ pmat
+    return np.stack([
+        pmat[0, 0] * upper[:, 0] + pmat[1, 0] * upper[:, 1],
+        pmat[0, 1] * upper[:, 0] + pmat[1, 1] * upper[:, 1],
+    ], axis=1)
+
+
+def rescale(partial, lnscale):
+    """
+    Divides a node's (npatterns, 2) conditional likelihoods in place by
+    their per-pattern maximum and adds its log to lnscale. Returns the
+    scaling factors.
+    """
+    scale = partial.max(axis=1)
+    scale[scale == 0] = 1.
+    partial /= scale[:, None]
+    lnscale += np.log(scale)
+    return scale
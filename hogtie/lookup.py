@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+Precomputed fits of every possible pattern on a small tree. A tree
+with ntips tips has only 2^ntips presence/absence patterns, fewer than
+the columns of many k-mer matrices when ntips is up to about 20, so
+all of them can be fit once per (tree, model, prior) and stored on
+disk. Each column is then scored by reading its bit-packed pattern as
+an integer code and indexing the table, with no dedup or fitting.
+"""
+
+import os
+import numpy as np
+from loguru import logger
+from hogtie.batch_optimizer import BatchOptimizer
+from hogtie.parallel import parallel_fit
+from hogtie.patterns import PatternIndex, PatternSymmetry, pack_patterns
+from hogtie.profiling import count, stage
+
+
+# 2^24 patterns take ~400MB of fits, the most that is worth storing
+MAX_TIPS = 24
+
+FIT_KEYS = ("alpha", "beta", "negLogLik", "convergence")
+
+
+def packed_codes(packed, ntips):
+    """
+    Returns the integer code of each row of a (npatterns,
+    ceil(ntips / 8)) bit-packed array of patterns, e.g.,
+    BinaryMatrix.packed: the first tip is the most significant bit.
+    """
+    packed = np.asarray(packed, dtype=np.uint8)
+    codes = np.zeros(packed.shape[0], dtype=np.int64)
+    for col in range(packed.shape[1]):
+        codes <<= 8
+        codes |= packed[:, col]
+    return codes >> (8 * packed.shape[1] - ntips)
+
+
+def pattern_codes(patterns):
+    """
+    Returns the integer code of each of a (npatterns, ntips) array of
+    binary patterns.
+    """
+    patterns = np.asarray(patterns)
+    return packed_codes(pack_patterns(patterns), patterns.shape[1])
+
+
+def code_patterns(codes, ntips):
+    """
+    Returns the (npatterns, ntips) binary patterns of integer codes,
+    the inverse of pattern_codes().
+    """
+    shifts = np.arange(ntips - 1, -1, -1, dtype=np.int64)
+    return ((np.asarray(codes, dtype=np.int64)[:, None] >> shifts) & 1).astype(np.uint8)
+
+
+class LikelihoodTable:
+    """
+    Fitted rates and negative log-likelihood of every possible
+    pattern on a tree under one model and prior, indexed by pattern
+    code. Built with LikelihoodTable.build() or read with
+    LikelihoodTable.load().
+
+    Attributes
+    ----------
+    tree: str
+        digest of the compiled tree the table was built for.
+    model: str
+        Either equal rates ('ER') or all rates different ('ARD').
+    prior: float
+        Prior probability that the root state is 1.
+    ntips: int
+        number of tips, the table has 2^ntips entries.
+    fits: dict
+        alpha, beta, negLogLik and convergence arrays of each pattern.
+    """
+    def __init__(self, tree, model, prior, ntips, fits):
+        self.tree = tree
+        self.model = model
+        self.prior = prior
+        self.ntips = ntips
+        self.fits = fits
+
+
+    @classmethod
+    def build(cls, ctree, model, prior=0.5, workers=1, backend="numpy"):
+        """
+        Fits every possible pattern on the tree with a BatchOptimizer
+        using the given likelihood backend, split across processes 
+        when workers > 1. Patterns related by a symmetry of the tree
+        and model (see PatternSymmetry) are fit once.
+        """
+        if ctree.ntips > MAX_TIPS:
+            raise Exception(f'likelihood tables are limited to {MAX_TIPS} tips')
+        with stage("build_table"):
+            patterns = code_patterns(np.arange(2 ** ctree.ntips), ctree.ntips)
+            index = PatternIndex(PatternSymmetry(ctree, model, prior).canonical(patterns).T)
+            del patterns
+            logger.info(
+                f"fitting {index.npatterns} patterns for a table of "
+                f"{2 ** ctree.ntips} patterns")
+            if workers > 1:
+                fits = parallel_fit(
+                    ctree, index.patterns, model, prior, workers=workers, backend=backend)
+            else:
+                fits = BatchOptimizer(ctree, index.patterns, model, prior, backend=backend).fit()
+            fits = {key: index.expand(fits[key]) for key in FIT_KEYS}
+        return cls(ctree.digest(), model, prior, ctree.ntips, fits)
+
+
+    def check(self, ctree, model, prior):
+        """
+        Raises an Exception if the table was not built for this tree,
+        model and prior.
+        """
+        if self.tree != ctree.digest():
+            raise Exception('likelihood table was built for a different tree')
+        if (self.model, self.prior) != (model, prior):
+            raise Exception(
+                f'likelihood table was built for model={self.model} '
+                f'prior={self.prior}, not model={model} prior={prior}')
+
+
+    def lookup(self, patterns):
+        """
+        Returns the fits of a (npatterns, ntips) array of patterns, as
+        the same dict of arrays as BatchOptimizer.fit().
+        """
+        return self.lookup_codes(pattern_codes(patterns))
+
+
+    def lookup_codes(self, codes):
+        """
+        Returns the fits of the patterns with the given codes.
+        """
+        count("table_lookups", len(codes))
+        return {key: values[codes] for key, values in self.fits.items()}
+
+
+    def save(self, path):
+        """
+        Writes the table to a .npz file at path.
+        """
+        with open(path, "wb") as out:
+            np.savez(
+                out,
+                tree=self.tree,
+                model=self.model,
+                prior=self.prior,
+                ntips=self.ntips,
+                **self.fits,
+            )
+
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a table written by LikelihoodTable.save().
+        """
+        with np.load(path) as arrs:
+            return cls(
+                str(arrs["tree"]),
+                str(arrs["model"]),
+                float(arrs["prior"]),
+                int(arrs["ntips"]),
+                {key: arrs[key] for key in FIT_KEYS},
+            )
+
+
+def open_table(table, ctree, model, prior=0.5, workers=1, backend="numpy"):
+    """
+    Returns a LikelihoodTable from a LikelihoodTable, a path, or None,
+    checked against the tree, model and prior. A table that does not
+    exist at path yet is built (see LikelihoodTable.build()) and 
+    written there.
+    """
+    if table is None:
+        return None
+    if not isinstance(table, LikelihoodTable):
+        if os.path.exists(table):
+            with stage("read_table"):
+                table = LikelihoodTable.load(table)
+        else:
+            path = table
+            table = LikelihoodTable.build(ctree, model, prior, workers, backend)
+            table.save(path)
+            logger.info(f"wrote likelihood table to {path}")
+    table.check(ctree, model, prior)
+    return table
+
+
+
+if __name__ == "__main__":
+    import time
+    import toytree
+    from hogtie.compiled_tree import compile_tree
+    TREE = compile_tree(toytree.rtree.unittree(ntips=14, treeheight=1, seed=123))
+    START = time.time()
+    TABLE = LikelihoodTable.build(TREE, 'ER')
+    print(f"table of {2 ** TREE.ntips} patterns built in {time.time() - START:.2f}s")
+    PATTERNS = np.random.default_rng(123).integers(0, 2, (1000000, 14), dtype=np.uint8)
+    START = time.time()
+    NEGLOGLIK = TABLE.lookup(PATTERNS)["negLogLik"]
+    print(f"{PATTERNS.shape[0]} patterns scored in {time.time() - START:.3f}s")
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""
+Streaming reader for presence/absence matrices stored as csv with one
+row per tip and one column per variant. Large k-mer matrices are read
+in blocks of columns so that only a block of each row is held in
+memory at a time, regardless of the number of columns in the file.
+"""
+
+import numpy as np
+
+
+class _RowCursor:
+    """
+    Reads the comma separated fields of one line of a file from a
+    start offset, a few at a time, so that long lines never have to be
+    held in memory in full.
+    """
+    def __init__(self, handle, start, end, bufsize):
+        self.handle = handle
+        self.pos = start
+        self.end = end
+        self.bufsize = bufsize
+        self.tail = b""
+        self.pending = []
+
+
+    @property
+    def exhausted(self):
+        "True when all fields of the line have been taken"
+        return not self.pending and not self.tail and self.pos >= self.end
+
+
+    def take(self, nfields):
+        """
+        Returns a list with the next nfields fields (bytes) of the line,
+        or fewer if the end of the line is reached.
+        """
+        fields = self.pending
+        while len(fields) < nfields and (self.pos < self.end or self.tail):
+            if self.pos < self.end:
+                self.handle.seek(self.pos)
+                chunk = self.handle.read(min(self.bufsize, self.end - self.pos))
+                self.pos += len(chunk)
+            else:
+                chunk = b""
+            parts = (self.tail + chunk).split(b",")
+            # the last field may continue in the next read
+            self.tail = parts.pop() if self.pos < self.end else b""
+            fields.extend(part.strip() for part in parts)
+        self.pending = fields[nfields:]
+        return fields[:nfields]
+
+
+class ColumnBlockReader:
+    """
+    Iterates over a csv presence/absence matrix in blocks of columns.
+    The first row holds the column ids and the first field of every
+    other row the tip name, as written by pandas.DataFrame.to_csv().
+
+    Parameters
+    ----------
+    path: str
+        path to the csv matrix file.
+    chunksize: int
+        number of columns in each block.
+    bufsize: int
+        number of bytes read from a row at a time. By default enough
+        for about one block of single character fields.
+
+    Attributes
+    ----------
+    tip_names: list
+        name of the tip of each row, in file order.
+    """
+    def __init__(self, path, chunksize=100000, bufsize=None):
+        self.path = path
+        self.chunksize = int(chunksize)
+        self.bufsize = bufsize if bufsize else max(2 * self.chunksize + 64, 4096)
+        self.offsets = self._line_offsets()
+        if len(self.offsets) < 2:
+            raise Exception('matrix file must have a header row and at least one tip row')
+
+        with open(self.path, "rb") as handle:
+            self.tip_names = [
+                _RowCursor(handle, start, end, 4096).take(1)[0].decode()
+                for start, end in self.offsets[1:]
+            ]
+
+
+    @property
+    def ntips(self):
+        "number of rows (tips) in the matrix"
+        return len(self.tip_names)
+
+
+    def _line_offsets(self):
+        """
+        Returns the (start, end) byte offsets of every non-empty line,
+        found by scanning the file in fixed size reads.
+        """
+        offsets = []
+        start = 0
+        pos = 0
+        with open(self.path, "rb") as handle:
+            while True:
+                chunk = handle.read(1 << 20)
+                if not chunk:
+                    break
+                idx = chunk.find(b"\n")
+                while idx != -1:
+                    offsets.append((start, pos + idx))
+                    start = pos + idx + 1
+                    idx = chunk.find(b"\n", idx + 1)
+                pos += len(chunk)
+        offsets.append((start, pos))
+        return [(start, end) for start, end in offsets if end - start > 1]
+
+
+    def __iter__(self):
+        """
+        Yields (column_ids, block) with a list of the column ids and a
+        (ntips, ncolumns) uint8 array for each block of columns.
+        """
+        with open(self.path, "rb") as handle:
+            rows = [
+                _RowCursor(handle, start, end, self.bufsize)
+                for start, end in self.offsets
+            ]
+            # skip the index header and the tip names
+            for row in rows:
+                row.take(1)
+
+            header, rows = rows[0], rows[1:]
+            while not header.exhausted:
+                column_ids = [i.decode() for i in header.take(self.chunksize)]
+                block = np.empty((len(rows), len(column_ids)), dtype=np.uint8)
+                for ridx, row in enumerate(rows):
+                    fields = row.take(self.chunksize)
+                    if len(fields) != len(column_ids):
+                        raise Exception(
+                            f'row {self.tip_names[ridx]} has a different number '
+                            'of columns than the header')
+                    block[ridx] = np.array(fields).astype(float)
+                yield column_ids, block
+
+            if not all(row.exhausted for row in rows):
+                raise Exception('matrix rows have more columns than the header')
+
+
+
+if __name__ == "__main__":
+    import os
+    HOGTIEDIR = os.path.dirname(os.getcwd())
+    file1 = os.path.join(HOGTIEDIR, "sampledata", "testmatrix.csv")
+    reader = ColumnBlockReader(file1, chunksize=30)
+    print(reader.tip_names)
+    for cols, data in reader:
+        print(cols[0], cols[-1], data.shape)
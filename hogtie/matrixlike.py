@@ -6,98 +6,441 @@ Runs BinaryStateModel on matrix of binary character state data for gwas data for
 
 
 import numpy as np
-import toytree
-import toyplot
 import pandas as pd #assuming matrix will be a pandas df
 from loguru import logger
-from hogtie.binary_state_model import BinaryStateModel
+from hogtie.batch_optimizer import BOUNDS, BatchOptimizer, boundary_optimum
+from hogtie.binary_matrix import BinaryMatrix, is_binary_matrix
+from hogtie.cache import open_cache
+from hogtie.compiled_tree import CompiledTree, compile_tree
+from hogtie.jit import resolve_backend
+from hogtie.likelihood import LikelihoodEngine
+from hogtie.lookup import open_table, packed_codes
+from hogtie.matrix_reader import ColumnBlockReader
+from hogtie.parallel import parallel_fit
+from hogtie.parsimony import fitch_scores, parsimony_rates
+from hogtie.patterns import PatternIndex, PatternSymmetry, PatternTable, pack_patterns, pattern_keys
+from hogtie.profiling import count, stage
+from hogtie.transition import transition_matrices
+
+
+# multiples of the parsimony rate at which patterns screened out by
+# parsimony are scored (see parsimony_rates())
+SCREEN_SCALES = (1., 1.5, 2.)
+
+# number of screened patterns scored together
+SCREEN_CHUNKSIZE = 10000
 
 
 class MatrixParser:
     """
-    Runs BinaryStateModel on matrix columns, returns a likelihood score for each column.
+    Fits the binary state model to each matrix column, returns a likelihood score for each column.
     The matrix should correspond to presence/absence data corresponding to sequence variants (this
     could be kmers, snps, transcripts, etc.).
 
     Parameters
     ----------
-    tree: newick string or toytree object
+    tree: newick string, toytree object or CompiledTree
         species tree to be used. ntips = number of rows in data matrix
-    matrix: pandas.dataframe object, csv
+    matrix: pandas.dataframe object, csv or bit-packed matrix (.hbm) file
         matrix of 1's and 0's corresponding to presence/absence data of the sequence variant at the tips of 
-        the input tree. Row number must equal tip number. 
+        the input tree. Row number must equal tip number. Files written by `hogtie convert` are
+        memory-mapped instead of parsed.
     model: str
         Either equal rates ('ER') or all rates different ('ARD')
     prior: float
         Prior probability that the root state is 1 (default=0.5). Flat, uniform prior is assumed.
+    workers: int
+        Number of processes used to fit unique patterns (default=1).
+    chunksize: int
+        If set, a matrix file is not loaded into memory but streamed in
+        blocks of this many columns by stream_likelihoods().
+    cache: str or LikelihoodCache
+        Optional path to a persistent likelihood cache (SQLite). Patterns 
+        fit in earlier runs with the same tree, model and prior are read
+        from the cache instead of being refit.
+    screen: int
+        If set, only patterns whose Fitch parsimony score (minimum
+        number of changes on the tree) is above screen get the full
+        optimizer search. Patterns at or below it fit the tree well and 
+        are not fit: they are scored at a few fixed rates set by their
+        parsimony score (see score_screened()).
+    table: str or LikelihoodTable
+        Optional path to a table of the fits of every possible pattern
+        on a small tree (see hogtie.lookup). Columns are scored by 
+        indexing the table instead of being fit. The table is built
+        and written to the path if it does not exist yet.
+    backend: str
+        Backend of the likelihood engines: 'numpy', 'numba' (compiled
+        pruning passes) or 'auto' to use numba when it is installed
+        (default='auto').
 
     """
     def __init__(self, 
         tree,               #must be Toytree class object
         matrix = None,      #must be pandas DataFrame class object
         model = None,
-        prior = 0.5    
+        prior = 0.5,
+        workers = 1,
+        chunksize = None,
+        cache = None,
+        screen = None,
+        table = None,
+        backend = "auto",
         ):
 
-        if isinstance(tree, toytree.tree):
+        if isinstance(tree, CompiledTree):
             self.tree = tree
-        elif isinstance(tree, str):
-            self.tree = toytree.tree(tree, tree_format=0)
-        else: 
-            raise Exception('tree must be either a newick string or toytree object')
+        else:
+            # toytree is only imported when a tree has to be parsed
+            import toytree
+            if isinstance(tree, toytree.tree):
+                self.tree = tree
+            elif isinstance(tree, str):
+                self.tree = toytree.tree(tree, tree_format=0)
+            else: 
+                raise Exception('tree must be either a newick string or toytree object')
 
+        # compiled once and shared by every per-column model fit
+        with stage("compile_tree"):
+            self.ctree = compile_tree(self.tree)
 
-        if isinstance(matrix, pd.DataFrame):
-            self.matrix = matrix  
-        else:
-            self.matrix = pd.read_csv(matrix, index_col=0)
+
+        self.reader = None
+        with stage("read_matrix"):
+            if isinstance(matrix, pd.DataFrame):
+                self.matrix = matrix  
+            elif is_binary_matrix(matrix) and chunksize:
+                self.matrix = None
+                self.reader = BinaryMatrix(matrix, chunksize)
+            elif is_binary_matrix(matrix):
+                self.matrix = BinaryMatrix(matrix)
+            elif chunksize:
+                self.matrix = None
+                self.reader = ColumnBlockReader(matrix, chunksize)
+            else:
+                self.matrix = pd.read_csv(matrix, index_col=0)
 
         self.model = model
         self.prior = prior
+        self.workers = workers
+        self.cache = open_cache(cache)
+        self.screen = screen
+        self.backend = resolve_backend(backend)
+        self.symmetry = PatternSymmetry(self.ctree, model, prior)
+        self.table = open_table(table, self.ctree, model, prior, workers, self.backend)
+        self._pattern_index = None
+        self.fits = None
 
         #for i in self.matrix:
         #  if i != 1 or 0:
         #        raise ValueError('Only valid trait values are 0 and 1')
 
+    @property
+    def pattern_index(self):
+        """
+        Index of the unique column patterns, built once on first access.
+        """
+        if self.matrix is None:
+            raise Exception('matrix is streamed in chunks, use stream_likelihoods()')
+        with stage("dedup"):
+            if self._pattern_index is None and isinstance(self.matrix, BinaryMatrix):
+                self._pattern_index = PatternIndex.from_packed(
+                    self.matrix.packed, self.matrix.ntips)
+            if self._pattern_index is None:
+                self._pattern_index = PatternIndex(self.matrix.to_numpy())
+        return self._pattern_index
+
     @property
     def unique_matrix(self):
         """
         Gets matrix that contains only columns with unique pattern of 1's and 0's
         """
-        matrix_array = self.matrix.to_numpy()
-        unique_array = np.unique(matrix_array, axis=1)
-        unique_matrix = pd.DataFrame(unique_array)
-        return unique_matrix
+        return pd.DataFrame(self.pattern_index.patterns.T)
 
     def matrix_likelihoods(self):
         """
-        Gets likelihoods for each column of the matrix
+        Gets likelihoods for each column of the matrix. All unique
+        columns are fit at once by a BatchOptimizer, split across 
+        processes when workers > 1, and the results are mapped back to
+        the columns in their original order. With a likelihood table
+        the columns are scored by indexing it, without deduplication.
         """
-        likelihoods = np.empty((0,len(self.matrix.columns)),float)
-        for column in self.unique_matrix:
-            data = self.unique_matrix[column]
-            out = BinaryStateModel(self.tree, data, self.model, self.prior)
-            out.optimize()
-        
-            lik = out.log_lik
+        if self.table is not None and self.matrix is not None:
+            with stage("table_lookup"):
+                codes = self.column_codes()
+                self.likelihoods = pd.DataFrame(self.table.lookup_codes(codes)["negLogLik"])
+            return
 
-            for col in self.matrix:
-                if list(self.matrix[col]) == list(self.unique_matrix[column]):
-                    likelihoods = np.append(likelihoods, lik)
+        index = self.pattern_index
+        self.fits = self.fit_patterns(index.patterns)
+        with stage("expand"):
+            self.likelihoods = pd.DataFrame(index.expand(self.fits["negLogLik"]))
+        logger.debug(f'Likelihoods for each column: {self.likelihoods}')
 
-        self.likelihoods = pd.DataFrame(likelihoods)
+    def column_codes(self):
+        """
+        Returns the likelihood table code of the pattern of each column.
+        """
+        if isinstance(self.matrix, BinaryMatrix):
+            packed, ntips = self.matrix.packed, self.matrix.ntips
+        else:
+            matrix = self.matrix.to_numpy()
+            packed, ntips = pack_patterns(matrix.T), matrix.shape[0]
+        if ntips != self.ctree.ntips:
+            raise Exception('Matrix row number must equal ntips on tree')
+        return packed_codes(packed, ntips)
+
+    def stream_likelihoods(self, outfile):
+        """
+        Gets likelihoods for each column of a matrix streamed in blocks
+        of columns and writes them to outfile block by block, in the
+        same csv format as self.likelihoods.to_csv(). Each block is
+        deduplicated against a running table of the patterns seen so
+        far and only new patterns are fit, so memory is bounded by the
+        block size and the number of unique patterns.
+        """
+        if self.reader is None:
+            raise Exception('stream_likelihoods requires a chunksize and a matrix file')
+        if self.reader.ntips != self.ctree.ntips:
+            raise Exception('Matrix row number must equal ntips on tree')
 
-        #testing something in simulate
-        #self.likelihoods = likelihoods
-        
-        logger.debug(f'Likelihoods for each column: {self.tree.get_node_values("likelihood",True,True)}')
+        self.pattern_table = PatternTable(self.reader.ntips)
+        negloglik = np.empty(0)
+        ncolumns = 0
+        blocks = iter(self.reader)
+        with open(outfile, "w") as out:
+            out.write(",0\n")
+            while True:
+                with stage("read_matrix"):
+                    _, block = next(blocks, (None, None))
+                if block is None:
+                    break
+                with stage("dedup"):
+                    ids, new = self.pattern_table.add(block)
+                if new.shape[0]:
+                    fits = self.fit_patterns(new)
+                    negloglik = np.concatenate([negloglik, fits["negLogLik"]])
+                with stage("write_output"):
+                    index = np.arange(ncolumns, ncolumns + ids.size)
+                    pd.DataFrame(negloglik[ids], index=index).to_csv(out, header=False)
+                ncolumns += ids.size
+                logger.debug(
+                    f"{ncolumns} columns read, "
+                    f"{self.pattern_table.npatterns} unique patterns")
+
+    def ancestral_states(self):
+        """
+        Returns the marginal probability that each node is in state 1
+        for each unique column pattern under its own fitted rates, 
+        shape (nnodes, npatterns) with patterns in the order of 
+        pattern_index.patterns (columns map to them by 
+        pattern_index.inverse). All patterns are reconstructed at once
+        by one pruning and one preorder pass. Patterns are fit first if
+        matrix_likelihoods() has not been run.
+        """
+        index = self.pattern_index
+        if self.fits is None:
+            self.fits = self.fit_patterns(index.patterns)
+        alpha = self.fits["alpha"]
+        beta = alpha if self.model == 'ER' else self.fits["beta"]
+        with stage("ancestral_states"):
+            pmats = transition_matrices(alpha, beta, self.ctree.dists)
+            engine = LikelihoodEngine(self.ctree, index.patterns, self.backend)
+            return engine.marginal_states(pmats, self.prior)
+
+    def leave_one_out_deltas(self):
+        """
+        Returns the increase in log-likelihood of each unique column
+        pattern when each tip in turn is treated as missing, under the
+        pattern's own fitted rates, shape (npatterns, ntips) with 
+        patterns in the order of pattern_index.patterns and tips in 
+        node idx order. Rates are not refit without the tip, which 
+        replaces ntips refits per pattern by one extra pass over all 
+        patterns. Patterns are fit first if matrix_likelihoods() has
+        not been run.
+        """
+        index = self.pattern_index
+        if self.fits is None:
+            self.fits = self.fit_patterns(index.patterns)
+        alpha = self.fits["alpha"]
+        beta = alpha if self.model == 'ER' else self.fits["beta"]
+        with stage("leave_one_out"):
+            pmats = transition_matrices(alpha, beta, self.ctree.dists)
+            engine = LikelihoodEngine(self.ctree, index.patterns, self.backend)
+            return engine.leave_one_out_deltas(pmats, self.prior)
+
+    def fit_patterns(self, patterns):
+        """
+        Fits the model to each of a (npatterns, ntips) array of unique
+        patterns, split across processes when workers > 1. Patterns 
+        related by a symmetry of the tree and model (see 
+        PatternSymmetry) are fit once as their canonical pattern. 
+        Patterns found in the cache are not refit, and new fits are 
+        stored. With screen set, only patterns above the parsimony 
+        threshold are fit (see screen_patterns()). With a likelihood 
+        table the fits are read from it instead.
+        """
+        if self.table is not None:
+            return self.table.lookup(patterns)
+        if not self.symmetry.trivial:
+            with stage("canonicalize"):
+                index = PatternIndex(self.symmetry.canonical(patterns).T)
+            count("symmetric_patterns", patterns.shape[0] - index.npatterns)
+            logger.debug(
+                f"{patterns.shape[0]} patterns reduced to "
+                f"{index.npatterns} by symmetry")
+            # always fit the canonical pattern, so that a pattern's fit
+            # does not depend on whether its partners are in the batch
+            fits = self._fit_canonical(index.patterns)
+            return {key: index.expand(values) for key, values in fits.items()}
+        return self._fit_canonical(patterns)
+
+    def _fit_canonical(self, patterns):
+        """
+        Fits the model to each pattern, screened or through the cache.
+        """
+        if self.screen is not None:
+            return self.screen_patterns(patterns)
+        return self._cached_fit_patterns(patterns)
+
+    def screen_patterns(self, patterns):
+        """
+        Computes the Fitch parsimony score of every pattern with one
+        bitwise pass, fits the patterns scoring above screen, and 
+        scores the rest without a search (see score_screened()).
+        Returns the fits with the 'parsimony' scores and a 'screened'
+        flag.
+        """
+        with stage("screen"):
+            parsimony = fitch_scores(self.ctree, patterns)
+        screened = parsimony <= self.screen
+        count("screened_patterns", int(screened.sum()))
+        logger.debug(f"{screened.sum()} of {screened.size} patterns screened out")
+
+        npatterns = patterns.shape[0]
+        fits = {
+            "alpha": np.empty(npatterns),
+            "beta": np.empty(npatterns),
+            "negLogLik": np.empty(npatterns),
+            "convergence": np.empty(npatterns, dtype=bool),
+        }
+        full = np.flatnonzero(~screened)
+        if full.size:
+            for key, values in self._cached_fit_patterns(patterns[full]).items():
+                fits[key][full] = values
+        if screened.any():
+            with stage("score_screened"):
+                scored = self.score_screened(patterns[screened], parsimony[screened])
+            for key, values in scored.items():
+                fits[key][screened] = values
+        fits["parsimony"] = parsimony
+        fits["screened"] = screened
+        return fits
+
+    def score_screened(self, patterns, parsimony):
+        """
+        Scores patterns that fit the tree with few changes at the best
+        of a few fixed rates set by their parsimony scores (see 
+        parsimony_rates()), with one pruning pass per candidate rate 
+        instead of an optimizer search. Constant patterns are scored at
+        their exact optimum (see boundary_optimum()). The score of a
+        pattern depends only on the pattern, and is never below its 
+        maximum likelihood score. Being this cheap, the scores are not
+        cached.
+        """
+        alphas, betas = parsimony_rates(
+            self.ctree, patterns, parsimony, self.model, SCREEN_SCALES, BOUNDS)
+        closed, optimum0, optimum1 = boundary_optimum(patterns, self.model, self.prior, BOUNDS)
+        if self.model == 'ER':
+            optimum1 = optimum0
+        alphas = np.vstack([alphas, np.where(closed, optimum0, alphas[0])])
+        betas = np.vstack([betas, np.where(closed, optimum1, betas[0])])
+
+        # in blocks, which bound the memory of the per-pattern matrices
+        negloglik = np.empty(alphas.shape)
+        engine = None
+        for start in range(0, patterns.shape[0], SCREEN_CHUNKSIZE):
+            block = slice(start, start + SCREEN_CHUNKSIZE)
+            if engine is None:
+                engine = LikelihoodEngine(self.ctree, patterns[block], self.backend)
+            else:
+                engine.set_patterns(patterns[block])
+            for cand, (alpha, beta) in enumerate(zip(alphas[:, block], betas[:, block])):
+                pmats = transition_matrices(alpha, beta, self.ctree.dists)
+                negloglik[cand, block] = -engine.log_likelihoods(pmats, self.prior)
+        best = negloglik.argmin(axis=0)
+        cols = np.arange(patterns.shape[0])
+        return {
+            "alpha": alphas[best, cols],
+            "beta": betas[best, cols] if self.model == 'ARD' else np.full(cols.size, np.nan),
+            "negLogLik": negloglik[best, cols],
+            "convergence": np.ones(cols.size, dtype=bool),
+        }
+
+    def _cached_fit_patterns(self, patterns):
+        """
+        Fits the model to every pattern, reading and storing fits in
+        the cache if one is set.
+        """
+        if self.cache is None:
+            return self._fit_patterns(patterns)
+
+        treekey = self.ctree.digest()
+        keys = pattern_keys(patterns)
+        with stage("cache_lookup"):
+            found, fits = self.cache.lookup(treekey, self.model, self.prior, keys)
+        missing = np.flatnonzero(~found)
+        if missing.size:
+            newfits = self._fit_patterns(patterns[missing])
+            with stage("cache_store"):
+                self.cache.store(treekey, self.model, self.prior, keys[missing], newfits)
+            for key, values in newfits.items():
+                fits[key][missing] = values
+        logger.debug(f"likelihood cache: {self.cache.stats()}")
+        return fits
+
+    def _fit_patterns(self, patterns, **kwargs):
+        """
+        Fits the model to every pattern with a BatchOptimizer, with 
+        optional optimizer settings in kwargs.
+        """
+        with stage("optimize"):
+            if self.workers > 1:
+                fits = parallel_fit(
+                    self.ctree, patterns, self.model, self.prior,
+                    workers=self.workers, backend=self.backend, **kwargs,
+                )
+            else:
+                fits = BatchOptimizer(
+                    self.ctree, patterns, self.model, self.prior,
+                    backend=self.backend, **kwargs,
+                ).fit()
+        count("nonconverged_fits", int((~fits["convergence"]).sum()))
+        if not fits["convergence"].all():
+            logger.warning(
+                f"{(~fits['convergence']).sum()} patterns did not converge")
+        return fits
 
     
+
 if __name__ == "__main__":
     import os
+    import toytree
     HOGTIEDIR = os.path.dirname(os.getcwd())
     tree1 = toytree.rtree.unittree(ntips=10)
     file1 = os.path.join(HOGTIEDIR, "sampledata", "testmatrix.csv")
     testmatrix = MatrixParser(tree=tree1, matrix=file1, model='ARD')
     testmatrix.matrix_likelihoods()
     print(testmatrix.likelihoods)
+
+    # screened scores must not depend on the blocks the matrix is read in
+    import tempfile
+    screened = MatrixParser(tree=tree1, matrix=file1, model='ARD', screen=1)
+    screened.matrix_likelihoods()
+    outfile = os.path.join(tempfile.mkdtemp(), "streamed.csv")
+    for chunksize in (1, 7, 10, 37, 100):
+        streamed = MatrixParser(tree=tree1, matrix=file1, model='ARD', screen=1, chunksize=chunksize)
+        streamed.stream_likelihoods(outfile)
+        result = pd.read_csv(outfile, index_col=0, float_precision="round_trip")
+        assert (result.to_numpy() == screened.likelihoods.to_numpy()).all(), chunksize
+    print("streamed and in-memory screened scores are identical")
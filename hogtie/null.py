@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+"""
+Summaries of null distributions of per-column likelihood scores that
+can be saved and reused, so observed data can be scored against a
+null without simulating it again, and nulls of pattern scores under
+a fitted model, exact by enumerating tip patterns or by parametric
+bootstrap from forward simulations.
+"""
+
+import hashlib
+import os
+import numpy as np
+from loguru import logger
+from hogtie.forward import ForwardSimulator
+from hogtie.likelihood import SubtreeLikelihoodEngine
+from hogtie.patterns import PatternIndex
+from hogtie.transition import transition_matrices
+
+
+class NullDistribution:
+    """
+    Quantiles, histogram and moments of a sample of null scores
+    (negative log-likelihoods).
+
+    Parameters
+    ----------
+    values: ndarray
+        null scores to summarize.
+    nquantiles: int
+        number of evenly spaced quantiles to store.
+    nbins: int
+        number of histogram bins.
+    meta: dict
+        description of how the null was generated, stored with it.
+    """
+    def __init__(self, values=None, nquantiles=1001, nbins=100, meta=None):
+        self.meta = dict(meta) if meta else {}
+        self.nvalues = 0
+        self.mean = np.nan
+        self.std = np.nan
+        self.nbins = nbins
+        self.probs = np.linspace(0, 1, nquantiles)
+        self.quantiles = None
+        self.hist = None
+        self.bin_edges = None
+        if values is not None:
+            self.summarize(values)
+
+
+    def summarize(self, values):
+        """
+        Sets the summaries from a sample of null scores.
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[np.isfinite(values)]
+        self.nvalues = values.size
+        self.mean = values.mean()
+        self.std = values.std(ddof=1)
+        self.quantiles = np.quantile(values, self.probs)
+        self.hist, self.bin_edges = np.histogram(values, bins=self.nbins)
+
+
+    def threshold(self, nsd=2):
+        """
+        Returns the score nsd standard deviations above the null mean.
+        """
+        return self.mean + nsd * self.std
+
+
+    def sf(self, values):
+        """
+        Returns the probability that a null score is at least as high
+        as each value, interpolated from the stored quantiles.
+        """
+        return 1. - np.interp(values, self.quantiles, self.probs)
+
+
+    def save(self, path):
+        """
+        Writes the summaries to a .npz file.
+        """
+        np.savez(
+            path,
+            nvalues=self.nvalues,
+            mean=self.mean,
+            std=self.std,
+            probs=self.probs,
+            quantiles=self.quantiles,
+            hist=self.hist,
+            bin_edges=self.bin_edges,
+            meta_keys=np.array(list(self.meta), dtype=str),
+            meta_values=np.array([str(i) for i in self.meta.values()], dtype=str),
+        )
+
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads summaries written by NullDistribution.save().
+        """
+        null = cls()
+        with np.load(path) as arrs:
+            null.nvalues = int(arrs["nvalues"])
+            null.mean = float(arrs["mean"])
+            null.std = float(arrs["std"])
+            null.probs = arrs["probs"]
+            null.quantiles = arrs["quantiles"]
+            null.hist = arrs["hist"]
+            null.nbins = null.hist.size
+            null.bin_edges = arrs["bin_edges"]
+            null.meta = dict(zip(arrs["meta_keys"].tolist(), arrs["meta_values"].tolist()))
+        return null
+
+
+    def mismatches(self, **params):
+        """
+        Returns the names of the keyword parameters whose values differ
+        from those recorded in meta (e.g., the nreps, nsites and seed a
+        null was simulated with). Values are compared as strings, since
+        meta is stored as strings by save().
+        """
+        return [
+            name for name, value in params.items()
+            if self.meta.get(name) != str(value)
+        ]
+
+
+def null_key(ctree, **params):
+    """
+    Returns a hex hash of a compiled tree and the keyword parameters
+    that define a null (e.g., Ne, model and prior).
+    """
+    sha = hashlib.sha1(ctree.digest().encode())
+    for name in sorted(params):
+        sha.update(f"{name}={params[name]!r};".encode())
+    return sha.hexdigest()
+
+
+def null_path(null_dir, key):
+    """
+    Returns the path of the null artifact with a key in null_dir.
+    """
+    return os.path.join(null_dir, f"null-{key}.npz")
+
+
+def enumerate_patterns(ntips, start, stop):
+    """
+    Returns the (stop - start, ntips) uint8 patterns whose bits are the
+    integers in [start, stop), with tip i as bit i.
+    """
+    codes = np.arange(start, stop, dtype=np.int64)
+    return ((codes[:, None] >> np.arange(ntips)) & 1).astype(np.uint8)
+
+
+class ExactNull:
+    """
+    Exact null distribution of the pattern score -log P(x) under the
+    two-state model with fixed rates, computed by a vectorized pruning
+    pass over every one of the 2^ntips tip patterns in blocks.
+
+    Patterns with P(x) < min_prob, which are exactly the patterns with
+    a score above -log(min_prob), are not stored. Only their total
+    probability is kept, so tail probabilities of scores up to the 
+    cutoff remain exact while memory is bounded by 1 / min_prob.
+
+    Parameters
+    ----------
+    ctree: CompiledTree
+        compiled species tree.
+    alpha: float
+        Rate of transition from state 0 to state 1.
+    beta: float
+        Rate of transition from state 1 to state 0.
+    prior: float
+        Prior probability that the root state is 1 (default=0.5).
+    min_prob: float
+        Probability below which patterns are only counted in the 
+        pooled upper tail.
+    blocksize: int
+        number of patterns in each pruning pass.
+
+    Attributes
+    ----------
+    scores: ndarray
+        sorted scores of the stored patterns.
+    probs: ndarray
+        probability of each stored pattern.
+    tail_mass: float
+        total probability of the patterns that were not stored.
+    cutoff: float
+        score above which patterns were not stored.
+    """
+    def __init__(self, ctree, alpha, beta, prior=0.5, min_prob=1e-10, blocksize=65536):
+        self.ctree = ctree
+        self.alpha = alpha
+        self.beta = beta
+        self.prior = prior
+        self.min_prob = min_prob
+        self.blocksize = blocksize
+        self.cutoff = -np.log(min_prob)
+        self.scores = None
+        self.probs = None
+        self.tail_mass = 0.
+        self._upper = None
+        self.enumerate()
+
+
+    def enumerate(self):
+        """
+        Computes the probability of every tip pattern and stores the
+        sorted scores.
+        """
+        ntips = self.ctree.ntips
+        if ntips > 40:
+            raise Exception('exact null is limited to trees with at most 40 tips')
+        npatterns = 2 ** ntips
+        pmats = transition_matrices(self.alpha, self.beta, self.ctree.dists)
+
+        scores = []
+        probs = []
+        self.tail_mass = 0.
+        engine = None
+        for start in range(0, npatterns, self.blocksize):
+            patterns = enumerate_patterns(ntips, start, min(start + self.blocksize, npatterns))
+            if engine is None:
+                engine = SubtreeLikelihoodEngine(self.ctree, patterns)
+            else:
+                engine.set_patterns(patterns)
+            score = -engine.log_likelihoods(pmats, self.prior)
+            keep = score <= self.cutoff
+            scores.append(score[keep])
+            probs.append(np.exp(-score[keep]))
+            self.tail_mass += np.exp(-score[~keep]).sum()
+
+        scores = np.concatenate(scores)
+        order = np.argsort(scores, kind="stable")
+        self.scores = scores[order]
+        self.probs = np.concatenate(probs)[order]
+
+        # upper[i] = P(score >= scores[i]); upper[-1] = pooled tail
+        self._upper = np.append(np.cumsum(self.probs[::-1])[::-1], 0.) + self.tail_mass
+        logger.debug(
+            f"exact null: {npatterns} patterns, {self.scores.size} stored, "
+            f"total probability {self._upper[0]:.12f}")
+
+
+    def sf(self, values):
+        """
+        Returns the probability that a null pattern scores at least as
+        high as each value. Exact for values up to the cutoff; above it
+        the pooled tail probability is returned as an upper bound.
+        """
+        idx = np.searchsorted(self.scores, np.asarray(values, dtype=float), side="left")
+        return self._upper[idx]
+
+
+    def threshold(self, level=0.05):
+        """
+        Returns the smallest score whose null tail probability is at
+        most level.
+        """
+        if self.tail_mass > level:
+            raise Exception(
+                f'patterns below min_prob hold {self.tail_mass:.3g} of the null '
+                'probability, set a lower min_prob to resolve this level')
+        idx = np.searchsorted(-self._upper[:-1], -level, side="left")
+        if idx == self.scores.size:
+            return self.cutoff
+        return self.scores[idx]
+
+
+class ParametricBootstrap:
+    """
+    Parametric bootstrap p-values of the pattern score -log P(x) under
+    the two-state model with fixed rates. Sites are forward simulated
+    in blocks, each block is deduplicated and scored with one pruning
+    pass, and the number of simulated sites scoring at least as high as
+    each observed score is accumulated, so memory is bounded by the
+    block size for any number of sites.
+
+    Parameters
+    ----------
+    ctree: CompiledTree
+        compiled species tree.
+    alpha: float
+        Rate of transition from state 0 to state 1.
+    beta: float
+        Rate of transition from state 1 to state 0.
+    prior: float
+        Prior probability that the root state is 1 (default=0.5).
+    nsites: int
+        number of sites to simulate.
+    blocksize: int
+        number of sites simulated at a time.
+    seed: int
+        Seed of the forward simulator.
+    """
+    def __init__(self, ctree, alpha, beta, prior=0.5, nsites=1000000, blocksize=100000, seed=None):
+        self.ctree = ctree
+        self.prior = prior
+        self.nsites = nsites
+        self.blocksize = blocksize
+        self.pmats = transition_matrices(alpha, beta, ctree.dists)
+        self.simulator = ForwardSimulator(ctree, alpha, beta, prior, seed)
+
+
+    def scores(self, patterns):
+        """
+        Returns -log P(x) of each of a (npatterns, ntips) array of
+        patterns with tips in node idx order.
+        """
+        engine = SubtreeLikelihoodEngine(self.ctree, patterns)
+        return -engine.log_likelihoods(self.pmats, self.prior)
+
+
+    def pvalues(self, observed):
+        """
+        Returns the bootstrap p-value (1 + nge) / (1 + nsites) of each
+        observed score, where nge is the number of simulated sites 
+        scoring at least as high.
+        """
+        observed = np.asarray(observed, dtype=float)
+        order = np.argsort(observed)
+        nabove = np.zeros(observed.size + 1)
+        for block in self.simulator.blocks(self.nsites, self.blocksize):
+            index = PatternIndex(block.T)
+            scores = self.scores(index.patterns)
+            # a simulated score s counts for every observed score <= s
+            idx = np.searchsorted(observed[order], scores, side="right")
+            nabove += np.bincount(idx, weights=index.counts, minlength=observed.size + 1)
+        # sites with idx > k score at least the k-th smallest observed
+        nge = np.cumsum(nabove[::-1])[::-1][1:]
+        pvalues = np.empty(observed.size)
+        pvalues[order] = (1. + nge) / (1. + self.nsites)
+        return pvalues
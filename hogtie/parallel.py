@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""
+Multi-process fitting of unique patterns. The compiled tree arrays and
+the pattern array are placed in shared memory once; worker processes
+attach to them when they start and each task only receives the range
+of patterns to fit.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from loguru import logger
+from hogtie.batch_optimizer import BatchOptimizer
+from hogtie.compiled_tree import CompiledTree
+from hogtie.profiling import PROFILER, enable_profiling
+
+
+# state of each worker process, set by _init_worker
+_WORKER = {}
+
+
+class SharedArrays:
+    """
+    Copies a dict of arrays into shared memory blocks that other
+    processes can attach to with attach_arrays(self.spec). Use as a
+    context manager so the blocks are released when done.
+    """
+    def __init__(self, arrays):
+        self.blocks = []
+        self.spec = {}
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)
+            view[...] = arr
+            self.blocks.append(block)
+            self.spec[name] = (block.name, arr.shape, arr.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        "Releases and removes the shared memory blocks."
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def attach_arrays(spec):
+    """
+    Returns a dict of ndarray views on the shared memory blocks
+    described by spec, and the list of blocks, which must be kept
+    alive as long as the views are used.
+    """
+    arrays = {}
+    blocks = []
+    for name, (bname, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name=bname)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        blocks.append(block)
+    return arrays, blocks
+
+
+def _init_worker(spec, tip_names, model, prior, kwargs, profile):
+    """
+    Attaches a worker process to the shared tree and pattern arrays.
+    """
+    enable_profiling(profile)
+    arrays, blocks = attach_arrays(spec)
+    ctree = CompiledTree()
+    ctree.tip_names = tip_names
+    ctree.dists = arrays["dists"]
+    ctree.parents = arrays["parents"]
+    ctree.children = arrays["children"]
+    ctree.postorder = arrays["postorder"]
+    _WORKER.update(
+        ctree=ctree,
+        patterns=arrays["patterns"],
+        blocks=blocks,
+        model=model,
+        prior=prior,
+        kwargs=kwargs,
+    )
+
+
+def _fit_range(bounds):
+    """
+    Fits the patterns in [start, stop) of the shared pattern array.
+    Returns the fits and the profiling counters of the task.
+    """
+    PROFILER.reset()
+    start, stop = bounds
+    optim = BatchOptimizer(
+        _WORKER["ctree"],
+        _WORKER["patterns"][start:stop],
+        _WORKER["model"],
+        _WORKER["prior"],
+        **_WORKER["kwargs"],
+    )
+    return optim.fit(), dict(PROFILER.counters)
+
+
+def parallel_fit(ctree, patterns, model, prior=0.5, workers=2, chunksize=None, **kwargs):
+    """
+    Fits every pattern with a BatchOptimizer split across a pool of
+    worker processes. Returns the same dict of arrays as
+    BatchOptimizer.fit(), in the order of the input patterns.
+
+    Parameters
+    ----------
+    ctree: CompiledTree
+        compiled species tree.
+    patterns: ndarray
+        (npatterns, ntips) binary patterns.
+    model: str
+        Either equal rates ('ER') or all rates different ('ARD').
+    prior: float
+        Prior probability that the root state is 1 (default=0.5).
+    workers: int
+        Number of worker processes.
+    chunksize: int
+        Number of patterns per task. By default patterns are split into
+        four tasks per worker.
+    kwargs:
+        Additional arguments to BatchOptimizer.
+    """
+    patterns = np.asarray(patterns)
+    npatterns = patterns.shape[0]
+    if chunksize is None:
+        chunksize = max(1, -(-npatterns // (4 * workers)))
+    tasks = [
+        (start, min(start + chunksize, npatterns))
+        for start in range(0, npatterns, chunksize)
+    ]
+    logger.debug(f"fitting {npatterns} patterns in {len(tasks)} tasks on {workers} workers")
+
+    results = {
+        "alpha": np.empty(npatterns),
+        "beta": np.empty(npatterns),
+        "negLogLik": np.empty(npatterns),
+        "convergence": np.empty(npatterns, dtype=bool),
+    }
+    shared = {
+        "dists": ctree.dists,
+        "parents": ctree.parents,
+        "children": ctree.children,
+        "postorder": ctree.postorder,
+        "patterns": patterns,
+    }
+    with SharedArrays(shared) as arrays:
+        initargs = (arrays.spec, ctree.tip_names, model, prior, kwargs, PROFILER.enabled)
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as pool:
+            # map returns results in task order regardless of finish order
+            for (start, stop), (chunk, counters) in zip(tasks, pool.map(_fit_range, tasks)):
+                PROFILER.merge(counters)
+                for key, values in chunk.items():
+                    results[key][start:stop] = values
+    return results
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+"""
+Deduplication of binary column patterns. Each column of a
+presence/absence matrix is bit-packed into a byte string so that
+unique patterns can be found by hashing/sorting short keys, and
+per-pattern results are mapped back to columns with a single index.
+"""
+
+import numpy as np
+
+
+def pack_patterns(patterns):
+    """
+    Returns the (npatterns, ceil(ntips / 8)) uint8 bit-packed form of a
+    (npatterns, ntips) array of binary patterns.
+    """
+    return np.packbits(np.asarray(patterns, dtype=bool), axis=1)
+
+
+def pattern_keys(patterns):
+    """
+    Returns a 1-d array with one fixed size byte string key per
+    pattern, which can be hashed, sorted and compared as a unit.
+    """
+    return packed_keys(pack_patterns(patterns))
+
+
+def packed_keys(packed):
+    """
+    Returns the keys of patterns that are already bit-packed, as a
+    view of the (npatterns, nbytes) packed array when it is contiguous.
+    """
+    packed = np.ascontiguousarray(packed)
+    return packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+
+
+class PatternIndex:
+    """
+    Index of the unique column patterns in a binary matrix.
+
+    Parameters
+    ----------
+    matrix: ndarray
+        binary data of shape (ntips, ncolumns).
+
+    Attributes
+    ----------
+    patterns: ndarray
+        (npatterns, ntips) unique column patterns.
+    counts: ndarray
+        (npatterns,) number of columns with each pattern.
+    inverse: ndarray
+        (ncolumns,) index of the pattern of each column.
+    """
+    def __init__(self, matrix):
+        matrix = np.asarray(matrix)
+        first = self._index(pattern_keys(matrix.T))
+        self.patterns = matrix[:, first].T
+
+
+    @classmethod
+    def from_packed(cls, packed, ntips):
+        """
+        Builds the index from (ncolumns, ceil(ntips / 8)) bit-packed
+        columns, e.g. BinaryMatrix.packed, unpacking only the unique
+        patterns.
+        """
+        index = cls.__new__(cls)
+        first = index._index(packed_keys(packed))
+        index.patterns = np.unpackbits(packed[first], axis=1, count=ntips)
+        return index
+
+
+    def _index(self, keys):
+        """
+        Sets the inverse and counts of the unique keys and returns the
+        index of the first column with each.
+        """
+        _, first, self.inverse, self.counts = np.unique(
+            keys,
+            return_index=True,
+            return_inverse=True,
+            return_counts=True,
+        )
+        self.inverse = self.inverse.ravel()
+        return first
+
+
+    @property
+    def npatterns(self):
+        "number of unique patterns"
+        return self.patterns.shape[0]
+
+    @property
+    def ncolumns(self):
+        "number of columns in the indexed matrix"
+        return self.inverse.size
+
+
+    def expand(self, values):
+        """
+        Maps an array with one value per unique pattern (along the
+        first axis) to one value per column of the original matrix.
+        """
+        return np.asarray(values)[self.inverse]
+
+
+class PatternSymmetry:
+    """
+    Symmetries of pattern likelihoods that follow from the tree and
+    model. Swapping the states of the two tips of a cherry whose
+    branches are equally long leaves the likelihood of any pattern
+    unchanged, and under the ER model with a root prior of 0.5 so does
+    complementing every state. Patterns related by these symmetries
+    have the same likelihood and fitted rates, so only one canonical
+    pattern of each group needs to be fit.
+
+    Parameters
+    ----------
+    ctree: CompiledTree
+        compiled species tree.
+    model: str
+        Either equal rates ('ER') or all rates different ('ARD').
+    prior: float
+        Probability that the root state is 1.
+
+    Attributes
+    ----------
+    cherries: ndarray
+        (ncherries, 2) tip idxs of the cherries with equal branches.
+    complement: bool
+        whether complementing a pattern leaves its likelihood unchanged.
+    """
+    def __init__(self, ctree, model, prior=0.5):
+        cherries = []
+        for node in ctree.postorder:
+            child0, child1 = ctree.children[node]
+            if (
+                child0 < ctree.ntips and child1 < ctree.ntips
+                and ctree.dists[child0] == ctree.dists[child1]
+            ):
+                cherries.append((child0, child1))
+        self.cherries = np.array(cherries, dtype=np.int64).reshape(-1, 2)
+        self.complement = model == 'ER' and prior == 0.5
+
+
+    @property
+    def trivial(self):
+        "whether every pattern is its own canonical pattern"
+        return not (self.cherries.size or self.complement)
+
+
+    def _sort_cherries(self, patterns):
+        "Sets the states of each cherry in increasing order, in place."
+        tip0, tip1 = self.cherries.T
+        low = np.minimum(patterns[:, tip0], patterns[:, tip1])
+        patterns[:, tip1] = np.maximum(patterns[:, tip0], patterns[:, tip1])
+        patterns[:, tip0] = low
+        return patterns
+
+
+    def canonical(self, patterns):
+        """
+        Returns the canonical pattern of each of a (npatterns, ntips)
+        array of binary patterns with tips in node idx order: the
+        states of every cherry are sorted, and under complement
+        symmetry the smaller (in bit-packed byte order) of the sorted
+        pattern and its sorted complement is kept.
+        """
+        patterns = self._sort_cherries(np.array(patterns))
+        if not self.complement:
+            return patterns
+        flipped = self._sort_cherries(1 - patterns)
+        packed = pack_patterns(patterns)
+        fpacked = pack_patterns(flipped)
+        rows = np.arange(patterns.shape[0])
+        first = (packed != fpacked).argmax(axis=1)
+        use = fpacked[rows, first] < packed[rows, first]
+        patterns[use] = flipped[use]
+        return patterns
+
+
+class PatternTable:
+    """
+    Running table of the unique column patterns seen in a stream of
+    matrix blocks. Patterns are stored only as their bit-packed keys,
+    so memory grows with the number of unique patterns rather than
+    with the number of columns read.
+
+    Parameters
+    ----------
+    ntips: int
+        number of rows (tips) in each block.
+    """
+    def __init__(self, ntips):
+        self.ntips = ntips
+        self._ids = {}
+        self._counts = []
+
+
+    @property
+    def npatterns(self):
+        "number of unique patterns seen so far"
+        return len(self._ids)
+
+    @property
+    def counts(self):
+        "(npatterns,) number of columns with each pattern"
+        return np.array(self._counts, dtype=int)
+
+    @property
+    def patterns(self):
+        "(npatterns, ntips) unique patterns in the order first seen"
+        packed = np.frombuffer(b"".join(self._ids), dtype=np.uint8)
+        packed = packed.reshape(self.npatterns, -1)
+        return np.unpackbits(packed, axis=1, count=self.ntips)
+
+
+    def add(self, block):
+        """
+        Adds the columns of a (ntips, ncolumns) block to the table.
+        Returns the pattern id of each column, and a (nnew, ntips)
+        array of the patterns not seen in any earlier block, in the
+        order of their ids (ids npatterns-nnew to npatterns-1).
+        """
+        block = np.asarray(block)
+        if block.shape[0] != self.ntips:
+            raise Exception('Matrix row number must equal ntips on tree')
+
+        keys, first, inverse, counts = np.unique(
+            pattern_keys(block.T),
+            return_index=True,
+            return_inverse=True,
+            return_counts=True,
+        )
+        start = self.npatterns
+        ids = np.empty(keys.size, dtype=np.int64)
+        for idx, key in enumerate(keys):
+            ids[idx] = self._ids.setdefault(key.tobytes(), len(self._ids))
+        self._counts.extend([0] * (self.npatterns - start))
+        for pid, count in zip(ids, counts):
+            self._counts[pid] += count
+
+        # new ids were handed out in increasing order along keys
+        isnew = ids >= start
+        return ids[inverse.ravel()], block[:, first[isnew]].T
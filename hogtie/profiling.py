@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+Lightweight instrumentation of hogtie runs: wall time timers around
+the stages of a run and counters on hot paths (pruning passes,
+transition matrix computations, optimizer iterations, cache hits).
+Profiling is off by default; while disabled stage() returns a shared
+no-op context and count() returns after a single attribute check.
+"""
+
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from loguru import logger
+
+
+class Profiler:
+    """
+    Accumulates stage timings and event counters.
+
+    Attributes
+    ----------
+    enabled: bool
+        whether timings and counts are recorded.
+    timers: dict
+        total seconds and number of calls of each stage.
+    counters: dict
+        total count of each event.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.timers = defaultdict(lambda: [0., 0])
+        self.counters = defaultdict(int)
+
+
+    def reset(self):
+        "Drops all timings and counts."
+        self.timers.clear()
+        self.counters.clear()
+
+
+    def merge(self, counters):
+        "Adds counts recorded elsewhere, e.g., in a worker process."
+        for name, value in counters.items():
+            self.counters[name] += value
+
+
+    def summary(self):
+        """
+        Returns a dict with the stage timings, the counters and derived
+        per-pattern rates.
+        """
+        counters = dict(self.counters)
+        derived = {}
+        nfit = counters.get("patterns_fit", 0)
+        if nfit:
+            iterations = counters.get("golden_iterations", 0) + counters.get("bfgs_iterations", 0)
+            derived["optimizer_iterations_per_pattern"] = iterations / nfit
+            derived["pattern_evaluations_per_fit"] = counters.get("pruned_patterns", 0) / nfit
+        for name in ("pmat_cache", "likelihood_cache"):
+            total = counters.get(f"{name}_hits", 0) + counters.get(f"{name}_misses", 0)
+            if total:
+                derived[f"{name}_hit_rate"] = counters[f"{name}_hits"] / total
+        return {
+            "stages": {
+                name: {"seconds": secs, "calls": calls}
+                for name, (secs, calls) in self.timers.items()
+            },
+            "counters": counters,
+            "derived": derived,
+        }
+
+
+PROFILER = Profiler()
+_NOOP = nullcontext()
+
+
+@contextmanager
+def _timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer = PROFILER.timers[name]
+        timer[0] += time.perf_counter() - start
+        timer[1] += 1
+
+
+def stage(name):
+    """
+    Returns a context manager that adds its wall time to the named
+    stage when profiling is enabled.
+    """
+    if PROFILER.enabled:
+        return _timed(name)
+    return _NOOP
+
+
+def count(name, value=1):
+    """
+    Adds value to the named counter when profiling is enabled.
+    """
+    if PROFILER.enabled:
+        PROFILER.counters[name] += value
+
+
+def enable_profiling(enabled=True):
+    """
+    Turns recording of stage timings and counters on or off.
+    """
+    PROFILER.enabled = enabled
+
+
+def log_profile():
+    """
+    Logs the profile summary as a single JSON message bound with
+    profile=True, so that it can be routed to its own sink by
+    utils.set_loglevel(profile=...). Returns the summary dict.
+    """
+    summary = PROFILER.summary()
+    logger.bind(profile=True).info(json.dumps(summary, sort_keys=True))
+    return summary
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+
+"""
+Streaming region calling along the genome. Per k-mer scores are
+consumed in genome order in blocks, smoothed with a triangular window
+whose state is carried between blocks, and positions whose smoothed
+score reaches a threshold are merged into outlier regions. Per-bin
+summaries are kept for plotting instead of every point.
+"""
+
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+
+Region = namedtuple("Region", ["chrom", "start", "end", "peak", "count"])
+
+SUMMARY_COLUMNS = ["chrom", "start", "end", "mean", "max", "smoothed", "n"]
+
+
+def triang(window):
+    """
+    Returns the normalized triangular window weights used by
+    pandas.Series.rolling(window, win_type='triang').
+    """
+    half = np.arange(1, (window + 1) // 2 + 1)
+    if window % 2:
+        weights = 2. * half / (window + 1.)
+        weights = np.concatenate([weights, weights[-2::-1]])
+    else:
+        weights = (2. * half - 1.) / window
+        weights = np.concatenate([weights, weights[::-1]])
+    return weights / weights.sum()
+
+
+def boxcars(window):
+    """
+    Returns the lengths of the boxcars whose cascade is the triangular
+    window: two of length (window + 1) // 2 give the 1, 2, .., m, .., 1
+    weights of an odd window, and a third of length 2 turns them into
+    the 1, 3, .., 2m - 1, 2m - 1, .., 1 weights of an even window.
+    """
+    half = (window + 1) // 2
+    if window % 2:
+        return (half, half)
+    return (half, half, 2)
+
+
+def running_sums(values, length):
+    """
+    Returns the sums of every run of length consecutive values, each
+    obtained from the previous one by adding one value and dropping one.
+    """
+    cumsum = np.concatenate([[0.], np.cumsum(values)])
+    return cumsum[length:] - cumsum[:-length]
+
+
+def triang_smooth(scores, window):
+    """
+    Returns the triangular weighted mean of every full window of
+    scores, the same as np.convolve(scores, triang(window), 'valid'),
+    as cascaded boxcar running sums in constant work per position.
+    Windows containing a NaN are NaN.
+    """
+    missing = np.isnan(scores)
+    smoothed = np.where(missing, 0., scores)
+    lengths = boxcars(window)
+    for length in lengths:
+        smoothed = running_sums(smoothed, length)
+    smoothed /= np.prod(lengths)
+    if missing.any():
+        smoothed[running_sums(missing, window) > 0] = np.nan
+    return smoothed
+
+
+class RegionCaller:
+    """
+    Calls outlier regions from scores pushed in genome order. Each
+    position gets the triangular weighted mean of the window centered
+    on it; positions where it is >= threshold are outliers, and
+    outliers within max_gap of each other are merged into a region.
+    The window is smoothed as cascaded boxcar running sums (see
+    triang_smooth()), so work per position is constant, and memory is
+    bounded by the window and block sizes.
+
+    Parameters
+    ----------
+    threshold: float
+        smoothed score at or above which a position is an outlier.
+    window: int
+        number of positions in the smoothing window.
+    max_gap: int
+        largest gap (in position units) between consecutive outlier
+        positions in one region; 0 merges only adjacent positions.
+    bin_size: int
+        number of positions in each plotting summary bin.
+
+    Attributes
+    ----------
+    regions: list
+        Region(chrom, start, end, peak, count) of every finished region,
+        with the positions of its first and last outliers, its maximum
+        raw score and the number of outlier positions.
+    """
+    def __init__(self, threshold, window=50, max_gap=0, bin_size=1000):
+        self.threshold = threshold
+        self.window = window
+        self.max_gap = max_gap
+        self.bin_size = bin_size
+        self.lag = window // 2
+        self.regions = []
+        self._summaries = []
+        self._reset(None)
+
+
+    def _reset(self, chrom):
+        "Starts a new chromosome with empty carried state."
+        self.chrom = chrom
+        self._tail_pos = np.empty(0, dtype=np.int64)
+        self._tail_score = np.empty(0)
+        self._open = None
+        self._bin = None
+
+
+    def push(self, positions, scores, chrom=""):
+        """
+        Adds a block of positions and scores in genome order. Starting
+        a new chrom finishes the previous one. Returns the regions that
+        were finished by this block.
+        """
+        nregions = len(self.regions)
+        if chrom != self.chrom:
+            self._finish()
+            self._reset(chrom)
+
+        positions = np.concatenate([self._tail_pos, np.asarray(positions, dtype=np.int64)])
+        scores = np.concatenate([self._tail_score, np.asarray(scores, dtype=float)])
+        if scores.size >= self.window:
+            smoothed = triang_smooth(scores, self.window)
+            center = slice(self.lag, self.lag + smoothed.size)
+            self._call(positions[center], scores[center], smoothed)
+            self._summarize(positions[center], scores[center], smoothed)
+            keep = self.window - 1
+            self._tail_pos = positions[positions.size - keep:]
+            self._tail_score = scores[scores.size - keep:]
+        else:
+            self._tail_pos = positions
+            self._tail_score = scores
+        return self.regions[nregions:]
+
+
+    def flush(self):
+        """
+        Finishes the current chromosome and returns the regions that
+        were finished by it.
+        """
+        nregions = len(self.regions)
+        self._finish()
+        self._reset(None)
+        return self.regions[nregions:]
+
+
+    def _finish(self):
+        "Closes the open region and summary bin."
+        if self._open is not None:
+            self.regions.append(Region(*self._open))
+        if self._bin is not None:
+            self._summaries.append(self._bin)
+
+
+    def _call(self, positions, scores, smoothed):
+        """
+        Merges the outlier positions of a block into regions.
+        """
+        outliers = np.flatnonzero(smoothed >= self.threshold)
+        pos = positions[outliers]
+
+        # a new region starts where the gap to the previous outlier is too large
+        starts = np.flatnonzero(np.diff(pos) > self.max_gap + 1) + 1
+        starts = np.concatenate([[0], starts]).astype(np.int64)
+        ends = np.append(starts[1:], pos.size)
+        peaks = np.maximum.reduceat(scores[outliers], starts) if pos.size else ()
+        for first, last, peak in zip(starts, ends, peaks) if pos.size else ():
+            region = [self.chrom, pos[first], pos[last - 1], peak, last - first]
+            if first == 0 and self._open is not None:
+                if pos[0] - self._open[2] <= self.max_gap + 1:
+                    self._open = [
+                        self.chrom, self._open[1], region[2],
+                        max(self._open[3], peak), self._open[4] + region[4],
+                    ]
+                    continue
+                self.regions.append(Region(*self._open))
+            elif self._open is not None:
+                self.regions.append(Region(*self._open))
+            self._open = region
+
+        # regions far from the end of the block cannot grow any more
+        if self._open is not None and positions[-1] - self._open[2] > self.max_gap + 1:
+            self.regions.append(Region(*self._open))
+            self._open = None
+
+
+    def _summarize(self, positions, scores, smoothed):
+        """
+        Adds a block to the per-bin plotting summaries.
+        """
+        start = 0
+        if self._bin is not None:
+            # fill the partial bin carried from the previous block
+            start = min(self.bin_size - self._bin[-1], positions.size)
+            self._bin = self._merge_bin(
+                self._bin, positions[:start], scores[:start], smoothed[:start])
+            if self._bin[-1] < self.bin_size:
+                return
+            self._summaries.append(self._bin)
+            self._bin = None
+
+        nfull = (positions.size - start) // self.bin_size
+        stop = start + nfull * self.bin_size
+        if nfull:
+            shape = (nfull, self.bin_size)
+            self._summaries.extend(zip(
+                [self.chrom] * nfull,
+                positions[start:stop:self.bin_size],
+                positions[start + self.bin_size - 1:stop:self.bin_size],
+                scores[start:stop].reshape(shape).mean(axis=1),
+                scores[start:stop].reshape(shape).max(axis=1),
+                smoothed[start:stop].reshape(shape).mean(axis=1),
+                [self.bin_size] * nfull,
+            ))
+        if stop < positions.size:
+            self._bin = self._merge_bin(
+                None, positions[stop:], scores[stop:], smoothed[stop:])
+
+
+    def _merge_bin(self, current, positions, scores, smoothed):
+        "Returns a partial summary bin with more positions added."
+        if not positions.size:
+            return current
+        nvals = positions.size
+        if current is None:
+            return (self.chrom, positions[0], positions[-1], scores.mean(),
+                scores.max(), smoothed.mean(), nvals)
+        total = current[-1] + nvals
+        return (
+            self.chrom, current[1], positions[-1],
+            (current[3] * current[-1] + scores.sum()) / total,
+            max(current[4], scores.max()),
+            (current[5] * current[-1] + smoothed.sum()) / total,
+            total,
+        )
+
+
+    def summaries(self):
+        """
+        Returns a DataFrame with the chrom, first and last position,
+        mean and max raw score, mean smoothed score and number of
+        positions of each summary bin.
+        """
+        rows = list(self._summaries)
+        if self._bin is not None:
+            rows.append(self._bin)
+        return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+
+
+    def scan(self, scores, positions=None, chrom="", blocksize=100000):
+        """
+        Pushes a whole array of scores (positions default to 0..n-1)
+        in blocks and returns a RegionIndex of all called regions.
+        """
+        scores = np.asarray(scores, dtype=float)
+        if positions is None:
+            positions = np.arange(scores.size)
+        for start in range(0, scores.size, blocksize):
+            self.push(positions[start:start + blocksize], scores[start:start + blocksize], chrom)
+        self.flush()
+        return RegionIndex(self.regions)
+
+
+
+class RegionIndex:
+    """
+    Regions sorted by chrom and start that can be queried by
+    coordinate.
+
+    Parameters
+    ----------
+    regions: list or DataFrame
+        Region tuples or a DataFrame with Region fields as columns.
+    """
+    def __init__(self, regions):
+        frame = pd.DataFrame(list(regions) if not isinstance(regions, pd.DataFrame) else regions,
+            columns=list(Region._fields))
+        self.regions = frame.sort_values(["chrom", "start"], kind="stable").reset_index(drop=True)
+        self._bounds = {}
+        for chrom, group in self.regions.groupby("chrom", sort=False):
+            starts = group.start.to_numpy()
+            # running max of ends, so overlapping regions are also found
+            maxends = np.maximum.accumulate(group.end.to_numpy())
+            self._bounds[chrom] = (group.index[0], starts, maxends)
+
+
+    def __len__(self):
+        return len(self.regions)
+
+
+    def query(self, chrom, start, end):
+        """
+        Returns a DataFrame of the regions on chrom overlapping the
+        closed interval [start, end].
+        """
+        if chrom not in self._bounds:
+            return self.regions.iloc[:0]
+        offset, starts, maxends = self._bounds[chrom]
+        lower = np.searchsorted(maxends, start, side="left")
+        upper = np.searchsorted(starts, end, side="right")
+        hits = self.regions.iloc[offset + lower:offset + upper]
+        return hits[hits.end >= start]
+
+
+    def to_csv(self, path):
+        """
+        Writes the regions as a tab separated file.
+        """
+        self.regions.to_csv(path, sep="\t", index=False)
+
+
+    @classmethod
+    def from_csv(cls, path):
+        """
+        Reads regions written by RegionIndex.to_csv().
+        """
+        return cls(pd.read_csv(path, sep="\t", keep_default_na=False,
+            dtype={"chrom": str}))
+
+
+
+def plot_summaries(summaries, threshold=None, width=500, height=500):
+    """
+    Plots the mean smoothed score of each summary bin along the genome
+    and a horizontal line at the threshold. Returns the toyplot canvas,
+    axes and mark.
+    """
+    import toyplot
+    canvas, axes, mark = toyplot.plot(
+        summaries["start"].to_numpy(),
+        summaries["smoothed"].to_numpy(),
+        width=width,
+        height=height,
+        color='blue',
+    )
+    if threshold is not None:
+        axes.hlines(threshold, style={"stroke": "red", "stroke-width": 2})
+    return canvas, axes, mark
+
+
+
+if __name__ == "__main__":
+    RNG = np.random.default_rng(123)
+    SCORES = RNG.normal(5, 1, 1000000)
+    SCORES[500000:500500] += 4
+    CALLER = RegionCaller(threshold=7, window=51, max_gap=10)
+    INDEX = CALLER.scan(SCORES)
+    print(INDEX.regions)
+    print(INDEX.query("", 499000, 501000))
+    print(CALLER.summaries().head())
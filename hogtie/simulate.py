@@ -4,12 +4,19 @@
 generating null data and testing observations against it
 """
 
-import ipcoal
+import os
+from concurrent.futures import ProcessPoolExecutor
 import toytree
-import toyplot
 from loguru import logger
 import numpy as np
-from hogtie import MatrixParser
+import pandas as pd
+from hogtie.matrixlike import MatrixParser
+from hogtie.compiled_tree import compile_tree
+from hogtie.discrete_markov_model import DiscreteMarkovModel
+from hogtie.null import (
+    ExactNull, NullDistribution, ParametricBootstrap, null_key, null_path)
+from hogtie.profiling import stage
+from hogtie.regions import RegionCaller, plot_summaries
 
 class SimulateNull():
     """
@@ -18,11 +25,63 @@ class SimulateNull():
     TO DO: Not sure standard deviation-based comparison is the best for
     log-likelihoods from a statistical point of view. Maybe something more like
     an AIC-type comparison or a likelihood-ratio test?
+
+    Parameters
+    ----------
+    tree: newick string or toytree object
+        species tree to be used.
+    matrix: pandas.dataframe object, csv or bit-packed matrix (.hbm) file
+        observed presence/absence data, passed to MatrixParser. Files
+        written by `hogtie convert` are memory-mapped instead of parsed.
+    model: str
+        Either equal rates ('ER') or all rates different ('ARD')
+    prior: float
+        Prior probability that the root state is 1 (default=0.5).
+    Ne: float
+        Effective population size of the coalescent simulations 
+        (default=treeheight ** 3, high ILS).
+    nreps: int
+        Number of independent simulation replicates in the null.
+    nsites: int
+        Number of sites simulated in each replicate.
+    workers: int
+        Number of processes used to run replicates.
+    seed: int
+        Seed from which an independent seed is drawn for each replicate,
+        so the null is the same regardless of the number of workers.
+    null_dir: str
+        Optional directory where null distributions are saved, keyed by
+        tree, Ne, model and prior. A saved null is loaded instead of 
+        being simulated again.
+    mode: str
+        'simulate' (default) compares per-column likelihood scores to 
+        those of coalescent simulations. 'exact' fits a single 
+        DiscreteMarkovModel to all columns, scores each column by its
+        negative log-probability under that model, and compares it to
+        the exact distribution of scores over all 2^ntips patterns.
+        'bootstrap' scores columns the same way and gets parametric
+        bootstrap p-values from nreps * nsites sites forward simulated
+        under the fitted model, for trees too large to enumerate.
+    level: float
+        Tail probability of the significance threshold in 'exact' and
+        'bootstrap' modes.
     """
-    def __init__(self, tree, matrix, model=None, prior=0.5):
+    def __init__(self, tree, matrix, model=None, prior=0.5, Ne=None,
+        nreps=1, nsites=10000, workers=1, seed=None, null_dir=None,
+        mode='simulate', level=0.05):
         self.model = model
         self.prior = prior
         self.matrix = matrix
+        self.nreps = nreps
+        self.nsites = nsites
+        self.workers = workers
+        self.seed = seed
+        self.null_dir = null_dir
+        self.null_dist = None
+        self.mode = mode
+        self.level = level
+        if mode not in ('simulate', 'exact', 'bootstrap'):
+            raise Exception("mode must be either 'simulate', 'exact' or 'bootstrap'")
 
         if isinstance(tree, toytree.tree):
             self.tree = tree
@@ -32,32 +91,133 @@ class SimulateNull():
             raise Exception('tree must be either a newick string or toytree object')
 
         self.treeheight = float(self.tree.treenode.height)
+        self.Ne = Ne if Ne is not None else self.treeheight ** 3
+
+    def simulate_null(self):
+        """
+        Returns the null distribution of likelihood scores. It is loaded
+        from null_dir if one was saved for this tree, Ne, model and prior
+        with the same nreps, nsites and seed; otherwise nreps replicates
+        are simulated across a process pool and their pooled scores are
+        summarized (and saved, replacing a null simulated with other 
+        settings).
+        """
+        if self.null_dist is not None:
+            return self.null_dist
+
+        key = null_key(compile_tree(self.tree), Ne=float(self.Ne), 
+            model=self.model, prior=float(self.prior))
+        path = null_path(self.null_dir, key) if self.null_dir else None
+        if path and os.path.exists(path):
+            null_dist = NullDistribution.load(path)
+            stale = null_dist.mismatches(
+                nreps=self.nreps, nsites=self.nsites, seed=self.seed)
+            if not stale:
+                logger.info(f"loading null distribution from {path}")
+                self.null_dist = null_dist
+                return self.null_dist
+            logger.warning(
+                f"null distribution at {path} was simulated with other "
+                f"{', '.join(stale)}, simulating it again")
+
+        # one independent seed per replicate
+        seeds = [
+            int(i.generate_state(1)[0])
+            for i in np.random.SeedSequence(self.seed).spawn(self.nreps)
+        ]
+        args = [
+            (self.tree, self.Ne, self.nsites, self.model, self.prior, seed)
+            for seed in seeds
+        ]
+        with stage("simulate_null"):
+            if self.workers > 1:
+                with ProcessPoolExecutor(self.workers) as pool:
+                    values = list(pool.map(_simulate_replicate, *zip(*args)))
+            else:
+                values = [_simulate_replicate(*i) for i in args]
+
+        self.null_dist = NullDistribution(np.concatenate(values), meta={
+            "Ne": self.Ne, "model": self.model, "prior": self.prior,
+            "nreps": self.nreps, "nsites": self.nsites, "seed": self.seed,
+        })
+        if path:
+            os.makedirs(self.null_dir, exist_ok=True)
+            self.null_dist.save(path)
+            logger.info(f"saved null distribution to {path}")
+        return self.null_dist
+
+    def fit_all_columns(self):
+        """
+        Fits one DiscreteMarkovModel to all columns of the matrix and 
+        scores each column by its negative log-probability under it.
+        Returns the column scores and the fitted model.
+        """
+        lik_calc = MatrixParser(tree=self.tree, model=self.model, 
+            prior=self.prior, matrix=self.matrix)
+        index = lik_calc.pattern_index
+        ctree = lik_calc.ctree
+        fit = DiscreteMarkovModel(
+            ctree,
+            pd.DataFrame(index.patterns, columns=list(ctree.tip_names)),
+            self.model,
+            self.prior,
+            counts=index.counts,
+        )
+        with stage("fit_all_columns"):
+            fit.optimize()
+        logger.info(f"model fit to all columns: {fit.model_fit}")
+        return pd.DataFrame(index.expand(fit.log_likelihoods)), fit
+
+    def exact_null(self):
+        """
+        Returns the column scores of fit_all_columns() and the ExactNull
+        of the score over all tip patterns under the fitted rates.
+        """
+        likes, fit = self.fit_all_columns()
+        with stage("exact_null"):
+            self.null_dist = ExactNull(fit.ctree, fit.qmat[0, 1], fit.qmat[1, 0], self.prior)
+        return likes, self.null_dist
+
+    def bootstrap_null(self):
+        """
+        Returns the column scores of fit_all_columns() and their 
+        parametric bootstrap p-values from nreps * nsites sites 
+        simulated under the fitted rates.
+        """
+        likes, fit = self.fit_all_columns()
+        self.null_dist = ParametricBootstrap(
+            fit.ctree, fit.qmat[0, 1], fit.qmat[1, 0], self.prior,
+            nsites=self.nreps * self.nsites, seed=self.seed,
+        )
+        with stage("bootstrap_null"):
+            pvalues = self.null_dist.pvalues(likes[0])
+        return likes, pvalues
 
     def null(self):
         """
         Simulates SNPs across the input tree to create the null expectation for likelihood
-        scores and compares
+        scores and compares. In 'exact' and 'bootstrap' modes columns are instead scored
+        against the null of exact_null() or bootstrap_null().
         """
-        
-        #high ILS
-        mod = ipcoal.Model(tree=self.tree, Ne=(self.treeheight ** 3))
-        mod.sim_loci(nloci=1, nsites=10000)
-        null_genos = mod.write_vcf().iloc[:, 9:].T
-
-        #make sure matrix has only 0's and 1's
-        for col in null_genos:
-            null_genos[col] = null_genos[col].replace([2,3],1)
-
-        #run Binary State model on the matrix and get likelihoods
-        null = MatrixParser(tree=self.tree, matrix=null_genos, model=self.model)
-        null.matrix_likelihoods()
-
-        #get z -scores null likelihood expectations
-        null_std = null.likelihoods[0].std()
-        null_mean = null.likelihoods[0].mean()
-        
+        if self.mode == 'exact':
+            self.likes, null_dist = self.exact_null()
+            self.high_lik = null_dist.threshold(self.level)
+            self.likes['deviation_score'] = (self.likes[0] >= self.high_lik).astype(int)
+            self.likes['null_pvalue'] = null_dist.sf(self.likes[0])
+            return self.likes
+
+        if self.mode == 'bootstrap':
+            self.likes, pvalues = self.bootstrap_null()
+            significant = pvalues <= self.level
+            self.high_lik = self.likes[0][significant].min() if significant.any() else np.inf
+            self.likes['deviation_score'] = significant.astype(int)
+            self.likes['null_pvalue'] = pvalues
+            return self.likes
+
+        null_dist = self.simulate_null()
+
         #get the likelihood value that corresponds 2 standard deviations above the null mean
-        self.high_lik = null_mean + 2 * null_std
+        self.high_lik = null_dist.threshold(2)
 
         lik_calc = MatrixParser(tree=self.tree,
                                model=self.model,
@@ -75,28 +235,55 @@ class SimulateNull():
                 devs.append(0)
 
         lik_calc.likelihoods['deviation_score'] = np.array(devs)
+        lik_calc.likelihoods['null_pvalue'] = null_dist.sf(lik_calc.likelihoods[0])
         
         self.likes = lik_calc.likelihoods
         return self.likes
 
-    def genome_graph(self):
+    def genome_graph(self, window=50, max_gap=0, bin_size=1000, regions_file=None):
         """
         Graphs rolling average of likelihoods along the linear genome, identifies 
         regions that deviate significantly from null expectations
 
+        Scores are scanned in blocks by a RegionCaller: positions whose
+        centered triangular rolling average is at or above high_lik are 
+        merged into regions (stored as a RegionIndex in self.regions and
+        optionally written to regions_file), and only per-bin summaries
+        of bin_size positions are plotted.
+
         TO DO: change color of outliers
         """
+        caller = RegionCaller(self.high_lik, window=window, max_gap=max_gap, bin_size=bin_size)
+        self.regions = caller.scan(self.likes[0].to_numpy())
+        self.summaries = caller.summaries()
+        logger.info(f"{len(self.regions)} regions at or above {self.high_lik:.3f}")
+        if regions_file:
+            self.regions.to_csv(regions_file)
 
-        self.likes['rollingav']= self.likes[0].rolling(50, win_type='triang').mean()
-        
-        a,b,c = toyplot.plot(
-            self.likes['rollingav'],
-            width = 500,
-            height=500,
-            color = 'blue',
-        )
+        return plot_summaries(self.summaries, self.high_lik)
+
+def _simulate_replicate(tree, ne, nsites, model, prior, seed):
+    """
+    Simulates one null replicate of SNPs on the tree and returns the
+    likelihood scores of its columns.
+    """
+    # imported here so that scoring and exact or bootstrap nulls do not need ipcoal
+    import ipcoal
+
+    #high ILS
+    mod = ipcoal.Model(tree=tree, Ne=ne, seed=seed)
+    mod.sim_loci(nloci=1, nsites=nsites)
+    null_genos = mod.write_vcf().iloc[:, 9:].T
+
+    #make sure matrix has only 0's and 1's
+    for col in null_genos:
+        null_genos[col] = null_genos[col].replace([2,3],1)
+
+    #run Binary State model on the matrix and get likelihoods
+    null = MatrixParser(tree=tree, matrix=null_genos, model=model, prior=prior)
+    null.matrix_likelihoods()
+    return null.likelihoods[0].to_numpy()
 
-        b.hlines(self.high_lik, style={"stroke": "red", "stroke-width": 2});
 
 if __name__ == "__main__":
     testtree = toytree.rtree.unittree(ntips=10, treeheight=1e5)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Closed-form transition probabilities for the two-state Markov model.
+
+For a 2x2 rate matrix Q = [[-alpha, alpha], [beta, -beta]] the matrix
+exponential P(t) = expm(Q * t) has an exact solution, so the transition
+matrices of every edge in a tree can be computed in a single vectorized
+call instead of calling scipy.linalg.expm once per branch.
+"""
+
+from collections import OrderedDict
+import numpy as np
+from hogtie.profiling import count
+
+
+def transition_matrices(alpha, beta, dists):
+    """
+    Returns the transition probability matrices P(t) for every branch
+    length in dists given the rates alpha (0->1) and beta (1->0).
+
+        P(t) = | 1 - a*f   a*f     |     f = (1 - exp(-(a+b)t)) / (a+b)
+               | b*f       1 - b*f |
+
+    Parameters
+    ----------
+    alpha: float or ndarray
+        Rate of transition from state 0 to state 1. An array of shape
+        (npatterns,) returns a separate matrix for each entry.
+    beta: float or ndarray
+        Rate of transition from state 1 to state 0. Same shape as alpha.
+    dists: ndarray
+        Branch lengths, shape (nedges,).
+
+    Returns
+    -------
+    ndarray
+        Shape (nedges, 2, 2) when alpha and beta are scalars, or
+        (nedges, 2, 2, npatterns) when they are arrays. In the latter
+        case pmats[:, i, j] broadcasts against (npatterns,) vectors.
+    """
+    count("pmat_computations")
+    alpha = np.asarray(alpha, dtype=float)
+    beta = np.asarray(beta, dtype=float)
+    dists = np.asarray(dists, dtype=float)
+
+    # broadcast dists (nedges,) against rates () or (npatterns,)
+    dists = dists.reshape(dists.shape + (1,) * alpha.ndim)
+    ratio = _expm1_ratio(alpha + beta, dists)
+
+    p01 = alpha * ratio
+    p10 = beta * ratio
+    return _assemble(1. - p01, p01, p10, 1. - p10)
+
+
+def transition_derivatives(alpha, beta, dists):
+    """
+    Returns the derivatives of the transition probability matrices 
+    from transition_matrices() with respect to alpha and to beta, as
+    two arrays with the same shape as the matrices.
+
+        dP01/da = f + a*f'    dP01/db = a*f'      f' = df/d(a+b)
+        dP10/da = b*f'        dP10/db = f + b*f'
+
+    and the diagonal entries are the negatives since rows sum to 1.
+    """
+    count("pmat_derivative_computations")
+    alpha = np.asarray(alpha, dtype=float)
+    beta = np.asarray(beta, dtype=float)
+    dists = np.asarray(dists, dtype=float)
+    dists = dists.reshape(dists.shape + (1,) * alpha.ndim)
+    ratio = _expm1_ratio(alpha + beta, dists)
+    dratio = _expm1_ratio_derivative(alpha + beta, dists)
+
+    dp01 = ratio + alpha * dratio
+    dp10 = beta * dratio
+    dalpha = _assemble(-dp01, dp01, dp10, -dp10)
+
+    dp01 = alpha * dratio
+    dp10 = ratio + beta * dratio
+    dbeta = _assemble(-dp01, dp01, dp10, -dp10)
+    return dalpha, dbeta
+
+
+def _assemble(p00, p01, p10, p11):
+    """
+    Stacks the four (nedges, ...) entries into (nedges, 2, 2, ...).
+    """
+    pmats = np.empty(p01.shape[:1] + (2, 2) + p01.shape[1:])
+    pmats[:, 0, 0] = p00
+    pmats[:, 0, 1] = p01
+    pmats[:, 1, 0] = p10
+    pmats[:, 1, 1] = p11
+    return pmats
+
+
+def _expm1_ratio(rate, dists):
+    """
+    Returns (1 - exp(-rate * t)) / rate, which tends to t as the total
+    rate goes to zero (no change along the branch).
+    """
+    safe = np.where(rate > 0, rate, 1.)
+    return np.where(rate > 0, -np.expm1(-safe * dists) / safe, dists)
+
+
+def _expm1_ratio_derivative(rate, dists):
+    """
+    Returns the derivative of _expm1_ratio with respect to the rate,
+    (t * exp(-rate * t) - ratio) / rate, using its Taylor series 
+    t^2 * (-1/2 + x/3 - x^2/8) with x = rate * t where the closed form
+    loses precision.
+    """
+    prod = rate * dists
+    small = prod < 1e-3
+    safe = np.where(small, 1., rate)
+    exact = (dists * np.exp(-safe * dists) + np.expm1(-safe * dists) / safe) / safe
+    series = dists ** 2 * (-0.5 + prod / 3. - prod ** 2 / 8.)
+    return np.where(small, series, exact)
+
+
+class TransitionCache:
+    """
+    Stores the transition matrices of every edge of a tree keyed by
+    the (alpha, beta) parameter values they were computed for, so that
+    repeated evaluations at the same point (e.g., the final evaluation
+    after an optimizer converges) do not recompute them.
+
+    Parameters
+    ----------
+    dists: ndarray
+        Branch lengths of every node in the tree, in node idx order.
+    maxsize: int
+        Maximum number of parameter points to keep. The least recently
+        used entry is dropped when the cache is full.
+    """
+    def __init__(self, dists, maxsize=16):
+        self.dists = np.asarray(dists, dtype=float)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._dcache = OrderedDict()
+
+
+    def get(self, alpha, beta):
+        """
+        Returns the (nnodes, 2, 2) array of transition matrices for
+        the given rates, computing them only on a cache miss.
+        """
+        key = (float(alpha), float(beta))
+        if key in self._cache:
+            self.hits += 1
+            count("pmat_cache_hits")
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        self.misses += 1
+        count("pmat_cache_misses")
+        pmats = transition_matrices(key[0], key[1], self.dists)
+        pmats.setflags(write=False)
+        self._cache[key] = pmats
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return pmats
+
+
+    def get_derivatives(self, alpha, beta):
+        """
+        Returns the derivatives of the transition matrices with respect
+        to alpha and beta for the given rates, computing them only on a
+        cache miss.
+        """
+        key = (float(alpha), float(beta))
+        if key in self._dcache:
+            self._dcache.move_to_end(key)
+            return self._dcache[key]
+
+        derivs = transition_derivatives(key[0], key[1], self.dists)
+        for darr in derivs:
+            darr.setflags(write=False)
+        self._dcache[key] = derivs
+        if len(self._dcache) > self.maxsize:
+            self._dcache.popitem(last=False)
+        return derivs
+
+
+    def clear(self):
+        """
+        Drops all cached transition matrices.
+        """
+        self._cache.clear()
+        self._dcache.clear()
@@ -16,21 +16,24 @@ LOGFORMAT = (
 )
 
 
-# colorize the logger if stdout is IPython/Jupyter or a terminal (TTY)
-try:
-    import IPython
-    TTY1 = bool(IPython.get_ipython())
-except ImportError:
-    TTY1 = False
+# colorize the logger if stdout is IPython/Jupyter or a terminal (TTY).
+# IPython is only checked if it is already running, since importing it
+# here would add a large fixed cost to every hogtie import.
+IPYTHON = sys.modules.get("IPython")
+TTY1 = bool(IPYTHON and IPYTHON.get_ipython())
 TTY2 = sys.stdout.isatty()
 
 
-def set_loglevel(loglevel="INFO"):
+def set_loglevel(loglevel="INFO", profile=None):
     """
     Set the loglevel for loguru logger. Using 'enable' here as 
     described in the loguru docs for logging inside of a library.
     This sets the level at which logger calls will be displayed 
     throughout the rest of the code.
+
+    If profile is a file path or stream, the JSON profile summary 
+    logged by hogtie.profiling.log_profile() is written there as one
+    line per run, instead of to stdout with the other messages.
     """
     config = {}
     config["handlers"] = [{
@@ -40,5 +43,13 @@ def set_loglevel(loglevel="INFO"):
         "colorize": TTY1 or TTY2,
         "enqueue": True,
     }]
+    if profile is not None:
+        config["handlers"][0]["filter"] = lambda record: not record["extra"].get("profile")
+        config["handlers"].append({
+            "sink": profile,
+            "format": "{message}",
+            "level": "INFO",
+            "filter": lambda record: record["extra"].get("profile", False),
+        })
     logger.configure(**config)
     logger.enable("hogtie")